@@ -0,0 +1,35 @@
+"""
+    Compare speed and accuracy of the accumulation policies
+
+    Usage: python benchmarks/accumulate.py [frames] [size]
+"""
+import sys
+import time
+import numpy as np
+from merge.accumulate import Accumulator, policies
+
+
+def main(argv=sys.argv[1:]):
+    frames = int(argv[0]) if len(argv) > 0 else 10000
+    size = int(argv[1]) if len(argv) > 1 else 256
+    rng = np.random.default_rng(0)
+    values = rng.integers(2**12, size=(frames, size, size), dtype="uint16")
+    expected = np.sum(values, axis=0, dtype="int64")
+    print("{} frames of {}x{} uint16".format(frames, size, size))
+    header = ("policy", "seconds", "max rel. err", "MiB")
+    print("{:10} {:>10} {:>14} {:>10}".format(*header))
+    for policy in policies:
+        acc = Accumulator(policy)
+        begin = time.perf_counter()
+        for value in values:
+            acc(value)
+        elapsed = time.perf_counter() - begin
+        error = np.max(np.abs(acc.sum() - expected) / np.maximum(expected, 1))
+        # All arrays kept by the accumulator, not only those of its state
+        arrays = [a for a in vars(acc).values() if isinstance(a, np.ndarray)]
+        memory = sum(a.nbytes for a in arrays) / 2**20
+        print("{:10} {:10.3f} {:14.3g} {:10.1f}".format(policy, elapsed, error, memory))
+
+
+if __name__ == "__main__":
+    main()
@@ -15,11 +15,12 @@ REQUIRES_PYTHON = ">=3.5.0"
 VERSION = None  # Will be read from the __version__.py file
 
 # What packages are required for this module to be executed?
-REQUIRED = ["numpy", "scikit-image"]
+REQUIRED = ["numpy", "tifffile", "imageio"]
 
 # What packages are optional?
 EXTRAS = {
-    # 'fancy feature': ['django'],
+    "skimage": ["scikit-image"],
+    "hdf5": ["h5py"],
 }
 
 
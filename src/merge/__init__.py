@@ -1 +1,2 @@
 from merge.__version__ import __version__  # noqa
+from merge.api import Result, reduce  # noqa
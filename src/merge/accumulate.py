@@ -1,8 +1,30 @@
 import numpy as np
 
 
-def promote_dtype(dtype):
-    # TODO: Is this sufficient?
+policies = ["auto", "float32", "float64", "int64", "kahan"]
+
+# Number of elements per block of the compensated summation, small enough for
+# the temporary arrays to stay in the cache
+kahan_block = 2**14
+
+
+def promote_dtype(dtype, policy="auto"):
+    """Return the dtype used for accumulating values of the given dtype
+
+    The policies are
+    - "auto": float32 for values with up to 4 bytes, float64 otherwise
+    - "float32" and "float64": always the given dtype
+    - "int64": exact int64 for integer values, float64 otherwise
+    - "kahan": float32 with compensated summation in Accumulator
+    """
+    if policy in ("float32", "float64"):
+        return policy
+    if policy == "int64":
+        return "int64" if np.can_cast(dtype, "int64") else "float64"
+    if policy == "kahan":
+        return "float32"
+    if policy != "auto":
+        raise ValueError("Unknown accumulation policy '{}'".format(policy))
     if dtype.itemsize <= 4:
         return "float32"
     else:
@@ -10,32 +32,374 @@ def promote_dtype(dtype):
 
 
 class Accumulator:
-    def __init__(self):
+    """Sum of values added one after the other
+
+    If out is given, the sum is accumulated in this array without copying it.
+    With the policy "kahan", sum() returns the compensated sum as a new array.
+    """
+
+    def __init__(self, policy="auto", out=None):
+        self._policy = policy
+        self._out = out
         self.reset()
 
+    def _zeros(self, value):
+        dtype = np.dtype(promote_dtype(value.dtype, self._policy))
+        if self._out is None:
+            return np.zeros_like(value, dtype=dtype)
+        if self._out.shape != np.shape(value) or self._out.dtype != dtype:
+            raise ValueError(
+                "Cannot accumulate {} values of shape {} in {} array of shape"
+                " {}".format(dtype, np.shape(value), self._out.dtype, self._out.shape)
+            )
+        self._out[...] = 0
+        return self._out
+
     def __call__(self, value):
         if self._count == 0:
             try:
-                self._sum = np.zeros_like(value, dtype=promote_dtype(value.dtype))
+                self._sum = self._zeros(value)
             except AttributeError:
                 # value doesn't have a dtype attribute,
                 # therefore no promotion can be done
                 pass
-        self._sum += value
+            else:
+                if self._policy == "kahan":
+                    self._compensation = np.zeros_like(self._sum)
+        if self._compensation is None:
+            self._sum += value
+        else:
+            self._add_compensated(value)
         self._count += 1
         return self._count
 
+    def _add_compensated(self, value, sign=1):
+        # Kahan summation of sign * value in blocks, so that only temporary
+        # arrays of kahan_block elements are needed besides sum and compensation
+        total = self._sum.reshape(-1)
+        compensation = self._compensation.reshape(-1)
+        value = np.ravel(value)
+        size = min(kahan_block, total.size)
+        corrected = np.empty(size, dtype=total.dtype)
+        new_total = np.empty(size, dtype=total.dtype)
+        for start in range(0, total.size, kahan_block):
+            stop = min(start + kahan_block, total.size)
+            s = total[start:stop]
+            c = compensation[start:stop]
+            y = corrected[: stop - start]
+            t = new_total[: stop - start]
+            if sign > 0:
+                np.subtract(value[start:stop], c, out=y)
+            else:
+                np.add(value[start:stop], c, out=y)
+                np.negative(y, out=y)
+            np.add(s, y, out=t)
+            np.subtract(t, s, out=c)
+            c -= y
+            s[...] = t
+
+    def remove(self, value):
+        """Remove a value that was added before"""
+        if self._compensation is None:
+            self._sum -= value
+        else:
+            self._add_compensated(value, -1)
+        self._count -= 1
+        return self._count
+
+    def state(self):
+        """Return the accumulated state as a dict of arrays"""
+        state = dict(
+            sum=np.asarray(self._sum),
+            count=np.asarray(self._count),
+            policy=np.asarray(self._policy),
+        )
+        if self._compensation is not None:
+            state["compensation"] = self._compensation
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        """Create an accumulator from the result of state()"""
+        acc = cls(policy=str(state.get("policy", "auto")))
+        acc._count = int(state["count"])
+        if acc._count:
+            acc._sum = state["sum"]
+            if "compensation" in state:
+                acc._compensation = state["compensation"]
+        return acc
+
+    def merge(self, other):
+        """Add everything accumulated by other to self and return self"""
+        if other._count == 0:
+            return self
+        if self._count == 0:
+            try:
+                self._sum = self._zeros(other._sum)
+                self._sum += other._sum
+            except AttributeError:
+                self._sum = other._sum
+            if other._compensation is not None:
+                self._compensation = other._compensation.copy()
+        elif self._compensation is not None:
+            self._add_compensated(other.sum())
+        else:
+            self._sum += other.sum()
+        self._count += other._count
+        return self
+
+    def extend(self, values):
+        """Add all values along the first axis of the array values"""
+        values = np.asarray(values)
+        if len(values) == 0:
+            return self._count
+        dtype = promote_dtype(values.dtype, self._policy)
+        if self._policy == "kahan":
+            exact = np.sum(values, axis=0, dtype="float64")
+            total = exact.astype(dtype)
+            compensation = (total - exact).astype(dtype)
+        else:
+            total = np.sum(values, axis=0, dtype=dtype)
+            compensation = None
+        batch = Accumulator(self._policy)
+        batch._sum = total
+        batch._compensation = compensation
+        batch._count = len(values)
+        Accumulator.merge(self, batch)
+        return self._count
+
+    @classmethod
+    def combine(cls, accumulators):
+        """Merge accumulators pairwise and return the result
+
+        The given accumulators may be modified.
+        """
+        accumulators = list(accumulators)
+        if not accumulators:
+            return cls()
+        while len(accumulators) > 1:
+            pairs = zip(accumulators[::2], accumulators[1::2])
+            merged = [first.merge(second) for first, second in pairs]
+            if len(accumulators) % 2:
+                merged.append(accumulators[-1])
+            accumulators = merged
+        return accumulators[0]
+
     def reset(self):
         self._sum = 0
         self._count = 0
+        self._compensation = None
+
+    def policy(self):
+        return self._policy
 
     def count(self):
         return self._count
 
     def sum(self):
+        if self._compensation is not None:
+            return self._sum - self._compensation
         return self._sum
 
     def avg(self):
         if self.count() == 0:
             return 0
         return self.sum() / self.count()
+
+
+class StatsAccumulator(Accumulator):
+    """Accumulator that also keeps the variance, minimum and maximum
+
+    The variance is updated with Welford's algorithm and partial results are
+    merged with the algorithm of Chan et al.
+    """
+
+    def __call__(self, value):
+        count = super().__call__(value)
+        if count == 1:
+            value = np.asarray(value)
+            dtype = promote_dtype(value.dtype, self._policy)
+            self._mean = value.astype(np.result_type(dtype, "float32"))
+            self._m2 = np.zeros_like(self._mean)
+            self._delta = np.zeros_like(self._mean)
+            self._tmp = np.zeros_like(self._mean)
+            self._min = value.copy()
+            self._max = value.copy()
+            return count
+
+        delta = np.subtract(value, self._mean, out=self._delta)
+        np.multiply(delta, 1 / count, out=self._tmp)
+        self._mean += self._tmp
+        np.subtract(value, self._mean, out=self._tmp)
+        self._tmp *= delta
+        self._m2 += self._tmp
+        np.minimum(self._min, value, out=self._min)
+        np.maximum(self._max, value, out=self._max)
+        return count
+
+    def remove(self, value):
+        raise NotImplementedError("Cannot remove values from a StatsAccumulator")
+
+    def extend(self, values):
+        values = np.asarray(values)
+        if len(values) == 0:
+            return self._count
+        batch = StatsAccumulator(self._policy)
+        Accumulator.extend(batch, values)
+        dtype = np.result_type(promote_dtype(values.dtype, self._policy), "float32")
+        batch._mean = np.mean(values, axis=0, dtype=dtype)
+        deviations = np.subtract(values, batch._mean, dtype=dtype)
+        deviations *= deviations
+        batch._m2 = np.sum(deviations, axis=0)
+        del deviations
+        batch._delta = np.zeros_like(batch._mean)
+        batch._tmp = np.zeros_like(batch._mean)
+        batch._min = np.min(values, axis=0)
+        batch._max = np.max(values, axis=0)
+        self.merge(batch)
+        return self._count
+
+    def state(self):
+        state = super().state()
+        state.update(
+            mean=np.asarray(self._mean),
+            m2=np.asarray(self._m2),
+            min=np.asarray(self._min),
+            max=np.asarray(self._max),
+        )
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        acc = super().from_state(state)
+        if acc._count:
+            acc._mean = state["mean"]
+            acc._m2 = state["m2"]
+            acc._delta = np.zeros_like(acc._mean)
+            acc._tmp = np.zeros_like(acc._mean)
+            acc._min = state["min"]
+            acc._max = state["max"]
+        return acc
+
+    def merge(self, other):
+        if other._count == 0:
+            return self
+        if self._count == 0:
+            self._mean = other._mean.copy()
+            self._m2 = other._m2.copy()
+            self._delta = np.zeros_like(self._mean)
+            self._tmp = np.zeros_like(self._mean)
+            self._min = other._min.copy()
+            self._max = other._max.copy()
+        else:
+            count = self._count + other._count
+            delta = other._mean - self._mean
+            self._mean += delta * (other._count / count)
+            delta *= delta
+            delta *= self._count * other._count / count
+            self._m2 += other._m2
+            self._m2 += delta
+            np.minimum(self._min, other._min, out=self._min)
+            np.maximum(self._max, other._max, out=self._max)
+        return super().merge(other)
+
+    def reset(self):
+        super().reset()
+        self._mean = 0
+        self._m2 = 0
+        self._min = 0
+        self._max = 0
+
+    def var(self, ddof=0):
+        if self.count() <= ddof:
+            return 0
+        return self._m2 / (self.count() - ddof)
+
+    def std(self, ddof=0):
+        return np.sqrt(self.var(ddof))
+
+    def min(self):
+        return self._min
+
+    def max(self):
+        return self._max
+
+
+def leave_one_out_scale(stats, sigma=5.0):
+    """Return the scale of a ClippedAccumulator that leaves each value out
+
+    With it, a value is accepted if it deviates from the mean of the other
+    n - 1 values by at most sigma times their standard deviation, so that a
+    single outlier does not hide itself by inflating the standard deviation.
+    For a deviation d from the mean of all values, this holds if
+
+        d**2 <= sigma**2 * m2 / (n / (n - 1) * (n * (n - 2) / (n - 1) + sigma**2))
+
+    which is a fixed threshold per pixel. All values are accepted for n < 3.
+    """
+    n = stats.count()
+    if n < 3:
+        return np.full(np.shape(stats.avg()), np.inf)
+    return np.sqrt(stats._m2 / (n / (n - 1) * (n * (n - 2) / (n - 1) + sigma**2)))
+
+
+class ClippedAccumulator(Accumulator):
+    """Accumulator that skips values far from a per-pixel center
+
+    Values are only added where they deviate from center by at most sigma
+    times scale. The number of added values per pixel is given by accepted().
+    """
+
+    def __init__(self, center, scale, sigma=5.0, policy="auto"):
+        self._center = np.asarray(center)
+        self._threshold = sigma * np.asarray(scale)
+        super().__init__(policy)
+
+    def __call__(self, value):
+        if self._count == 0:
+            dtype = promote_dtype(value.dtype, self._policy)
+            self._sum = np.zeros_like(value, dtype=dtype)
+            self._accepted = np.zeros(value.shape, dtype="int64")
+            self._deviation = np.zeros_like(self._center)
+            self._mask = np.zeros(value.shape, dtype="bool")
+        deviation = np.subtract(value, self._center, out=self._deviation)
+        np.abs(deviation, out=deviation)
+        mask = np.less_equal(deviation, self._threshold, out=self._mask)
+        np.add(self._sum, value, out=self._sum, where=mask)
+        self._accepted += mask
+        self._count += 1
+        return self._count
+
+    def remove(self, value):
+        raise NotImplementedError("Cannot remove values from a ClippedAccumulator")
+
+    def extend(self, values):
+        for value in values:
+            self(value)
+        return self._count
+
+    def merge(self, other):
+        if other._count == 0:
+            return self
+        if self._count == 0:
+            self._accepted = other._accepted.copy()
+            self._deviation = np.zeros_like(self._center)
+            self._mask = np.zeros(self._accepted.shape, dtype="bool")
+        else:
+            self._accepted += other._accepted
+        return super().merge(other)
+
+    def reset(self):
+        super().reset()
+        self._accepted = 0
+
+    def accepted(self):
+        return self._accepted
+
+    def avg(self):
+        """Return the mean of the accepted values or center if there are none"""
+        if self.count() == 0:
+            return 0
+        avg = self._center.astype(np.result_type(self._sum.dtype, "float32"))
+        np.divide(self._sum, self._accepted, out=avg, where=self._accepted > 0)
+        return avg
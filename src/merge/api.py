@@ -0,0 +1,429 @@
+"""
+    Reduce images to statistics in memory without writing any files
+"""
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import functools
+from itertools import chain, repeat
+import logging
+import os
+from pathlib import Path
+import sys
+import numpy as np
+from merge.accumulate import (
+    Accumulator,
+    ClippedAccumulator,
+    StatsAccumulator,
+    leave_one_out_scale,
+)
+from merge.correction import Correction, load_reference
+from merge.listing import find_files
+from merge.percentile import percentiles as reduce_percentiles
+from merge.shared import reduce_shared
+from merge.stack import open_stack, reduce_stack
+from merge.utils import (
+    ItemTable,
+    items_to_merge,
+    load,
+    load_items,
+    parse_exclude,
+    parse_slice,
+)
+
+
+log = logging.getLogger(__name__)
+
+# Statistics by name, the values of percentile q are called "p{q:g}"
+stat_names = ["avg", "sum", "std", "var", "min", "max", "median", "accepted"]
+
+# The statistics of reduce and the indices of the reduced images
+Result = namedtuple("Result", ["stats", "start", "stop", "count", "missing"])
+
+
+def merge_items(
+    items, accumulator, jobs=1, prefetch=0, correction=None, loader=None
+):
+    loaded = load_items(items, jobs, prefetch, correction, loader)
+    for index, path, value in loaded:
+        accumulator(value)
+
+
+def reduce_items(
+    items, jobs=1, prefetch=0, cls=Accumulator, correction=None, loader=None
+):
+    acc = cls()
+    merge_items(items, acc, jobs, prefetch, correction, loader)
+    return acc
+
+
+def reduce_chunks(
+    items, workers, jobs=1, prefetch=0, cls=Accumulator, correction=None, loader=None
+):
+    n_chunks = min(workers, len(items))
+    bounds = [len(items) * i // n_chunks for i in range(n_chunks + 1)]
+    chunks = [items[start:stop] for start, stop in zip(bounds, bounds[1:])]
+    with ProcessPoolExecutor(max_workers=n_chunks) as executor:
+        partials = executor.map(
+            reduce_items,
+            chunks,
+            repeat(jobs),
+            repeat(prefetch),
+            repeat(cls),
+            repeat(correction),
+            repeat(loader),
+        )
+        return Accumulator.combine(partials)
+
+
+def reduce_all(
+    items,
+    jobs=1,
+    prefetch=0,
+    chunk_workers=1,
+    cls=Accumulator,
+    correction=None,
+    loader=None,
+):
+    kwargs = dict(
+        jobs=jobs, prefetch=prefetch, cls=cls, correction=correction, loader=loader
+    )
+    if chunk_workers > 1:
+        return reduce_chunks(items, chunk_workers, **kwargs)
+    return reduce_items(items, **kwargs)
+
+
+def check_start(items, slice, exclude):
+    first_index = items[0][0]
+    if slice.start is not None:
+        missing = range(first_index, slice.start)
+        for i in missing:
+            if i not in exclude:
+                log.warning(
+                    "Starting at index %d although index %d was requested",
+                    first_index,
+                    i,
+                )
+                return first_index
+
+    log.info("Starting at index %d", first_index)
+    return first_index
+
+
+def check_stop(items, slice, exclude):
+    last_index = items[-1][0]
+    # It is normal Python behavior to silently accept too large endpoints
+    log.info("Last index is %d", last_index)
+    return last_index
+
+
+def check_missing(missing_indices):
+    if missing_indices:
+        log.warning("The following indices are missing: %s", missing_indices)
+
+
+def check_duplicates(duplicated_indices):
+    if duplicated_indices:
+        raise ValueError(
+            "There exist multiple files for the following indices: {}".format(
+                duplicated_indices
+            )
+        )
+
+
+def select_items(available_items, slice, exclude):
+    """Return the items to merge, their first and last index and missing indices"""
+    items, missing, dups = items_to_merge(available_items, slice, exclude)
+    if not len(items):
+        raise ValueError("No images left to merge")
+    start = check_start(items, slice, exclude)
+    stop = check_stop(items, slice, exclude)
+    check_missing(missing)
+    check_duplicates(dups)
+    return items, start, stop, missing
+
+
+def compute_stats(
+    items,
+    stats,
+    percentiles=None,
+    percentile_method="sort",
+    max_memory=2**30,
+    reduce="mean",
+    sigma=5.0,
+    accumulate_dtype="auto",
+    correction=None,
+    loader=None,
+    jobs=1,
+    prefetch=0,
+    chunk_workers=1,
+    acc=None,
+    stack=None,
+    shared_workers=1,
+):
+    """Return an OrderedDict with the statistics of items and the image count
+
+    The keys are the names in stats followed by "p{q:g}" for each percentile q.
+    An already reduced acc or the frames of stack are used for all statistics
+    but the median and percentiles. With shared_workers > 1, the sum is
+    calculated by reduce_shared.
+    """
+    unknown = sorted(set(stats) - set(stat_names))
+    if unknown:
+        raise ValueError("Unknown statistics: {}".format(", ".join(unknown)))
+    if "accepted" in stats and reduce != "clipped":
+        raise ValueError('Statistic "accepted" needs reduce="clipped"')
+    moments = [stat for stat in stats if stat in ("std", "var", "min", "max")]
+    if shared_workers > 1 and (moments or reduce == "clipped"):
+        raise ValueError("Shared workers only calculate the average and sum")
+    if moments or reduce == "clipped":
+        cls = functools.partial(StatsAccumulator, policy=accumulate_dtype)
+    else:
+        cls = functools.partial(Accumulator, policy=accumulate_dtype)
+    if reduce == "clipped":
+        stats_acc = reduce_all(
+            items, jobs, prefetch, chunk_workers, cls, correction, loader
+        )
+        log.info("Rejecting values more than %g standard deviations off", sigma)
+        cls = functools.partial(
+            ClippedAccumulator,
+            stats_acc.avg(),
+            leave_one_out_scale(stats_acc, sigma),
+            sigma,
+            policy=accumulate_dtype,
+        )
+        acc = reduce_all(items, jobs, prefetch, chunk_workers, cls, correction, loader)
+    else:
+        if acc is None and stack is not None:
+            acc = reduce_stack(stack, items, cls, correction)
+        elif acc is None and shared_workers > 1:
+            acc = reduce_shared(
+                items,
+                shared_workers,
+                jobs,
+                prefetch,
+                correction,
+                accumulate_dtype,
+                loader,
+            )
+        elif acc is None:
+            acc = reduce_all(
+                items, jobs, prefetch, chunk_workers, cls, correction, loader
+            )
+        stats_acc = acc
+    log.info("Merged %d images", acc.count())
+
+    values = OrderedDict()
+    for stat in stats:
+        if stat in moments:
+            values[stat] = getattr(stats_acc, stat)()
+        elif stat != "median":
+            values[stat] = getattr(acc, stat)()
+    qs = list(percentiles or [])
+    if "median" in stats:
+        qs.append(50)
+    if qs:
+        result = reduce_percentiles(
+            items,
+            qs,
+            max_memory=max_memory,
+            method=percentile_method,
+            jobs=jobs,
+            prefetch=prefetch,
+            loader=loader,
+        )
+        if correction is not None:
+            # The correction is linear per pixel and keeps the order of values
+            result = correction(result)
+        for q, value in zip(percentiles or [], result):
+            values["p{:g}".format(q)] = value
+        if "median" in stats:
+            values["median"] = result[-1]
+    return values, acc.count()
+
+
+def find_group(dir, pattern, basename=None):
+    """Return the items of basename or of the only basename in dir"""
+    groups = find_files(dir, pattern)
+    if basename is not None:
+        if basename not in groups:
+            raise ValueError(
+                "No files of basename '{}' found in '{}'".format(basename, dir)
+            )
+        return groups[basename]
+    if not groups:
+        raise ValueError("No files matching '{}' found in '{}'".format(pattern, dir))
+    if len(groups) > 1:
+        raise ValueError(
+            "Files of several basenames found in '{}': {}".format(
+                dir, ", ".join(sorted(groups))
+            )
+        )
+    return next(iter(groups.values()))
+
+
+def read_frame(stack, frame):
+    return stack[frame : frame + 1][0]
+
+
+def reference_image(reference, cache_dir=None, jobs=1, prefetch=0, loader=None):
+    """Return the average of the files matching a glob pattern or the array"""
+    if isinstance(reference, (str, Path)):
+        return load_reference(str(reference), cache_dir, jobs, prefetch, loader)
+    return reference
+
+
+def stream_items(images, slice, exclude, selected):
+    """Yield the index and image of the images selected by slice and exclude
+
+    The images are numbered from 0 and only read up to the end of slice. The
+    indices of the yielded images are appended to selected.
+    """
+    step = 1 if slice.step is None else slice.step
+    if step < 0:
+        raise ValueError("Negative step not allowed, got " + str(step))
+    stop = sys.maxsize if slice.stop is None else slice.stop
+    indices = range(slice.start or 0, stop, step)
+    exclude = set(exclude)
+    for index, image in enumerate(images):
+        if index >= stop:
+            break
+        if index in indices and index not in exclude:
+            selected.append(index)
+            yield index, image
+
+
+def has_negative_bounds(slice):
+    return any(bound is not None and bound < 0 for bound in (slice.start, slice.stop))
+
+
+def can_stream(slice, stats, percentiles, reduce, shared_workers):
+    """Return whether the statistics can be calculated from a single pass"""
+    if percentiles or "median" in stats or reduce == "clipped":
+        return False
+    return shared_workers <= 1 and not has_negative_bounds(slice)
+
+
+def reduce(
+    source,
+    slice=None,
+    exclude=None,
+    stats=("avg", "sum"),
+    percentiles=None,
+    pattern=r"(?P<basename>.+)-(?P<index>[0-9]+)\.tif$",
+    basename=None,
+    reduce="mean",
+    sigma=5.0,
+    accumulate_dtype="auto",
+    dark=None,
+    flat=None,
+    cache_dir=None,
+    backend=None,
+    jobs=1,
+    prefetch=0,
+    max_memory=2**30,
+    percentile_method="sort",
+    shared_workers=1,
+):
+    """Return the statistics of the images of source as a Result
+
+    source is a directory with files matching pattern, of which basename
+    selects one group if there are several, a stack like "file.h5:/dataset",
+    a list of image paths or an iterable of arrays. The images of lists and
+    iterables are numbered from 0. slice and exclude are applied to these
+    numbers and can also be given like --slice and --exclude. dark and flat
+    are glob patterns like --dark and --flat or arrays. With shared_workers,
+    the sum of files is calculated by that many processes. Nothing is written.
+
+    Iterables of arrays are consumed one array at a time and only up to the end
+    of slice. All selected arrays are kept in memory only for the median,
+    percentiles, reduce="clipped", shared_workers or negative slice bounds.
+    """
+    if slice is None:
+        slice = parse_slice(":")
+    elif isinstance(slice, str):
+        slice = parse_slice(slice)
+    if exclude is None:
+        exclude = []
+    elif isinstance(exclude, str):
+        exclude = parse_exclude(exclude)
+    loader = None if backend is None else functools.partial(load, backend=backend)
+    dark, flat = (
+        reference_image(reference, cache_dir, jobs, prefetch, loader)
+        for reference in (dark, flat)
+    )
+    correction = None
+    if dark is not None or flat is not None:
+        correction = Correction(dark, flat)
+
+    file = None
+    stack = None
+    available_items = None
+    if isinstance(source, (str, Path)) and os.path.isdir(str(source)):
+        available_items = find_group(source, pattern, basename)
+    elif isinstance(source, (str, Path)):
+        file, stack = open_stack(str(source))
+        frames = np.arange(len(stack))
+        available_items = ItemTable(frames, frames.tolist())
+        loader = functools.partial(read_frame, stack)
+    else:
+        images = iter(source)
+        first = next(images, None)
+        if first is None:
+            raise ValueError("No images to reduce")
+        images = chain([first], images)
+        if not isinstance(first, (str, Path)):
+            loader = np.asarray
+            if can_stream(slice, stats, percentiles, reduce, shared_workers):
+                return reduce_stream(
+                    images, slice, exclude, stats, accumulate_dtype, correction
+                )
+            if not has_negative_bounds(slice):
+                images = list(stream_items(images, slice, exclude, []))
+                if not images:
+                    raise ValueError("No images left to merge")
+                available_items = ItemTable.from_items(images)
+        if available_items is None:
+            images = list(images)
+            available_items = ItemTable(np.arange(len(images)), images)
+    try:
+        items, start, stop, missing = select_items(available_items, slice, exclude)
+        values, count = compute_stats(
+            items,
+            stats,
+            percentiles,
+            percentile_method,
+            max_memory,
+            reduce,
+            sigma,
+            accumulate_dtype,
+            correction,
+            loader,
+            jobs,
+            prefetch,
+            stack=stack,
+            shared_workers=shared_workers,
+        )
+    finally:
+        if file is not None:
+            file.close()
+    return Result(values, start, stop, count, missing)
+
+
+def reduce_stream(images, slice, exclude, stats, accumulate_dtype, correction):
+    """Return the Result of the iterable images reading one image at a time"""
+    selected = []
+    items = stream_items(images, slice, exclude, selected)
+    first = next(items, None)
+    if first is None:
+        raise ValueError("No images left to merge")
+    values, count = compute_stats(
+        chain([first], items),
+        stats,
+        accumulate_dtype=accumulate_dtype,
+        correction=correction,
+        loader=np.asarray,
+    )
+    frames = [(index, None) for index in selected]
+    start = check_start(frames, slice, exclude)
+    stop = check_stop(frames, slice, exclude)
+    return Result(values, start, stop, count, [])
@@ -3,23 +3,108 @@
 """
 import sys
 import argparse
+from collections import OrderedDict, deque
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import os
 from pathlib import Path
 import logging
 import re
-from merge.accumulate import Accumulator
+import numpy as np
+from merge.accumulate import Accumulator, StatsAccumulator, policies
+from merge.api import check_duplicates, compute_stats, reduce_all, select_items
+from merge.cumsum import CumulativeIndex, reduce_indexed
+from merge.correction import create_correction, default_cache_dir
+from merge.checkpoint import (
+    combine_partials,
+    covered_indices,
+    file_key,
+    load_checkpoint,
+    plan_update,
+    read_partial,
+    save_checkpoint,
+    save_partial,
+)
+from merge.follow import follow as follow_files
+from merge.listing import find_files, find_files_recursive
 from merge.utils import (
     parse_slice,
     parse_exclude,
-    group_files,
+    parse_size,
     items_to_merge,
-    load,
     save,
+    load,
+    load_items,
+    load_mmap,
 )
+from merge.backends import backends
+from merge.h5output import H5Writer
+from merge.stack import open_stack, source_basename, stack_items
+from merge.server import default_socket, serve, submit
+from merge.shared import shared_memory
+from merge.writer import AsyncWriter
 
 
 log = logging.getLogger(__name__)
 
+# Above this number of basenames, files are matched by looking up the basenames
+# that are prefixes of their names instead of a regex alternation of all
+# basenames, if the pattern starts with the basename
+MAX_ALTERNATIVES = 32
+
+
+def add_output_arguments(parser):
+    parser.add_argument(
+        "--avg",
+        type=str,
+        default="{basename}_avg_{start}_{stop}.tif",
+        help=(
+            "Filename for saving the average"
+            ' (default: "{basename}_avg_{start}_{stop}.tif")'
+        ),
+    )
+    parser.add_argument(
+        "--sum",
+        type=str,
+        default="{basename}_sum_{start}_{stop}.tif",
+        help=(
+            "Filename for saving the sum"
+            ' (default: "{basename}_sum_{start}_{stop}.tif")'
+        ),
+    )
+    for stat, name in [
+        ("std", "standard deviation"),
+        ("var", "variance"),
+        ("min", "minimum"),
+        ("max", "maximum"),
+    ]:
+        default = "{{basename}}_{}_{{start}}_{{stop}}.tif".format(stat)
+        parser.add_argument(
+            "--" + stat,
+            action="store_true",
+            help="Save the {} to --{}-output".format(name, stat),
+        )
+        parser.add_argument(
+            "--{}-output".format(stat),
+            type=str,
+            default=default,
+            help='Filename for saving the {} (default: "{}")'.format(name, default),
+        )
+
+
+def add_logging_arguments(parser):
+    parser.add_argument(
+        "--quiet",
+        "-q",
+        action="count",
+        default=0,
+        help=("Reduce verbosity (can be given multiple times)"),
+    )
+    parser.add_argument(
+        "--log", type=str, help="Write logs to a file with the given name"
+    )
+
 
 def create_parser():
     parser = argparse.ArgumentParser(
@@ -40,6 +125,20 @@ def create_parser():
     parser.add_argument(
         "--all", action="store_true", help='Same as basename=".*" without escaping'
     )
+    parser.add_argument(
+        "--stack",
+        type=str,
+        action="append",
+        default=[],
+        metavar="SOURCE",
+        help=(
+            "Merge the frames of a stack instead of files, which is either an"
+            ' HDF5 dataset given as "file.h5:/path/to/dataset" or the pages of'
+            " a multi-page TIFF file, where the index is the frame number and"
+            " the basename is the file name without extension, can be given"
+            " multiple times"
+        ),
+    )
     parser.add_argument(
         "--pattern",
         type=str,
@@ -81,206 +180,1533 @@ def create_parser():
         help='Root directory where output files are written (default: ".")',
     )
     parser.add_argument(
-        "--avg",
+        "--recursive",
+        "-r",
+        action="store_true",
+        help=(
+            "Also merge files in all subdirectories of --dir, grouped by"
+            " directory and basename, and mirror the directories in --output-dir"
+        ),
+    )
+    parser.add_argument(
+        "--include-dirs",
         type=str,
-        default="{basename}_avg_{start}_{stop}.tif",
+        action="append",
+        default=[],
         help=(
-            "Filename for saving the average"
-            ' (default: "{basename}_avg_{start}_{stop}.tif")'
+            "Glob of subdirectories relative to --dir whose files are merged with"
+            " --recursive, can be given multiple times (default: all)"
         ),
     )
     parser.add_argument(
-        "--sum",
+        "--exclude-dirs",
         type=str,
-        default="{basename}_sum_{start}_{stop}.tif",
+        action="append",
+        default=[],
         help=(
-            "Filename for saving the sum"
-            ' (default: "{basename}_sum_{start}_{stop}.tif")'
+            "Glob of subdirectories relative to --dir that are skipped with all"
+            " their subdirectories with --recursive, can be given multiple times"
         ),
     )
+    add_output_arguments(parser)
     parser.add_argument(
-        "--quiet",
-        "-q",
-        action="count",
+        "--reduce",
+        choices=["mean", "clipped"],
+        default="mean",
+        help=(
+            'Calculate the average and sum of all values ("mean") or only of'
+            " values within --sigma standard deviations of the mean of the"
+            ' other values of each pixel ("clipped"), which needs two passes'
+            ' (default: "mean")'
+        ),
+    )
+    parser.add_argument(
+        "--sigma",
+        type=float,
+        default=5.0,
+        help="Rejection threshold of --reduce clipped (default: 5)",
+    )
+    parser.add_argument(
+        "--accepted",
+        action="store_true",
+        help=(
+            "Save the number of accepted values per pixel with --reduce clipped"
+            " to --accepted-output"
+        ),
+    )
+    parser.add_argument(
+        "--accepted-output",
+        type=str,
+        default="{basename}_accepted_{start}_{stop}.tif",
+        help=(
+            "Filename for saving the number of accepted values"
+            ' (default: "{basename}_accepted_{start}_{stop}.tif")'
+        ),
+    )
+    parser.add_argument(
+        "--accumulate-dtype",
+        choices=policies,
+        default="auto",
+        help=(
+            'Type of the running sums: "auto" uses float32 for inputs of up to'
+            ' 32 bits and float64 otherwise, "int64" sums integer inputs'
+            ' exactly and "kahan" uses compensated float32 summation'
+            ' (default: "auto")'
+        ),
+    )
+    parser.add_argument(
+        "--median",
+        action="store_true",
+        help="Save the median to --median-output",
+    )
+    parser.add_argument(
+        "--median-output",
+        type=str,
+        default="{basename}_median_{start}_{stop}.tif",
+        help=(
+            "Filename for saving the median"
+            ' (default: "{basename}_median_{start}_{stop}.tif")'
+        ),
+    )
+    parser.add_argument(
+        "--percentile",
+        type=float,
+        action="append",
+        default=[],
+        help="Percentile between 0 and 100 to save (can be given multiple times)",
+    )
+    parser.add_argument(
+        "--percentile-output",
+        type=str,
+        default="{basename}_p{percentile}_{start}_{stop}.tif",
+        help=(
+            "Filename for saving percentiles"
+            ' (default: "{basename}_p{percentile}_{start}_{stop}.tif")'
+        ),
+    )
+    parser.add_argument(
+        "--percentile-method",
+        choices=["sort", "histogram"],
+        default="sort",
+        help=(
+            "Calculate the median and percentiles by sorting tiles or with"
+            " exact histograms of integer images, which needs memory independent"
+            ' of the number of images but reads them several times (default: "sort")'
+        ),
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=str,
+        default="1G",
+        help=(
+            "Approximate memory used for tiles when calculating the median and"
+            ' percentiles, e.g., "512M" (default: "1G")'
+        ),
+    )
+    parser.add_argument(
+        "--bin",
+        type=int,
+        help=(
+            "Merge every block of BIN consecutive images separately instead of"
+            " all images at once"
+        ),
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        help="Merge every run of WINDOW consecutive images (moving average)",
+    )
+    parser.add_argument(
+        "--dark",
+        type=str,
+        help=(
+            "Glob pattern of dark images whose average is subtracted from every"
+            " image before merging"
+        ),
+    )
+    parser.add_argument(
+        "--flat",
+        type=str,
+        help=(
+            "Glob pattern of flat-field images whose average, after subtracting"
+            " the dark image and normalizing to a mean of one, divides every"
+            " image before merging"
+        ),
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=default_cache_dir(),
+        help=(
+            "Directory for caching averaged dark and flat-field images and"
+            " directory listings, an empty string disables caching"
+            ' (default: "{}")'.format(default_cache_dir())
+        ),
+    )
+    parser.add_argument(
+        "--listing-cache",
+        action="store_true",
+        help=(
+            "Cache the list of files in --dir in --cache-dir and reuse it while"
+            " the modification time of --dir does not change"
+        ),
+    )
+    parser.add_argument(
+        "--backend",
+        choices=sorted(backends),
+        help=(
+            "Library for loading images (default: tifffile for TIFF files, npy"
+            " for .npy files and imageio otherwise), outputs are always saved"
+            " with the library for their extension"
+        ),
+    )
+    parser.add_argument(
+        "--mmap",
+        action="store_true",
+        help=(
+            "Memory-map the pixels of uncompressed TIFF files instead of copying"
+            " them, other files are loaded as usual"
+        ),
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of threads used for loading images (default: 1)",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
         default=0,
-        help=("Reduce verbosity (can be given multiple times)"),
+        help=(
+            "Maximum number of images loaded ahead of the image that is"
+            " currently accumulated, which must be at least --jobs. With 0,"
+            " --jobs images are loaded ahead (default: 0)"
+        ),
     )
     parser.add_argument(
-        "--log", type=str, help="Write logs to a file with the given name"
+        "--chunk-workers",
+        type=int,
+        default=1,
+        help=(
+            "Number of processes that reduce chunks of the images of a single"
+            " basename in parallel (default: 1)"
+        ),
+    )
+    parser.add_argument(
+        "--shared-workers",
+        type=int,
+        default=1,
+        help=(
+            "Number of processes that sum disjoint stripes of rows of the images"
+            " of a single basename into one buffer in shared memory, which needs"
+            " Python 3.8. Images that are not uncompressed TIFF files are summed"
+            " whole into one sum per process in shared memory instead"
+            " (default: 1)"
+        ),
+    )
+    parser.add_argument(
+        "--group-workers",
+        type=int,
+        default=1,
+        help=(
+            "Number of processes that merge different basenames in parallel"
+            " (default: 1)"
+        ),
+    )
+    parser.add_argument(
+        "--write-jobs",
+        type=int,
+        default=1,
+        help=(
+            "Number of threads saving images while merging continues, 0 to"
+            " save synchronously (default: 1)"
+        ),
     )
+    parser.add_argument(
+        "--h5-output",
+        action="store_true",
+        help=(
+            "Write the statistics of all basenames to groups of the HDF5 file"
+            " --h5-file instead of separate files, and replace existing groups"
+            " of the file"
+        ),
+    )
+    parser.add_argument(
+        "--h5-file",
+        type=str,
+        default="merged.h5",
+        help=(
+            "Filename of the HDF5 file of --h5-output relative to --output-dir"
+            ' (default: "merged.h5")'
+        ),
+    )
+    parser.add_argument(
+        "--h5-group",
+        type=str,
+        help=(
+            'Group name in --h5-output (default: "{basename}" or'
+            ' "{reldir}/{basename}" with --recursive)'
+        ),
+    )
+    parser.add_argument(
+        "--checkpoint",
+        action="store_true",
+        help="Resume or extend the merge with the checkpoint --checkpoint-file",
+    )
+    parser.add_argument(
+        "--checkpoint-file",
+        type=str,
+        default="{basename}_checkpoint.npz",
+        help=(
+            "Filename of the checkpoint relative to --output-dir"
+            ' (default: "{basename}_checkpoint.npz")'
+        ),
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=100,
+        help="Update the checkpoint after this many images (default: 100)",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help='Merge from the cumulative sums --index-file written by "merge index"',
+    )
+    parser.add_argument(
+        "--index-file",
+        type=str,
+        default="{basename}_index",
+        help=(
+            "Filename without extension of cumulative sums, relative to"
+            ' --output-dir (default: "{basename}_index")'
+        ),
+    )
+    parser.add_argument(
+        "--follow",
+        "-f",
+        action="store_true",
+        help=(
+            "Keep merging new images as they appear until --timeout expires or"
+            " the stop index of --slice is reached"
+        ),
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=1.0,
+        help="Seconds between checks for new images with --follow (default: 1)",
+    )
+    parser.add_argument(
+        "--write-interval",
+        type=float,
+        default=10.0,
+        help=(
+            "Seconds between rewriting the outputs with --follow, 0 disables"
+            " (default: 10)"
+        ),
+    )
+    parser.add_argument(
+        "--write-every",
+        type=int,
+        default=0,
+        help=(
+            "Rewrite the outputs with --follow after this many new images,"
+            " 0 disables (default: 0)"
+        ),
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60.0,
+        help="Stop --follow after this many seconds without new images (default: 60)",
+    )
+    add_logging_arguments(parser)
 
     return parser
 
 
-def parse_config(args):
-    if args.quiet == 0:
-        level = logging.INFO
-    elif args.quiet == 1:
-        level = logging.WARNING
+def log_level(quiet):
+    if quiet == 0:
+        return logging.INFO
+    elif quiet == 1:
+        return logging.WARNING
     else:
-        level = logging.ERROR
+        return logging.ERROR
+
+
+stream_format = "%(levelname)-8s %(message)s"
 
+
+def create_file_handler(path):
+    file_handler = logging.FileHandler(path)
+    file_handler.setLevel(logging.INFO)
+    file_formatter = logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    file_handler.setFormatter(file_formatter)
+    return file_handler
+
+
+def setup_logging(quiet=0, log=None):
     logger = logging.getLogger("merge")
     logger.setLevel(logging.INFO)
 
     stream_handler = logging.StreamHandler()
-    stream_handler.setLevel(level)
-    stream_formatter = logging.Formatter("%(levelname)-8s %(message)s")
-    stream_handler.setFormatter(stream_formatter)
+    stream_handler.setLevel(log_level(quiet))
+    stream_handler.setFormatter(logging.Formatter(stream_format))
     logger.addHandler(stream_handler)
 
-    if args.log:
-        file_handler = logging.FileHandler(args.log)
-        file_handler.setLevel(logging.INFO)
-        file_formatter = logging.Formatter(
-            "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-        )
-        file_handler.setFormatter(file_formatter)
-        logger.addHandler(file_handler)
+    if log:
+        logger.addHandler(create_file_handler(log))
+
+
+def get_output_dir(args):
+    """Return --output-dir, with {reldir} appended for --recursive"""
+    if args.recursive:
+        return os.path.join(args.output_dir, "{reldir}")
+    return args.output_dir
 
+
+def parse_config(args):
     slice = parse_slice(args.slice)
     exclude = parse_exclude(args.exclude)
     if args.all:
         if args.basename:
             log.warning("Ignoring positional arguments because --all is given")
         basenames = [".*"]
+        basename_set = None
+    elif len(args.basename) > MAX_ALTERNATIVES and args.pattern.startswith(
+        "(?P<basename>{basename})"
+    ):
+        basenames = [".*"]
+        basename_set = list(args.basename)
     else:
         basenames = [re.escape(basename) for basename in args.basename]
-    if not basenames:
-        raise ValueError("Neither basename nor --all given")
+        basename_set = None
+    if not basenames and not args.stack:
+        raise ValueError("Neither basename, --all nor --stack given")
     pattern = args.pattern.format(
         basename="|".join(basenames), sep=args.sep, ext=args.ext
     )
 
-    avg_pattern = os.path.join(args.output_dir, args.avg)
-    sum_pattern = os.path.join(args.output_dir, args.sum)
+    output_dir = get_output_dir(args)
+    avg_pattern = os.path.join(output_dir, args.avg)
+    sum_pattern = os.path.join(output_dir, args.sum)
+    if args.median:
+        median_pattern = os.path.join(output_dir, args.median_output)
+    else:
+        median_pattern = None
+    percentile_pattern = os.path.join(output_dir, args.percentile_output)
+    if any(q < 0 or q > 100 for q in args.percentile):
+        raise ValueError("--percentile must be between 0 and 100")
+    max_memory = parse_size(args.max_memory)
+    if (median_pattern or args.percentile) and (
+        args.follow or args.bin or args.window
+    ):
+        raise ValueError(
+            "--median and --percentile cannot be combined with --follow, --bin"
+            " or --window"
+        )
+    if args.accepted:
+        accepted_pattern = os.path.join(output_dir, args.accepted_output)
+    else:
+        accepted_pattern = None
+    if args.reduce == "clipped" and (
+        args.follow or args.bin or args.window or args.checkpoint or args.index
+    ):
+        raise ValueError(
+            "--reduce clipped cannot be combined with --follow, --bin, --window,"
+            " --checkpoint or --index"
+        )
+    if accepted_pattern and args.reduce != "clipped":
+        log.warning("Ignoring --accepted because --reduce is not clipped")
+        accepted_pattern = None
+    stats_patterns = {}
+    for stat in ["std", "var", "min", "max"]:
+        if getattr(args, stat):
+            output = getattr(args, stat + "_output")
+            stats_patterns[stat] = os.path.join(output_dir, output)
+    if args.index:
+        index_pattern = os.path.join(output_dir, args.index_file)
+    else:
+        index_pattern = None
+    if args.checkpoint:
+        checkpoint_pattern = os.path.join(output_dir, args.checkpoint_file)
+    else:
+        checkpoint_pattern = None
+    if args.h5_output:
+        h5_output = os.path.join(args.output_dir, args.h5_file)
+    else:
+        h5_output = None
+    if args.h5_group:
+        h5_group = args.h5_group
+    elif args.recursive:
+        h5_group = "{reldir}/{basename}"
+    else:
+        h5_group = "{basename}"
+
+    if args.jobs < 1:
+        raise ValueError("--jobs must be at least 1")
+    if args.prefetch < 0:
+        raise ValueError("--prefetch must not be negative")
+    if 0 < args.prefetch < args.jobs:
+        raise ValueError("--prefetch must be 0 or at least --jobs")
+    if args.chunk_workers < 1:
+        raise ValueError("--chunk-workers must be at least 1")
+    if args.group_workers < 1:
+        raise ValueError("--group-workers must be at least 1")
+    if args.group_workers > 1 and args.chunk_workers > 1:
+        raise ValueError("--group-workers and --chunk-workers cannot be combined")
+    if args.shared_workers < 1:
+        raise ValueError("--shared-workers must be at least 1")
+    if args.shared_workers > 1 and shared_memory is None:
+        raise ValueError("--shared-workers needs Python 3.8 or later")
+    if args.shared_workers > 1 and (
+        args.chunk_workers > 1
+        or args.group_workers > 1
+        or args.follow
+        or args.stack
+        or args.checkpoint
+        or args.index
+        or args.bin
+        or args.window
+        or stats_patterns
+        or args.reduce != "mean"
+    ):
+        raise ValueError(
+            "--shared-workers cannot be combined with --chunk-workers,"
+            " --group-workers, --follow, --stack, --checkpoint, --index, --bin,"
+            " --window, --std, --var, --min, --max or --reduce clipped"
+        )
+    if args.write_jobs < 0:
+        raise ValueError("--write-jobs must not be negative")
+    if args.follow and (args.group_workers > 1 or args.chunk_workers > 1):
+        raise ValueError("--follow cannot be combined with --*-workers")
+    if args.bin is not None and args.bin < 1:
+        raise ValueError("--bin must be at least 1")
+    if args.window is not None and args.window < 1:
+        raise ValueError("--window must be at least 1")
+    if args.bin and args.window:
+        raise ValueError("--bin and --window cannot be combined")
+    if (args.bin or args.window) and (
+        args.follow or args.chunk_workers > 1 or args.checkpoint or args.index
+    ):
+        raise ValueError(
+            "--bin and --window cannot be combined with --follow, --chunk-workers,"
+            " --checkpoint or --index"
+        )
+    if stats_patterns and (
+        args.follow or args.window or args.checkpoint or args.index
+    ):
+        raise ValueError(
+            "--std, --var, --min and --max cannot be combined with --follow,"
+            " --window, --checkpoint or --index"
+        )
+    if (args.dark or args.flat) and (args.checkpoint or args.index):
+        raise ValueError(
+            "--dark and --flat cannot be combined with --checkpoint or --index"
+        )
+    if args.stack and (
+        args.basename
+        or args.all
+        or args.follow
+        or args.recursive
+        or args.chunk_workers > 1
+        or args.group_workers > 1
+        or args.checkpoint
+        or args.index
+        or args.bin
+        or args.window
+        or median_pattern
+        or args.percentile
+        or args.reduce != "mean"
+    ):
+        raise ValueError(
+            "--stack can only be combined with --avg, --sum, --std, --var, --min,"
+            " --max, --dark, --flat and --accumulate-dtype"
+        )
+    if h5_output and (
+        args.follow or args.bin or args.window or args.group_workers > 1
+    ):
+        raise ValueError(
+            "--h5-output cannot be combined with --follow, --bin, --window or"
+            " --group-workers"
+        )
+    if args.mmap and args.backend:
+        raise ValueError("--mmap and --backend cannot be combined")
+    if (args.include_dirs or args.exclude_dirs) and not args.recursive:
+        raise ValueError("--include-dirs and --exclude-dirs require --recursive")
+    if args.recursive and (args.follow or args.listing_cache):
+        raise ValueError(
+            "--recursive cannot be combined with --follow or --listing-cache"
+        )
+    if args.checkpoint and (args.follow or args.chunk_workers > 1):
+        raise ValueError(
+            "--checkpoint cannot be combined with --follow or --chunk-workers"
+        )
+    if args.index and args.follow:
+        raise ValueError("--index cannot be combined with --follow")
 
     return dict(
         pattern=pattern,
+        basenames=basename_set,
+        stacks=args.stack,
         dir=args.dir,
+        listing_cache=args.listing_cache and args.cache_dir or None,
+        recursive=args.recursive,
+        include_dirs=args.include_dirs,
+        exclude_dirs=args.exclude_dirs,
         slice=slice,
         exclude=exclude,
         avg_pattern=avg_pattern,
         sum_pattern=sum_pattern,
+        std_pattern=stats_patterns.get("std"),
+        var_pattern=stats_patterns.get("var"),
+        min_pattern=stats_patterns.get("min"),
+        max_pattern=stats_patterns.get("max"),
+        median_pattern=median_pattern,
+        percentiles=args.percentile,
+        percentile_pattern=percentile_pattern,
+        percentile_method=args.percentile_method,
+        max_memory=max_memory,
+        reduce=args.reduce,
+        sigma=args.sigma,
+        accepted_pattern=accepted_pattern,
+        accumulate_dtype=args.accumulate_dtype,
+        dark=args.dark,
+        flat=args.flat,
+        cache_dir=args.cache_dir,
+        backend=args.backend,
+        mmap=args.mmap,
+        jobs=args.jobs,
+        prefetch=args.prefetch,
+        chunk_workers=args.chunk_workers,
+        shared_workers=args.shared_workers,
+        group_workers=args.group_workers,
+        write_jobs=args.write_jobs,
+        checkpoint_pattern=checkpoint_pattern,
+        checkpoint_every=args.checkpoint_every,
+        index_pattern=index_pattern,
+        bin=args.bin,
+        window=args.window,
+        follow=args.follow,
+        poll_interval=args.poll_interval,
+        write_interval=args.write_interval,
+        write_every=args.write_every,
+        timeout=args.timeout,
+        h5_output=h5_output,
+        h5_group=h5_group,
     )
 
 
-def merge_items(items, accumulator):
-    for index, path in items:
-        try:
-            value = load(path)
-        except OSError:
-            log.error("Cannot open '%s'", path)
-        except ValueError:
-            log.error("Format of '%s' not supported", path)
-
-        accumulator(value)
-
-
-def check_start(items, slice, exclude):
-    first_index = items[0][0]
-    if slice.start is not None:
-        missing = range(first_index, slice.start)
-        for i in missing:
-            if i not in exclude:
-                log.warning(
-                    "Starting at index %d although index %d was requested",
-                    first_index,
-                    i,
-                )
-                return first_index
+def reduce_bins(
+    items, size, jobs=1, prefetch=0, cls=Accumulator, correction=None, loader=None
+):
+    """Yield first index, last index and Accumulator of blocks of size images
 
-    log.info("Starting at index %d", first_index)
-    return first_index
+    The Accumulator is reset after it has been yielded.
+    """
+    acc = cls()
+    loaded = load_items(items, jobs, prefetch, correction, loader)
+    for index, path, value in loaded:
+        if acc.count() == 0:
+            start = index
+        acc(value)
+        if acc.count() == size:
+            yield start, index, acc
+            acc.reset()
+    if acc.count():
+        log.warning("The last block contains only %d images", acc.count())
+        yield start, index, acc
 
 
-def check_stop(items, slice, exclude):
-    last_index = items[-1][0]
-    # It is normal Python behavior to silently accept too large endpoints
-    log.info("Last index is %d", last_index)
-    return last_index
+def reduce_windows(
+    items, width, jobs=1, prefetch=0, correction=None, policy="auto", loader=None
+):
+    """Yield first index, last index and Accumulator of each run of width images"""
+    acc = Accumulator(policy)
+    window = deque()
+    loaded = load_items(items, jobs, prefetch, correction, loader)
+    for index, path, value in loaded:
+        window.append((index, value))
+        acc(value)
+        if len(window) > width:
+            acc.remove(window.popleft()[1])
+        if len(window) == width:
+            yield window[0][0], index, acc
+    if len(window) < width:
+        log.warning("Less than %d images available", width)
 
 
-def check_missing(missing_indices):
-    if missing_indices:
-        log.warning("The following indices are missing: %s", missing_indices)
+def reduce_checkpointed(
+    items, checkpoint, every=0, jobs=1, prefetch=0, policy="auto", loader=None
+):
+    """Reduce items reusing and updating the checkpoint file"""
+    wanted = {index: file_key(path) for index, path in items}
+    if os.path.exists(checkpoint):
+        acc, merged = load_checkpoint(checkpoint)
+        plan = plan_update(merged, wanted)
+        if plan is None:
+            log.warning("Files in checkpoint '%s' changed, starting over", checkpoint)
+            acc, merged = Accumulator(policy), {}
+            plan = [], sorted(wanted)
+        elif acc.policy() != policy:
+            log.warning(
+                "Checkpoint '%s' uses --accumulate-dtype %s, starting over",
+                checkpoint,
+                acc.policy(),
+            )
+            acc, merged = Accumulator(policy), {}
+            plan = [], sorted(wanted)
+        else:
+            log.info("Reusing %d images from checkpoint '%s'", acc.count(), checkpoint)
+    else:
+        acc, merged = Accumulator(policy), {}
+        plan = [], sorted(wanted)
+    remove, add = plan
 
+    paths = dict(items)
+    updated = 0
+    if remove:
+        log.info("Removing %d images from the checkpoint", len(remove))
+        removed_items = [(index, merged[index][0]) for index in remove]
+        for index, path, value in load_items(
+            removed_items, jobs, prefetch, loader=loader
+        ):
+            acc.remove(value)
+            del merged[index]
+            updated += 1
+    added_items = [(i, paths[i]) for i in add]
+    for index, path, value in load_items(added_items, jobs, prefetch, loader=loader):
+        acc(value)
+        merged[index] = wanted[index]
+        updated += 1
+        if every and updated % every == 0:
+            save_checkpoint(checkpoint, acc, merged)
+    if updated or not os.path.exists(checkpoint):
+        log.info("Saving checkpoint to '%s'", checkpoint)
+        save_checkpoint(checkpoint, acc, merged)
+    return acc
 
-def check_duplicates(duplicated_indices):
-    if duplicated_indices:
-        raise ValueError(
-            "There exist multiple files for the following indices: {}".format(
-                duplicated_indices
+
+output_names = dict(
+    avg="average",
+    sum="sum",
+    std="standard deviation",
+    var="variance",
+    min="minimum",
+    max="maximum",
+    median="median",
+    accepted="number of accepted values",
+)
+
+
+def save_outputs(acc, basename, start, stop, saver=None, **patterns):
+    """Save the statistic of acc given by each keyword to its pattern
+
+    Images are saved with saver, which defaults to save.
+    """
+    if saver is None:
+        saver = save
+    for stat, pattern in patterns.items():
+        if not pattern:
+            continue
+        path = pattern.format(basename=basename, start=start, stop=stop)
+        log.info("Saving %s to '%s'", output_names[stat], path)
+        saver(path, getattr(acc, stat)())
+
+
+def merge_group(
+    available_items,
+    slice,
+    exclude,
+    basename=None,
+    avg=None,
+    sum=None,
+    jobs=1,
+    prefetch=0,
+    chunk_workers=1,
+    checkpoint=None,
+    checkpoint_every=0,
+    index=None,
+    bin=None,
+    window=None,
+    std=None,
+    var=None,
+    min=None,
+    max=None,
+    median=None,
+    percentiles=None,
+    percentile=None,
+    percentile_method="sort",
+    max_memory=2**30,
+    reduce="mean",
+    sigma=5.0,
+    accepted=None,
+    accumulate_dtype="auto",
+    correction=None,
+    loader=None,
+    stack=None,
+    writer=None,
+    h5_group="{basename}",
+    saver=None,
+    partial=None,
+    moments=False,
+    shared_workers=1,
+    reldir=".",
+):
+    if saver is None:
+        saver = save
+    items, start, stop, missing = select_items(available_items, slice, exclude)
+    if partial:
+        cls = functools.partial(
+            StatsAccumulator if moments else Accumulator, policy=accumulate_dtype
+        )
+        acc = reduce_all(items, jobs, prefetch, chunk_workers, cls, correction, loader)
+        path = partial.format(basename=basename, start=start, stop=stop)
+        log.info("Saving partial result of %d images to '%s'", acc.count(), path)
+        merged = {index: file_key(item) for index, item in items}
+        save_partial(path, acc, merged, basename, reldir)
+        return acc.count()
+    outputs = OrderedDict(avg=avg, sum=sum, std=std, var=var, min=min, max=max)
+    if bin or window:
+        if std or var or min or max:
+            cls = functools.partial(StatsAccumulator, policy=accumulate_dtype)
+        else:
+            cls = functools.partial(Accumulator, policy=accumulate_dtype)
+        if bin:
+            results = reduce_bins(items, bin, jobs, prefetch, cls, correction, loader)
+        else:
+            results = reduce_windows(
+                items, window, jobs, prefetch, correction, accumulate_dtype, loader
             )
+        for first, last, acc in results:
+            log.info("Merged %d images from %d to %d", acc.count(), first, last)
+            save_outputs(acc, basename, first, last, saver=saver, **outputs)
+        return len(items)
+
+    acc = None
+    if reduce == "clipped":
+        outputs["accepted"] = accepted
+    elif index:
+        acc = reduce_indexed(
+            index.format(basename=basename), items, slice, accumulate_dtype
+        )
+    elif checkpoint and stack is None:
+        checkpoint = checkpoint.format(basename=basename)
+        acc = reduce_checkpointed(
+            items,
+            checkpoint,
+            checkpoint_every,
+            jobs=jobs,
+            prefetch=prefetch,
+            policy=accumulate_dtype,
+            loader=loader,
+        )
+    outputs["median"] = median
+    values, count = compute_stats(
+        items,
+        [stat for stat, pattern in outputs.items() if pattern],
+        percentiles,
+        percentile_method,
+        max_memory,
+        reduce,
+        sigma,
+        accumulate_dtype,
+        correction,
+        loader,
+        jobs,
+        prefetch,
+        chunk_workers,
+        acc=acc,
+        stack=stack,
+        shared_workers=shared_workers,
+    )
+
+    if writer is not None:
+        attrs = dict(
+            start=start,
+            stop=stop,
+            count=count,
+            missing=np.array(missing, dtype="int64"),
+            excluded=np.array(
+                sorted(i for i in exclude or [] if start <= i <= stop), dtype="int64"
+            ),
+        )
+        inputs = [path for index, path in items]
+        group = h5_group.format(basename=basename, start=start, stop=stop)
+        writer.write(group, values, attrs, inputs)
+        return count
+    fields = dict(basename=basename, start=start, stop=stop)
+    for stat, value in values.items():
+        if stat in outputs:
+            name = output_names[stat]
+            path = outputs[stat].format(**fields)
+        else:
+            name = "percentile " + stat[1:]
+            path = percentile.format(percentile=stat[1:], **fields)
+        log.info("Saving %s to '%s'", name, path)
+        saver(path, value)
+    return count
+
+
+class RecordingHandler(logging.Handler):
+    """Keep log records in a picklable form to handle them later"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+def with_reldir(pattern, reldir):
+    """Replace {reldir} in pattern and keep all other fields"""
+    return pattern.replace("{reldir}", reldir.replace("{", "{{").replace("}", "}}"))
+
+
+def group_task(key, kwargs):
+    """Return the label, basename and merge_group kwargs of a group
+
+    Groups found with --recursive have a key (reldir, basename), {reldir} in
+    their output patterns is replaced by reldir and reldir is passed on.
+    """
+    if not isinstance(key, tuple):
+        return key, key, kwargs
+    reldir, basename = key
+    kwargs = {
+        name: with_reldir(value, reldir) if isinstance(value, str) else value
+        for name, value in kwargs.items()
+    }
+    kwargs["reldir"] = reldir
+    return os.path.join(reldir, basename), basename, kwargs
+
+
+def merge_group_recorded(key, available_items, level, kwargs):
+    """Call merge_group and return its log records, count and error"""
+    label, basename, kwargs = group_task(key, kwargs)
+    logger = logging.getLogger("merge")
+    handlers = logger.handlers
+    propagate = logger.propagate
+    previous_level = logger.level
+    handler = RecordingHandler()
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(level)
+    count = None
+    error = None
+    try:
+        log.info("Merging files for basename '%s'", label)
+        count = merge_group(available_items, basename=basename, **kwargs)
+    except Exception as e:
+        log.error("Merging basename '%s' failed: %s", label, e)
+        error = str(e) or type(e).__name__
+    finally:
+        logger.handlers = handlers
+        logger.propagate = propagate
+        logger.setLevel(previous_level)
+    return handler.records, count, error
+
+
+def merge_groups_parallel(groups, workers, **kwargs):
+    """Merge groups in worker processes and return the failed basenames
+
+    The log records of each group are handled in the parent process after the
+    group has finished, ordered by basename.
+    """
+    level = logging.getLogger("merge").getEffectiveLevel()
+    keys = sorted(groups)
+    summary = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            merge_group_recorded,
+            keys,
+            [groups[key] for key in keys],
+            repeat(level),
+            repeat(kwargs),
         )
+        for key, (records, count, error) in zip(keys, results):
+            for record in records:
+                logging.getLogger(record.name).handle(record)
+            summary.append((group_task(key, {})[0], count, error))
 
+    log.info("Summary:")
+    for basename, count, error in summary:
+        if error is None:
+            log.info("  '%s': merged %d images", basename, count)
+        else:
+            log.error("  '%s': failed (%s)", basename, error)
+    return [basename for basename, count, error in summary if error is not None]
 
-def merge_group(available_items, slice, exclude, basename=None, avg=None, sum=None):
-    items, missing, dups = items_to_merge(available_items, slice, exclude)
-    start = check_start(items, slice, exclude)
-    stop = check_stop(items, slice, exclude)
-    check_missing(missing)
-    check_duplicates(dups)
-    acc = Accumulator()
-    merge_items(items, acc)
-    if avg:
-        avg = avg.format(basename=basename, start=start, stop=stop)
-        log.info("Saving average to '%s'", avg)
-        save(avg, acc.avg())
-    if sum:
-        sum = sum.format(basename=basename, start=start, stop=stop)
-        log.info("Saving sum to '%s'", sum)
-        save(sum, acc.sum())
-
-
-def create_output_dirs(avg_pattern, sum_pattern):
-    avg_parent = Path(avg_pattern).parent
-    sum_parent = Path(sum_pattern).parent
-    log.info("Creating output directory '%s'", avg_parent)
-    avg_parent.mkdir(parents=True, exist_ok=True)
-    if sum_parent != avg_parent:
-        log.info("Creating output directory '%s'", sum_parent)
-        sum_parent.mkdir(parents=True, exist_ok=True)
+
+def merge_stacks(stacks, **kwargs):
+    """Merge the frames of each stack source and return the failed ones"""
+    failed = []
+    for source in stacks:
+        log.info("Merging frames of '%s'", source)
+        try:
+            file, stack = open_stack(source)
+        except (OSError, KeyError, ValueError) as e:
+            log.error("Cannot open '%s': %s", source, e)
+            failed.append(source)
+            continue
+        with file:
+            items = stack_items(source, stack)
+            merge_group(items, basename=source_basename(source), stack=stack, **kwargs)
+    return failed
+
+
+def create_loader(backend=None, mmap=False):
+    """Return the function for loading images or None for load"""
+    if mmap:
+        return load_mmap
+    if backend:
+        return functools.partial(load, backend=backend)
+    return None
+
+
+def create_output_dirs(*patterns):
+    parents = []
+    for pattern in patterns:
+        if pattern and Path(pattern).parent not in parents:
+            parents.append(Path(pattern).parent)
+    for parent in parents:
+        log.info("Creating output directory '%s'", parent)
+        parent.mkdir(parents=True, exist_ok=True)
 
 
 def merge(
     pattern,
+    basenames=None,
+    stacks=None,
     dir=".",
+    listing_cache=None,
+    recursive=False,
+    include_dirs=None,
+    exclude_dirs=None,
     slice=slice(None),
     exclude=None,
     avg_pattern=None,
     sum_pattern=None,
+    std_pattern=None,
+    var_pattern=None,
+    min_pattern=None,
+    max_pattern=None,
+    median_pattern=None,
+    percentiles=None,
+    percentile_pattern=None,
+    percentile_method="sort",
+    max_memory=2**30,
+    reduce="mean",
+    sigma=5.0,
+    accepted_pattern=None,
+    accumulate_dtype="auto",
+    dark=None,
+    flat=None,
+    cache_dir=None,
+    backend=None,
+    mmap=False,
+    jobs=1,
+    prefetch=0,
+    chunk_workers=1,
+    shared_workers=1,
+    group_workers=1,
+    write_jobs=1,
+    checkpoint_pattern=None,
+    checkpoint_every=0,
+    index_pattern=None,
+    bin=None,
+    window=None,
+    follow=False,
+    poll_interval=1.0,
+    write_interval=10.0,
+    write_every=0,
+    timeout=60.0,
+    h5_output=None,
+    h5_group="{basename}",
+    partial_pattern=None,
+    moments=False,
 ):
-    create_output_dirs(avg_pattern, sum_pattern)
-    files = [file for file in Path(dir).iterdir() if file.is_file()]
-    groups = group_files(files, pattern=pattern)
-    if not groups:
-        log.warning("No files matching '%s' found", pattern)
-    for basename, available_items in sorted(groups.items()):
-        log.info("Merging files for basename '%s'", basename)
-        merge_group(
-            available_items,
+    output_patterns = [
+        avg_pattern,
+        sum_pattern,
+        std_pattern,
+        var_pattern,
+        min_pattern,
+        max_pattern,
+        median_pattern,
+        percentile_pattern if percentiles else None,
+        accepted_pattern,
+        partial_pattern,
+    ]
+    if not recursive and not h5_output:
+        create_output_dirs(*output_patterns)
+    loader = create_loader(backend, mmap)
+    correction = create_correction(
+        dark, flat, cache_dir, jobs=jobs, prefetch=prefetch, loader=loader
+    )
+    if follow:
+        return follow_files(
+            pattern,
+            dir=dir,
+            basenames=basenames,
             slice=slice,
             exclude=exclude,
-            basename=basename,
-            avg=avg_pattern,
-            sum=sum_pattern,
+            avg_pattern=avg_pattern,
+            sum_pattern=sum_pattern,
+            jobs=jobs,
+            prefetch=prefetch,
+            poll_interval=poll_interval,
+            write_interval=write_interval,
+            write_every=write_every,
+            timeout=timeout,
+            correction=correction,
+            accumulate_dtype=accumulate_dtype,
+            loader=loader,
         )
+    kwargs = dict(
+        slice=slice,
+        exclude=exclude,
+        avg=avg_pattern,
+        sum=sum_pattern,
+        std=std_pattern,
+        var=var_pattern,
+        min=min_pattern,
+        max=max_pattern,
+        median=median_pattern,
+        percentiles=percentiles,
+        percentile=percentile_pattern,
+        percentile_method=percentile_method,
+        max_memory=max_memory,
+        reduce=reduce,
+        sigma=sigma,
+        accepted=accepted_pattern,
+        accumulate_dtype=accumulate_dtype,
+        correction=correction,
+        loader=loader,
+        jobs=jobs,
+        prefetch=prefetch,
+        chunk_workers=chunk_workers,
+        shared_workers=shared_workers,
+        checkpoint=checkpoint_pattern,
+        checkpoint_every=checkpoint_every,
+        index=index_pattern,
+        bin=bin,
+        window=window,
+        h5_group=h5_group,
+        partial=partial_pattern,
+        moments=moments,
+    )
+    writer = None
+    if h5_output:
+        create_output_dirs(h5_output)
+        writer = kwargs["writer"] = H5Writer(h5_output)
+    async_writer = None
+    if write_jobs > 0 and group_workers == 1 and not h5_output:
+        async_writer = AsyncWriter(write_jobs)
+        kwargs["saver"] = async_writer.save
+    failed = []
+    try:
+        if stacks:
+            failed = merge_stacks(stacks, **kwargs)
+            return failed
+        if recursive:
+            groups = find_files_recursive(
+                dir, pattern, basenames, include_dirs, exclude_dirs, workers=jobs
+            )
+            for reldir in sorted({reldir for reldir, basename in groups}):
+                if not h5_output:
+                    patterns = (with_reldir(p, reldir) for p in output_patterns if p)
+                    create_output_dirs(*patterns)
+        else:
+            groups = find_files(dir, pattern, basenames, listing_cache)
+        if not groups:
+            log.warning("No files matching '%s' found", pattern)
+        if group_workers > 1:
+            failed = merge_groups_parallel(groups, group_workers, **kwargs)
+            return failed
+        for key, available_items in sorted(groups.items()):
+            label, basename, group_kwargs = group_task(key, kwargs)
+            log.info("Merging files for basename '%s'", label)
+            merge_group(available_items, basename=basename, **group_kwargs)
+        return failed
+    finally:
+        if writer is not None:
+            writer.close()
+        if async_writer is not None:
+            failed.extend(async_writer.close())
+
+
+def index(
+    pattern,
+    dir=".",
+    index_pattern="{basename}_index",
+    stride=100,
+    basenames=None,
+    listing_cache=None,
+    **kwargs
+):
+    """Write cumulative sums of all available images of every group"""
+    groups = find_files(dir, pattern, basenames, listing_cache)
+    if not groups:
+        log.warning("No files matching '%s' found", pattern)
+    Path(index_pattern).parent.mkdir(parents=True, exist_ok=True)
+    for basename, available_items in sorted(groups.items()):
+        items, missing, dups = items_to_merge(available_items)
+        check_duplicates(dups)
+        path = index_pattern.format(basename=basename)
+        log.info("Indexing %d images of '%s' to '%s'", len(items), basename, path)
+        CumulativeIndex.build(path, items, stride=stride, **kwargs)
+    return []
+
+
+def create_index_parser():
+    parser = create_parser()
+    parser.prog = "merge index"
+    parser.description = (
+        "Store cumulative sums over all images to quickly merge arbitrary slices"
+        " with --index later."
+    )
+    parser.set_defaults(index=True)
+    parser.add_argument(
+        "--stride",
+        type=int,
+        default=100,
+        help="Number of indices between stored cumulative sums (default: 100)",
+    )
+    return parser
+
+
+def index_main(argv):
+    parser = create_index_parser()
+    args = parser.parse_args(argv)
+    setup_logging(args.quiet, args.log)
+    try:
+        config = parse_config(args)
+        if args.stride < 1:
+            raise ValueError("--stride must be at least 1")
+        if args.recursive:
+            raise ValueError("merge index does not support --recursive")
+    except ValueError as e:
+        log.error("%s", e)
+        parser.print_usage()
+        exit(1)
+
+    index(
+        config["pattern"],
+        dir=config["dir"],
+        index_pattern=config["index_pattern"],
+        stride=args.stride,
+        basenames=config["basenames"],
+        listing_cache=config["listing_cache"],
+        jobs=config["jobs"],
+        prefetch=config["prefetch"],
+        loader=create_loader(config["backend"], config["mmap"]),
+    )
+    return 0
+
+
+def run_job(cwd, options):
+    """Merge in cwd with the options of a submitted job
+
+    options are the fields of the parsed command line arguments, missing fields
+    have their default value. Returns the status, the failed groups and the log
+    messages of the job.
+    """
+    logger = logging.getLogger("merge")
+    handlers = logger.handlers
+    propagate = logger.propagate
+    handler = RecordingHandler()
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    failed = []
+    status = "error"
+    try:
+        args = create_parser().parse_args([])
+        unknown = sorted(set(options) - set(vars(args)))
+        if unknown:
+            raise ValueError("Unknown options: {}".format(", ".join(unknown)))
+        vars(args).update(options)
+        handler.setLevel(log_level(args.quiet))
+        if args.log:
+            logger.addHandler(create_file_handler(os.path.join(cwd, args.log)))
+        os.chdir(cwd)
+        config = parse_config(args)
+        if config["follow"]:
+            raise ValueError("--follow cannot be used with merge submit")
+        failed = merge(**config)
+        status = "failed" if failed else "ok"
+    except Exception as e:
+        log.error("%s", e)
+    finally:
+        for file_handler in logger.handlers[1:]:
+            file_handler.close()
+        logger.handlers = handlers
+        logger.propagate = propagate
+    formatter = logging.Formatter(stream_format)
+    messages = [formatter.format(record) for record in handler.records]
+    return dict(status=status, failed=failed, log=messages)
+
+
+def create_serve_parser():
+    parser = argparse.ArgumentParser(
+        prog="merge serve",
+        description=(
+            "Run merges submitted with merge submit in worker processes that"
+            " keep imports, directory listings and references loaded."
+        ),
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        default=default_socket(),
+        help="Unix socket to listen on (default: {})".format(default_socket()),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of jobs that run in parallel (default: 1)",
+    )
+    add_logging_arguments(parser)
+    return parser
+
+
+def serve_main(argv):
+    parser = create_serve_parser()
+    args = parser.parse_args(argv)
+    setup_logging(args.quiet, args.log)
+    if args.workers < 1:
+        log.error("--workers must be at least 1")
+        parser.print_usage()
+        exit(1)
+    try:
+        serve(args.socket, run_job, args.workers)
+    except (OSError, ValueError) as e:
+        log.error("%s", e)
+        return 1
+    return 0
+
+
+def create_submit_parser():
+    parser = create_parser()
+    parser.prog = "merge submit"
+    parser.description = (
+        "Run a merge in a server started with merge serve, which saves the"
+        " startup time of a new process."
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        default=default_socket(),
+        help="Unix socket of the server (default: {})".format(default_socket()),
+    )
+    return parser
+
+
+def submit_main(argv):
+    parser = create_submit_parser()
+    args = parser.parse_args(argv)
+    setup_logging(args.quiet)
+    options = vars(args)
+    path = options.pop("socket")
+    try:
+        response = submit(path, dict(cwd=os.getcwd(), options=options))
+    except (OSError, ValueError) as e:
+        log.error("Cannot submit to '%s': %s", path, e)
+        return 1
+    for message in response["log"]:
+        print(message, file=sys.stderr)
+    if "error" in response:
+        log.error("Job failed: %s", response["error"])
+    return 0 if response["status"] == "ok" else 1
+
+
+def create_partial_parser():
+    parser = create_parser()
+    parser.prog = "merge partial"
+    parser.description = (
+        "Save the sums over the images of every basename as partial results,"
+        ' which are combined with "merge combine" later.'
+    )
+    parser.add_argument(
+        "--partial",
+        type=str,
+        default="{basename}_partial_{start}_{stop}.npz",
+        help=(
+            "Filename of the partial result relative to --output-dir"
+            ' (default: "{basename}_partial_{start}_{stop}.npz")'
+        ),
+    )
+    parser.add_argument(
+        "--moments",
+        action="store_true",
+        help=(
+            "Also store the variance, minimum and maximum for --std, --var,"
+            " --min and --max of merge combine"
+        ),
+    )
+    return parser
+
+
+def partial_main(argv):
+    parser = create_partial_parser()
+    args = parser.parse_args(argv)
+    setup_logging(args.quiet, args.log)
+    try:
+        config = parse_config(args)
+        if (
+            args.stack
+            or args.follow
+            or args.checkpoint
+            or args.index
+            or args.bin
+            or args.window
+            or args.median
+            or args.percentile
+            or args.reduce != "mean"
+            or args.h5_output
+        ):
+            raise ValueError(
+                "merge partial cannot be combined with --stack, --follow,"
+                " --checkpoint, --index, --bin, --window, --median, --percentile,"
+                " --reduce clipped or --h5-output"
+            )
+    except ValueError as e:
+        log.error("%s", e)
+        parser.print_usage()
+        exit(1)
+
+    config.update(
+        partial_pattern=os.path.join(get_output_dir(args), args.partial),
+        moments=args.moments,
+    )
+    failed = merge(**config)
+    return 1 if failed else 0
+
+
+def create_combine_parser():
+    parser = argparse.ArgumentParser(
+        prog="merge combine",
+        description=(
+            'Combine the partial results written by "merge partial" and save'
+            " the statistics of every basename."
+        ),
+    )
+    parser.add_argument("partial", type=str, nargs="+", help="Partial result files")
+    parser.add_argument(
+        "--output-dir",
+        "-o",
+        type=str,
+        default=".",
+        help='Directory where output files are written (default: ".")',
+    )
+    add_output_arguments(parser)
+    add_logging_arguments(parser)
+    return parser
+
+
+def combine(paths, **patterns):
+    """Combine the partial results in paths and return the failed basenames
+
+    The statistic given by each keyword is saved to its pattern, where start
+    and stop are the first and last index of all partial results of a basename.
+    Partial results of "merge partial --recursive" are grouped by their
+    relative directory and basename, and {reldir} in the patterns is replaced
+    by the relative directory.
+    """
+    groups = OrderedDict()
+    for path in paths:
+        reldir, basename, indices, moments = read_partial(path)
+        groups.setdefault((reldir, basename), []).append((path, indices, moments))
+    needs_moments = any(patterns.get(stat) for stat in ["std", "var", "min", "max"])
+    failed = []
+    for (reldir, basename), partials in sorted(groups.items()):
+        label = os.path.normpath(os.path.join(reldir, basename))
+        try:
+            indices = covered_indices([partial[:2] for partial in partials])
+            moments = all(partial[2] for partial in partials)
+            if needs_moments and not moments:
+                raise ValueError(
+                    "Partial results without moments cannot give --std, --var,"
+                    " --min or --max, use merge partial --moments"
+                )
+            log.info(
+                "Combining %d partial results with %d images of '%s'",
+                len(partials),
+                len(indices),
+                label,
+            )
+            acc = combine_partials([partial[0] for partial in partials], moments)
+        except (OSError, KeyError, ValueError) as e:
+            log.error("Cannot combine partial results of '%s': %s", label, e)
+            failed.append(label)
+            continue
+        group_patterns = {
+            stat: os.path.normpath(with_reldir(pattern, reldir))
+            for stat, pattern in patterns.items()
+            if pattern
+        }
+        create_output_dirs(*group_patterns.values())
+        save_outputs(acc, basename, int(indices[0]), int(indices[-1]), **group_patterns)
+    return failed
+
+
+def combine_main(argv):
+    parser = create_combine_parser()
+    args = parser.parse_args(argv)
+    setup_logging(args.quiet, args.log)
+    patterns = dict(avg=args.avg, sum=args.sum)
+    for stat in ["std", "var", "min", "max"]:
+        if getattr(args, stat):
+            patterns[stat] = getattr(args, stat + "_output")
+    patterns = {
+        stat: os.path.join(args.output_dir, "{reldir}", pattern)
+        for stat, pattern in patterns.items()
+    }
+    try:
+        failed = combine(args.partial, **patterns)
+    except (OSError, KeyError, ValueError) as e:
+        log.error("%s", e)
+        return 1
+    return 1 if failed else 0
+
+
+commands = {
+    "index": index_main,
+    "partial": partial_main,
+    "combine": combine_main,
+    "serve": serve_main,
+    "submit": submit_main,
+}
 
 
 def main(argv=sys.argv[1:]):
+    if argv and argv[0] in commands:
+        return commands[argv[0]](argv[1:])
+
     parser = create_parser()
     args = parser.parse_args(argv)
+    setup_logging(args.quiet, args.log)
     try:
         config = parse_config(args)
-    except ValueError:
+    except ValueError as e:
+        log.error("%s", e)
         parser.print_usage()
         exit(1)
 
     log.debug("Using pattern '%s'", config["pattern"])
-    merge(**config)
+    failed = merge(**config)
 
-    return 0
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
@@ -0,0 +1,87 @@
+"""
+    Backends for loading and saving images
+
+    The modules of a backend are only imported when it is used.
+"""
+from collections import namedtuple
+import os
+import numpy as np
+
+
+Backend = namedtuple("Backend", ["load", "save"])
+
+
+def tifffile_load(path):
+    import tifffile
+
+    return tifffile.imread(str(path))
+
+
+def tifffile_save(path, image):
+    import tifffile
+
+    tifffile.imwrite(str(path), image)
+
+
+def import_imageio():
+    """Return the imageio v2 API without the deprecation warning of imageio 3"""
+    try:
+        import imageio.v2 as imageio
+    except ImportError:  # imageio < 2.16
+        import imageio
+    return imageio
+
+
+def imageio_load(path):
+    return np.asarray(import_imageio().imread(str(path)))
+
+
+def imageio_save(path, image):
+    import_imageio().imwrite(str(path), image)
+
+
+def skimage_load(path):
+    from skimage.io import imread
+
+    return imread(str(path))
+
+
+def skimage_save(path, image):
+    from skimage.io import imsave
+
+    imsave(str(path), image, check_contrast=False)
+
+
+def npy_load(path):
+    return np.load(str(path))
+
+
+def npy_save(path, image):
+    np.save(str(path), image)
+
+
+backends = {
+    "tifffile": Backend(tifffile_load, tifffile_save),
+    "imageio": Backend(imageio_load, imageio_save),
+    "skimage": Backend(skimage_load, skimage_save),
+    "npy": Backend(npy_load, npy_save),
+}
+
+# Backends by lowercase filename extension, all others use default_backend
+extensions = {
+    ".tif": "tifffile",
+    ".tiff": "tifffile",
+    ".npy": "npy",
+}
+default_backend = "imageio"
+
+
+def get_backend(path, name=None):
+    """Return the backend called name or the one for the extension of path"""
+    if name is None:
+        extension = os.path.splitext(str(path))[1].lower()
+        name = extensions.get(extension, default_backend)
+    try:
+        return backends[name]
+    except KeyError:
+        raise ValueError("Unknown backend '{}'".format(name)) from None
@@ -0,0 +1,125 @@
+"""
+    Persist accumulators together with the images they contain
+"""
+import logging
+import os
+import numpy as np
+from merge.accumulate import Accumulator, StatsAccumulator
+
+
+log = logging.getLogger(__name__)
+
+
+def file_key(path):
+    """Identify the current version of a file by its absolute path and mtime"""
+    return os.path.abspath(str(path)), os.stat(str(path)).st_mtime_ns
+
+
+def save_checkpoint(path, acc, merged, **arrays):
+    """Atomically save acc and merged, a dict mapping indices to file keys
+
+    Further arrays given as keywords are stored as well.
+    """
+    indices = sorted(merged)
+    state = {"acc_" + key: value for key, value in acc.state().items()}
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            indices=np.array(indices, dtype="int64"),
+            paths=np.array([merged[i][0] for i in indices], dtype="str"),
+            mtimes=np.array([merged[i][1] for i in indices], dtype="int64"),
+            **dict(state, **arrays)
+        )
+    os.replace(tmp_path, str(path))
+
+
+def load_checkpoint(path, cls=Accumulator):
+    """Return the accumulator and merged dict saved by save_checkpoint"""
+    with np.load(str(path)) as data:
+        state = {
+            key[len("acc_") :]: data[key]
+            for key in data.files
+            if key.startswith("acc_")
+        }
+        keys = zip(data["paths"], data["mtimes"])
+        merged = {
+            int(index): (str(path), int(mtime))
+            for index, (path, mtime) in zip(data["indices"], keys)
+        }
+    return cls.from_state(state), merged
+
+
+def plan_update(merged, wanted):
+    """Compare the merged files of a checkpoint to the wanted ones
+
+    Both arguments map indices to file keys. Returns the indices to remove
+    from and to add to the checkpoint or None if files in the checkpoint were
+    modified and it cannot be updated.
+    """
+    remove = []
+    for index, key in merged.items():
+        if wanted.get(index) == key:
+            continue
+        if not os.path.exists(key[0]) or file_key(key[0]) != key:
+            return None
+        remove.append(index)
+    add = [index for index, key in wanted.items() if merged.get(index) != key]
+    return sorted(remove), sorted(add)
+
+
+def save_partial(path, acc, merged, basename, reldir="."):
+    """Save the partial result acc of basename in reldir like a checkpoint"""
+    save_checkpoint(
+        path, acc, merged, basename=np.array(basename), reldir=np.array(reldir)
+    )
+
+
+def read_partial(path):
+    """Return the reldir, basename, indices and if a partial result has moments
+
+    reldir is "." for partial results of the directory itself.
+    """
+    with np.load(str(path)) as data:
+        moments = "acc_m2" in data.files
+        reldir = str(data["reldir"]) if "reldir" in data.files else "."
+        return reldir, str(data["basename"]), data["indices"], moments
+
+
+def covered_indices(partials):
+    """Return the sorted indices of partials, a list of (path, indices)
+
+    Raises ValueError if two partial results contain the same index.
+    """
+    covered = np.array([], dtype="int64")
+    owners = np.array([], dtype="int64")
+    for i, (path, indices) in enumerate(partials):
+        overlap = np.intersect1d(covered, indices)
+        if len(overlap):
+            other = partials[owners[np.searchsorted(covered, overlap[0])]][0]
+            raise ValueError(
+                "'{}' and '{}' both contain the indices {}".format(
+                    other, path, overlap.tolist()
+                )
+            )
+        covered = np.concatenate([covered, indices])
+        owners = np.concatenate([owners, np.full(len(indices), i, dtype="int64")])
+        order = np.argsort(covered, kind="stable")
+        covered = covered[order]
+        owners = owners[order]
+    return covered
+
+
+def combine_partials(paths, moments=True):
+    """Merge the accumulators of the partial results in paths
+
+    The partial results are loaded one after the other. If moments is false,
+    only the sums are merged.
+    """
+    cls = StatsAccumulator if moments else Accumulator
+    acc = None
+    for path in paths:
+        log.debug("Merging partial result '%s'", path)
+        partial, merged = load_checkpoint(path, cls)
+        acc = partial if acc is None else acc.merge(partial)
+    return acc
@@ -0,0 +1,117 @@
+"""
+    Dark-image and flat-field correction with cached reference images
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+from merge.accumulate import Accumulator
+from merge.checkpoint import file_key
+from merge.utils import load_items
+
+
+log = logging.getLogger(__name__)
+
+# References already calculated in this process, keyed by reference_key
+references = {}
+
+
+def default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache_home, "merge")
+
+
+def reference_key(paths):
+    """Return a key that changes if any of paths is modified"""
+    keys = [file_key(path) for path in sorted(paths)]
+    return hashlib.sha1(json.dumps(keys).encode()).hexdigest()
+
+
+def load_reference(pattern, cache_dir=None, jobs=1, prefetch=0, loader=None):
+    """Return the average of all files matching the glob pattern
+
+    The average is cached in memory and, if cache_dir is given, on disk.
+    """
+    paths = sorted(glob.glob(pattern))
+    if not paths:
+        raise ValueError("No files matching '{}' found".format(pattern))
+    key = reference_key(paths)
+    if key in references:
+        return references[key]
+
+    cache_path = os.path.join(cache_dir, key + ".npy") if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        log.info("Loading cached average of '%s' from '%s'", pattern, cache_path)
+        reference = np.load(cache_path)
+    else:
+        log.info("Averaging %d files matching '%s'", len(paths), pattern)
+        acc = Accumulator()
+        items = list(enumerate(paths))
+        for index, path, value in load_items(items, jobs, prefetch, loader=loader):
+            acc(value)
+        reference = np.asarray(acc.avg(), dtype="float32")
+        if cache_path:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = "{}.tmp{}".format(cache_path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                np.save(f, reference)
+            os.replace(tmp_path, cache_path)
+    references[key] = reference
+    return reference
+
+
+class Correction:
+    """Subtract a dark image and divide by a normalized flat-field image
+
+    The flat field is normalized to a mean of one after subtracting the dark
+    image. Pixels where the flat field is not positive are set to zero.
+    """
+
+    def __init__(self, dark=None, flat=None):
+        self.dark = None if dark is None else np.asarray(dark, dtype="float32")
+        self.gain = None
+        if flat is not None:
+            flat = np.asarray(flat, dtype="float32")
+            if self.dark is not None:
+                flat = flat - self.dark
+            valid = flat > 0
+            self.gain = np.zeros_like(flat)
+            np.divide(np.mean(flat[valid]), flat, out=self.gain, where=valid)
+
+    def rows(self, start, stop):
+        """Return the correction of the rows start:stop of an image"""
+        correction = Correction()
+        if self.dark is not None:
+            correction.dark = self.dark[start:stop]
+        if self.gain is not None:
+            correction.gain = self.gain[start:stop]
+        return correction
+
+    def __call__(self, value):
+        if self.dark is not None:
+            value = np.subtract(value, self.dark, dtype="float32")
+            if self.gain is not None:
+                value *= self.gain
+        elif self.gain is not None:
+            value = np.multiply(value, self.gain, dtype="float32")
+        return value
+
+
+def create_correction(
+    dark=None, flat=None, cache_dir=None, jobs=1, prefetch=0, loader=None
+):
+    """Return a Correction for the glob patterns dark and flat or None"""
+    if not dark and not flat:
+        return None
+    kwargs = dict(jobs=jobs, prefetch=prefetch, loader=loader)
+    if dark:
+        dark = load_reference(dark, cache_dir, **kwargs)
+    else:
+        dark = None
+    if flat:
+        flat = load_reference(flat, cache_dir, **kwargs)
+    else:
+        flat = None
+    return Correction(dark, flat)
@@ -0,0 +1,143 @@
+"""
+    Cumulative sums for constant time sums over arbitrary slices
+"""
+import json
+import logging
+import os
+import numpy as np
+from merge.accumulate import Accumulator, promote_dtype
+from merge.checkpoint import file_key
+from merge.utils import load, load_items
+
+
+log = logging.getLogger(__name__)
+
+
+class StaleIndexError(ValueError):
+    pass
+
+
+class CumulativeIndex:
+    """Sums of all images below every stride-th index
+
+    The index consists of the files path + ".npy", which holds the cumulative
+    sums, and path + ".json", which holds the indexed files and their mtimes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        self.first = meta["first"]
+        self.stride = meta["stride"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.indices = np.array([frame[0] for frame in meta["frames"]], dtype="int64")
+        self.keys = {index: (path, mtime) for index, path, mtime in meta["frames"]}
+        self.prefixes = np.load(path + ".npy", mmap_mode="r")
+
+    @classmethod
+    def build(cls, path, items, stride=100, jobs=1, prefetch=0, loader=None):
+        """Index items, which must be sorted and have unique indices"""
+        first = items[0][0]
+        last = items[-1][0]
+        n_prefixes = (last - first) // stride + 2
+        frames = []
+        prefixes = None
+        running = None
+        k = 1
+        for index, file, value in load_items(items, jobs, prefetch, loader=loader):
+            if prefixes is None:
+                shape = (n_prefixes,) + value.shape
+                prefixes = np.lib.format.open_memmap(
+                    path + ".npy", mode="w+", dtype="float64", shape=shape
+                )
+                prefixes[0] = 0
+                running = np.zeros(value.shape, dtype="float64")
+                dtype = value.dtype
+            while index >= first + k * stride:
+                prefixes[k] = running
+                k += 1
+            running += value
+            frames.append((index,) + file_key(file))
+        if prefixes is None:
+            raise ValueError("None of the images could be loaded")
+        while k < n_prefixes:
+            prefixes[k] = running
+            k += 1
+        prefixes.flush()
+        del prefixes
+
+        meta = dict(first=first, stride=stride, dtype=dtype.str, frames=frames)
+        with open(path + ".json", "w") as f:
+            json.dump(meta, f)
+        return cls(path)
+
+    def _frames_between(self, start, stop):
+        lo, hi = np.searchsorted(self.indices, [start, stop])
+        return self.indices[lo:hi].tolist()
+
+    def _load(self, index):
+        path, mtime = self.keys[index]
+        if not os.path.exists(path) or file_key(path) != (path, mtime):
+            raise StaleIndexError("'{}' changed since it was indexed".format(path))
+        return load(path)
+
+    def prefix_sum(self, index):
+        """Return the sum of all indexed images with an index below index"""
+        k = (index - self.first) // self.stride
+        k = min(max(k, 0), len(self.prefixes) - 1)
+        lower = self.first + k * self.stride
+        below = self._frames_between(lower, index)
+        if k + 1 < len(self.prefixes):
+            above = self._frames_between(index, lower + self.stride)
+        else:
+            above = None
+        if above is not None and len(above) < len(below):
+            total = np.array(self.prefixes[k + 1])
+            for i in above:
+                total -= self._load(i)
+        else:
+            total = np.array(self.prefixes[k])
+            for i in below:
+                total += self._load(i)
+        return total
+
+    def reduce(self, items, policy="auto"):
+        """Return an Accumulator of items, a contiguous selection of indices
+
+        Raises a StaleIndexError if items do not match the indexed files.
+        """
+        start = items[0][0]
+        stop = items[-1][0]
+        selected = {index for index, path in items}
+        for index, path in items:
+            if self.keys.get(index) != file_key(path):
+                raise StaleIndexError("'{}' is not indexed".format(path))
+        indexed = self._frames_between(start, stop + 1)
+        excluded = [index for index in indexed if index not in selected]
+        total = self.prefix_sum(stop + 1) - self.prefix_sum(start)
+        for index in excluded:
+            total -= self._load(index)
+        state = dict(
+            sum=total.astype(promote_dtype(self.dtype, policy)),
+            count=len(items),
+            policy=policy,
+        )
+        return Accumulator.from_state(state)
+
+
+def reduce_indexed(path, items, slice, policy="auto"):
+    """Return an Accumulator of items from the index at path or None"""
+    if slice.step not in (None, 1):
+        log.info("Not using the index because the step is not 1")
+        return None
+    if not os.path.exists(path + ".json"):
+        log.info("Not using the index because '%s.json' does not exist", path)
+        return None
+    try:
+        acc = CumulativeIndex(path).reduce(items, policy)
+    except StaleIndexError as e:
+        log.warning("Not using the index '%s': %s", path, e)
+        return None
+    log.info("Using the index '%s'", path)
+    return acc
@@ -0,0 +1,210 @@
+"""
+    Incrementally merge images while they are acquired
+"""
+import logging
+import os
+import time
+from merge.accumulate import Accumulator
+from merge.listing import find_files
+from merge.utils import items_to_merge, load, save, prefetch_map
+
+
+log = logging.getLogger(__name__)
+
+
+class Watcher:
+    """Wait for new files in a directory
+
+    Uses inotify if the optional package inotify_simple is installed and falls
+    back to polling otherwise.
+    """
+
+    def __init__(self, dir, interval=1.0):
+        self.interval = interval
+        try:
+            import inotify_simple
+        except ImportError:
+            self._inotify = None
+            return
+        flags = inotify_simple.flags
+        self._inotify = inotify_simple.INotify()
+        self._inotify.add_watch(str(dir), flags.CLOSE_WRITE | flags.MOVED_TO)
+
+    def wait(self, timeout=None):
+        if timeout is None or timeout > self.interval:
+            timeout = self.interval
+        if self._inotify is None:
+            time.sleep(timeout)
+        else:
+            self._inotify.read(timeout=int(timeout * 1000))
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+
+
+class Follower:
+    """Keep the running sum of a single basename up to date"""
+
+    def __init__(self, basename, slice, exclude, avg=None, sum=None, policy="auto"):
+        self.basename = basename
+        self.slice = slice
+        self.exclude = exclude
+        self.avg = avg
+        self.sum = sum
+        self.acc = Accumulator(policy)
+        self.merged = set()
+        self.start = None
+        self.stop = None
+        self.last_available = None
+        self.pending = 0
+        self.unwritten = 0
+        self.last_write = time.monotonic()
+        self.written = {}
+
+    def update(
+        self, available_items, jobs=1, prefetch=0, correction=None, loader=None
+    ):
+        """Merge items that were not merged before and return their number"""
+        items, missing, dups = items_to_merge(available_items, self.slice, self.exclude)
+        self.last_available = max(index for index, path in available_items)
+        if dups:
+            log.error(
+                "There exist multiple files for the following indices of '%s',"
+                " using the first one: %s",
+                self.basename,
+                dups,
+            )
+        new_items = [item for item in items if item[0] not in self.merged]
+        if loader is None:
+            loader = load
+        if correction is None:
+            func = loader
+        else:
+
+            def func(path):
+                return correction(loader(path))
+
+        paths = (path for index, path in new_items)
+        results = prefetch_map(func, paths, jobs=jobs, prefetch=prefetch)
+        count = 0
+        for (index, path), result in zip(new_items, results):
+            try:
+                value = result()
+            except (OSError, ValueError):
+                # The file might still be written, try again later
+                log.debug("Cannot load '%s' yet", path)
+                continue
+            self.acc(value)
+            self.merged.add(index)
+            count += 1
+        self.pending = len(new_items) - count
+        if self.merged:
+            self.start = min(self.merged)
+            self.stop = max(self.merged)
+        self.unwritten += count
+        return count
+
+    def done(self, final_index):
+        return (
+            final_index is not None
+            and self.last_available is not None
+            and self.last_available >= final_index
+            and self.pending == 0
+        )
+
+    def write_due(self, write_interval=None, write_every=None):
+        if self.unwritten == 0:
+            return False
+        if write_every and self.unwritten >= write_every:
+            return True
+        elapsed = time.monotonic() - self.last_write
+        return bool(write_interval) and elapsed >= write_interval
+
+    def write(self):
+        if self.unwritten == 0:
+            return
+        outputs = [("average", self.avg, self.acc.avg), ("sum", self.sum, self.acc.sum)]
+        for name, pattern, stat in outputs:
+            if not pattern:
+                continue
+            path = pattern.format(
+                basename=self.basename, start=self.start, stop=self.stop
+            )
+            log.info("Saving %s of %d images to '%s'", name, self.acc.count(), path)
+            save(path, stat())
+            previous = self.written.get(name)
+            if previous is not None and previous != path:
+                log.info("Removing outdated '%s'", previous)
+                os.remove(previous)
+            self.written[name] = path
+        self.unwritten = 0
+        self.last_write = time.monotonic()
+
+
+def follow(
+    pattern,
+    dir=".",
+    slice=slice(None),
+    exclude=None,
+    avg_pattern=None,
+    sum_pattern=None,
+    jobs=1,
+    prefetch=0,
+    poll_interval=1.0,
+    write_interval=10.0,
+    write_every=0,
+    timeout=60.0,
+    correction=None,
+    accumulate_dtype="auto",
+    basenames=None,
+    loader=None,
+):
+    """Merge images as they appear until timeout or the end of slice
+
+    Stops if no new image was merged for timeout seconds or if an image with
+    the last index of slice is available for every basename.
+    """
+    exclude = exclude or []
+    final_index = None if slice.stop is None else slice.stop - 1
+    followers = {}
+    watcher = Watcher(dir, poll_interval)
+    last_change = time.monotonic()
+    try:
+        while True:
+            groups = find_files(dir, pattern, basenames)
+            for basename, available_items in groups.items():
+                if basename not in followers:
+                    log.info("Following files for basename '%s'", basename)
+                    followers[basename] = Follower(
+                        basename,
+                        slice,
+                        exclude,
+                        avg_pattern,
+                        sum_pattern,
+                        accumulate_dtype,
+                    )
+                follower = followers[basename]
+                if follower.update(
+                    available_items, jobs, prefetch, correction, loader
+                ):
+                    last_change = time.monotonic()
+                if follower.write_due(write_interval, write_every):
+                    follower.write()
+
+            if followers and all(f.done(final_index) for f in followers.values()):
+                log.info("Reached index %d", final_index)
+                break
+            idle = time.monotonic() - last_change
+            if idle >= timeout:
+                log.info("No new images for %g seconds", timeout)
+                break
+            watcher.wait(timeout - idle)
+    finally:
+        watcher.close()
+        for follower in followers.values():
+            follower.write()
+
+    if not followers:
+        log.warning("No files matching '%s' found", pattern)
+    return []
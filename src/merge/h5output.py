@@ -0,0 +1,88 @@
+"""
+    Write the results of all groups to a single HDF5 file
+"""
+from collections import OrderedDict
+import logging
+import posixpath
+import numpy as np
+
+
+log = logging.getLogger(__name__)
+
+
+class H5Writer:
+    """Write the results of groups to an HDF5 file as they arrive
+
+    Every group is stored in an HDF5 group with one compressed dataset per
+    statistic, the provenance attributes start, stop, count, missing and
+    excluded and a dataset "inputs" with the merged files. Existing files are
+    appended to and groups that already exist are replaced. The file is kept
+    open and flushed to disk after every batch groups.
+    """
+
+    def __init__(self, path, batch=64, compression="gzip", compression_opts=4):
+        self.path = str(path)
+        self.batch = batch
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.unflushed = 0
+        self.file = None
+
+    def write(self, group, datasets, attrs, inputs):
+        """Write datasets, attributes and input files of group"""
+        if self.file is None:
+            import h5py
+
+            self.file = h5py.File(self.path, "a")
+        log.info("Writing group '%s' to '%s'", group, self.path)
+        self._write_group(group, datasets, attrs, inputs)
+        self.unflushed += 1
+        if self.unflushed >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if self.file is None or not self.unflushed:
+            return
+        self.file.flush()
+        self.unflushed = 0
+
+    def _write_group(self, name, datasets, attrs, inputs):
+        import h5py
+
+        name = posixpath.normpath(name)
+        if name in self.file:
+            log.info("Replacing group '%s' in '%s'", name, self.path)
+            del self.file[name]
+        group = self.file.create_group(name)
+        for key, value in datasets.items():
+            value = np.asarray(value)
+            if value.ndim:
+                options = dict(
+                    chunks=True,
+                    shuffle=True,
+                    compression=self.compression,
+                    compression_opts=self.compression_opts,
+                )
+            else:
+                options = {}
+            group.create_dataset(key, data=value, **options)
+        for key, value in attrs.items():
+            group.attrs[key] = value
+        inputs = [str(path) for path in OrderedDict.fromkeys(inputs)]
+        group.create_dataset(
+            "inputs", data=np.array(inputs, dtype=h5py.string_dtype())
+        )
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,149 @@
+"""
+    Fast discovery of the files to merge with an optional listing cache
+"""
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import time
+from merge.utils import ItemTable, group_files
+
+
+log = logging.getLogger(__name__)
+
+# A directory modified less than this many seconds before it was listed might
+# change again without a visible change of its mtime
+MTIME_RESOLUTION = 2.0
+
+# Listings made in this process by absolute path, as (mtime, names)
+listings = {}
+
+
+def scan_dir(dir):
+    """Return the names of all files in dir
+
+    Uses the file type returned by os.scandir, so that in general no file has
+    to be stat'ed.
+    """
+    return [entry.name for entry in os.scandir(str(dir)) if entry.is_file()]
+
+
+def listing_path(dir, cache_dir):
+    key = hashlib.sha1(os.path.abspath(str(dir)).encode()).hexdigest()
+    return os.path.join(cache_dir, "listings", key + ".json")
+
+
+def list_files(dir, cache_dir=None):
+    """Return the names of all files in dir
+
+    The listing is kept in memory and, if cache_dir is given, stored there. It
+    is reused as long as the modification time of dir does not change.
+    """
+    key = os.path.abspath(str(dir))
+    mtime = os.stat(str(dir)).st_mtime_ns
+    if key in listings and listings[key][0] == mtime:
+        log.debug("Using listing of '%s' from memory", dir)
+        return list(listings[key][1])
+    cached = None
+    if cache_dir:
+        path = listing_path(dir, cache_dir)
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            pass
+    if cached is not None and cached["mtime"] == mtime:
+        log.info("Using cached listing of '%s'", dir)
+        listings[key] = mtime, cached["names"]
+        return list(cached["names"])
+
+    listed = int(time.time() * 1e9)
+    names = scan_dir(dir)
+    if listed - mtime <= MTIME_RESOLUTION * 1e9:
+        return names
+    listings[key] = mtime, names
+    if cache_dir:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.tmp{}".format(path, os.getpid())
+        listing = dict(dir=os.path.abspath(str(dir)), mtime=mtime, names=names)
+        with open(tmp_path, "w") as f:
+            json.dump(listing, f)
+        os.replace(tmp_path, path)
+    return list(names)
+
+
+def find_files(dir, pattern, basenames=None, cache_dir=None):
+    """Group the files in dir like group_files
+
+    If basenames is given, pattern starts with ANY_BASENAME and only the given
+    basenames are matched, which is faster than matching many alternatives in
+    pattern.
+    """
+    groups = group_files(list_files(dir, cache_dir), pattern, basenames)
+    dir = Path(dir)
+    for basename, items in groups.items():
+        paths = [dir / name for name in items.paths]
+        groups[basename] = ItemTable(items.indices, paths)
+    return groups
+
+
+def dir_matches(reldir, globs):
+    return any(fnmatch.fnmatch(reldir, glob) for glob in globs)
+
+
+def scan_tree(dir, include=None, exclude=None, workers=1):
+    """Return (relative directory, file names) of dir and its subdirectories
+
+    Subdirectories are scanned concurrently by workers threads. Directories
+    matching a glob of exclude are skipped with all their subdirectories.
+    If include is given, only the files of matching directories are listed.
+    Symbolic links to directories are not followed.
+    """
+
+    def scan(reldir):
+        files = []
+        subdirs = []
+        for entry in os.scandir(os.path.join(str(dir), reldir)):
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(os.path.normpath(os.path.join(reldir, entry.name)))
+            elif entry.is_file():
+                files.append(entry.name)
+        return files, subdirs
+
+    listing = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(scan, "."): "."}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                reldir = pending.pop(future)
+                try:
+                    files, subdirs = future.result()
+                except OSError as e:
+                    log.warning("Cannot scan '%s': %s", reldir, e)
+                    continue
+                if not include or dir_matches(reldir, include):
+                    listing.append((reldir, files))
+                for subdir in subdirs:
+                    if exclude and dir_matches(subdir, exclude):
+                        log.debug("Skipping excluded directory '%s'", subdir)
+                        continue
+                    pending[executor.submit(scan, subdir)] = subdir
+    return sorted(listing)
+
+
+def find_files_recursive(
+    dir, pattern, basenames=None, include=None, exclude=None, workers=1
+):
+    """Group the files in dir and its subdirectories by (reldir, basename)"""
+    groups = OrderedDict()
+    root = Path(dir)
+    for reldir, names in scan_tree(dir, include, exclude, workers):
+        for basename, items in group_files(names, pattern, basenames).items():
+            paths = [root / reldir / name for name in items.paths]
+            groups[reldir, basename] = ItemTable(items.indices, paths)
+    return groups
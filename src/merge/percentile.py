@@ -0,0 +1,179 @@
+"""
+    Per-pixel percentiles over many images with bounded memory
+"""
+import logging
+import numpy as np
+from merge.accumulate import promote_dtype
+from merge.utils import load, load_rows, prefetch_map
+
+
+log = logging.getLogger(__name__)
+
+
+def rank_positions(n, qs):
+    """Return the ranks and weights to interpolate percentiles qs of n values
+
+    The interpolation is the same as the default of np.percentile.
+    """
+    positions = np.asarray(qs, dtype="float64") / 100 * (n - 1)
+    lower = np.floor(positions).astype("int64")
+    upper = np.minimum(lower + 1, n - 1)
+    return lower, upper, positions - lower
+
+
+def to_unsigned(values):
+    """Map integer values to unsigned integers of the same size keeping order"""
+    if values.dtype.kind == "u":
+        return values
+    unsigned = np.dtype("u{}".format(values.dtype.itemsize))
+    sign_bit = unsigned.type(1 << (8 * values.dtype.itemsize - 1))
+    return values.view(unsigned) ^ sign_bit
+
+
+def from_unsigned(values, dtype):
+    """Inverse of to_unsigned"""
+    dtype = np.dtype(dtype)
+    unsigned = np.dtype("u{}".format(dtype.itemsize))
+    values = values.astype(unsigned)
+    if dtype.kind == "u":
+        return values
+    sign_bit = unsigned.type(1 << (8 * dtype.itemsize - 1))
+    return (values ^ sign_bit).view(dtype)
+
+
+def select_histogram(read_tiles, ranks, dtype, size, bits=8):
+    """Return the values with the given ranks of every pixel of integer images
+
+    read_tiles is called once per pass and must return an iterable over the
+    tiles of all images. Each pass counts the values of every pixel in 2**bits
+    bins to find the next bits of the values with the given ranks. Returns an
+    array with shape (len(ranks), size).
+    """
+    dtype = np.dtype(dtype)
+    n_bins = 1 << bits
+    total_bits = 8 * dtype.itemsize
+    pixels = np.arange(size)
+    remaining = np.repeat(np.asarray(ranks, dtype="int64")[:, None], size, axis=1)
+    prefix = np.zeros((len(ranks), size), dtype="uint64")
+    for shift in range(total_bits - bits, -1, -bits):
+        counts = np.zeros((len(ranks), n_bins, size), dtype="uint32")
+        high_shift = np.uint64(shift + bits)
+        for tile in read_tiles():
+            values = to_unsigned(tile).ravel().astype("uint64")
+            digits = (values >> np.uint64(shift)) & np.uint64(n_bins - 1)
+            digits = digits.astype("intp")
+            if shift + bits == total_bits:
+                counts[:, digits, pixels] += 1
+                continue
+            high = values >> high_shift
+            for r in range(len(ranks)):
+                counts[r, digits, pixels] += high == (prefix[r] >> high_shift)
+        for r in range(len(ranks)):
+            cumulative = np.cumsum(counts[r], axis=0)
+            digit = np.argmax(cumulative > remaining[r], axis=0)
+            below = np.where(digit > 0, cumulative[digit - 1, pixels], 0)
+            remaining[r] -= below.astype("int64")
+            prefix[r] |= digit.astype("uint64") << np.uint64(shift)
+    return from_unsigned(prefix, dtype)
+
+
+def load_first(paths, loader=None):
+    """Return the first loadable image of paths and the paths from it on
+
+    Unreadable images before it are logged and skipped.
+    """
+    for i, path in enumerate(paths):
+        try:
+            return (loader or load)(path), paths[i:]
+        except (OSError, ValueError) as e:
+            log.error("Cannot open '%s': %s", path, e)
+    raise ValueError("None of the images can be read")
+
+
+def percentiles(
+    items, qs, max_memory=2**30, method="sort", jobs=1, prefetch=0, loader=None
+):
+    """Return the per-pixel percentiles qs of the images of items
+
+    The images are processed in tiles of whole rows such that the tile data
+    needs at most about max_memory bytes. With method "sort", the tiles of all
+    images are stacked and sorted. With method "histogram", which only works
+    for integer images, the memory is independent of the number of images but
+    every tile is read several times. Images that cannot be read in the first
+    pass are logged and left out.
+    """
+    first, paths = load_first([path for index, path in items], loader)
+    shape = first.shape
+    dtype = first.dtype
+    del first
+    row_size = int(np.prod(shape[1:], dtype="int64"))
+
+    if method == "histogram" and dtype.kind not in "iu":
+        log.warning("Histogram method needs integer images, sorting instead")
+        method = "sort"
+    if method == "histogram":
+        bits = 8 if dtype.itemsize > 1 else 4
+        bytes_per_pixel = len(qs) * 2 * (1 << bits) * 12
+    else:
+        bytes_per_pixel = len(paths) * dtype.itemsize
+    rows = int(max(1, max_memory // (bytes_per_pixel * row_size)))
+
+    def read_tiles(start, stop, failed=None):
+        """Yield the rows start:stop of paths
+
+        If failed is given, unreadable paths are appended to it, otherwise
+        they raise a ValueError.
+        """
+        tiles = prefetch_map(
+            lambda path: load_rows(path, start, stop, loader), paths, jobs, prefetch
+        )
+        for path, tile in zip(paths, tiles):
+            try:
+                yield tile()
+            except (OSError, ValueError) as e:
+                if failed is None:
+                    raise ValueError(
+                        "'{}' cannot be read anymore: {}".format(path, e)
+                    ) from None
+                log.error("Cannot open '%s': %s", path, e)
+                failed.append(path)
+
+    result = np.empty((len(qs),) + shape, dtype=promote_dtype(dtype))
+    for start in range(0, shape[0], rows):
+        stop = min(start + rows, shape[0])
+        log.info("Calculating percentiles of rows %d to %d", start, stop - 1)
+        # Unreadable images are found in the first pass and left out later
+        failed = [] if start == 0 else None
+
+        if method == "histogram":
+            if failed is not None:
+                for tile in read_tiles(start, stop, failed):
+                    pass
+                paths = [path for path in paths if path not in failed]
+                failed = None
+            n = len(paths)
+            lower, upper, weights = rank_positions(n, qs)
+            weights = weights.reshape((-1,) + (1,) * len(shape))
+            ranks = np.unique(np.concatenate([lower, upper]))
+            tile_shape = (stop - start,) + shape[1:]
+            size = int(np.prod(tile_shape))
+            values = select_histogram(
+                lambda: read_tiles(start, stop), ranks, dtype, size, bits
+            )
+            values = values.reshape((len(ranks),) + tile_shape).astype("float64")
+            lo = values[np.searchsorted(ranks, lower)]
+            hi = values[np.searchsorted(ranks, upper)]
+            result[:, start:stop] = lo + (hi - lo) * weights
+        else:
+            stack = np.empty((len(paths), stop - start) + shape[1:], dtype=dtype)
+            n = 0
+            for tile in read_tiles(start, stop, failed):
+                stack[n] = tile
+                n += 1
+            if failed:
+                paths = [path for path in paths if path not in failed]
+            result[:, start:stop] = np.percentile(
+                stack[:n], qs, axis=0, overwrite_input=True
+            )
+            del stack
+    return result
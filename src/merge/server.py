@@ -0,0 +1,133 @@
+"""
+    Run jobs submitted over a Unix socket in long-running worker processes
+"""
+from concurrent.futures import ProcessPoolExecutor
+import importlib
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import time
+
+
+log = logging.getLogger(__name__)
+
+# Modules imported before the worker processes are started
+preloaded_modules = ["tifffile", "imageio"]
+
+
+def default_socket():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR", tempfile.gettempdir())
+    return os.path.join(runtime_dir, "merge-{}.sock".format(os.getuid()))
+
+
+def read_message(file):
+    line = file.readline()
+    if not line:
+        raise ValueError("Connection closed without a message")
+    return json.loads(line.decode())
+
+
+def write_message(file, message):
+    file.write((json.dumps(message) + "\n").encode())
+    file.flush()
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        started = time.time()
+        try:
+            job = read_message(self.rfile)
+            future = self.server.executor.submit(
+                self.server.run, job["cwd"], job["options"]
+            )
+            response = future.result()
+        except Exception as e:
+            response = dict(status="error", failed=[], log=[], error=str(e))
+        log.info(
+            "Job finished with status %s after %.3f s",
+            response["status"],
+            time.time() - started,
+        )
+        try:
+            write_message(self.wfile, response)
+        except OSError as e:
+            log.warning("Cannot send response to the client: %s", e)
+
+
+def remove_stale_socket(path):
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX) as client:
+        try:
+            client.connect(path)
+        except OSError:
+            log.info("Removing stale socket '%s'", path)
+            os.remove(path)
+            return
+    raise ValueError("Another server is listening on '{}'".format(path))
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Accept jobs on a Unix socket and call run for them in worker processes
+
+    A job is a JSON object with the fields cwd and options, which are passed to
+    run, and the response is the JSON object returned by run. Both are sent as
+    a single line. The worker processes are kept for all jobs, so that the
+    caches of the modules they imported stay warm.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, run, workers=1):
+        remove_stale_socket(path)
+        self.run = run
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        super().__init__(path, JobHandler)
+
+    def server_bind(self):
+        super().server_bind()
+        # Only the user who started the server may submit jobs
+        os.chmod(self.server_address, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def preload():
+    for name in preloaded_modules:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+
+def serve(path, run, workers=1):
+    """Run submitted jobs until the process is interrupted or terminated"""
+    preload()
+    server = JobServer(path, run, workers)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log.info("Listening on '%s' with %d workers", path, workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.info("Stopping server")
+        server.server_close()
+
+
+def submit(path, job):
+    """Send job to the server listening on path and return its response"""
+    with socket.socket(socket.AF_UNIX) as client:
+        client.connect(path)
+        with client.makefile("rwb") as file:
+            write_message(file, job)
+            return read_message(file)
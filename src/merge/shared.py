@@ -0,0 +1,171 @@
+"""
+    Sum images with several processes in a buffer in shared memory
+"""
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import logging
+import weakref
+import numpy as np
+from merge.accumulate import Accumulator, promote_dtype
+from merge.utils import load, load_mmap, load_rows, prefetch_map
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+
+log = logging.getLogger(__name__)
+
+
+def add_values(acc, paths, values, correction):
+    """Add the loaded values of paths to acc and return the unloadable paths"""
+    failed = []
+    for path, value in zip(paths, values):
+        try:
+            value = value()
+        except (OSError, ValueError):
+            failed.append(path)
+            continue
+        if correction is not None:
+            value = correction(value)
+        acc(value)
+    return failed
+
+
+def reduce_stripe(
+    name, shape, dtype, rows, paths, jobs, prefetch, correction, policy, loader
+):
+    """Sum the rows of all images into the stripe of the shared buffer name
+
+    Returns the number of summed images and the paths that could not be loaded.
+    """
+    start, stop = rows
+    buffer = shared_memory.SharedMemory(name=name)
+    stripe = acc = None
+    try:
+        stripe = np.ndarray(shape, dtype, buffer=buffer.buf)[start:stop]
+        acc = Accumulator(policy, out=stripe)
+        tiles = prefetch_map(
+            lambda path: load_rows(path, start, stop, loader), paths, jobs, prefetch
+        )
+        failed = add_values(acc, paths, tiles, correction)
+        count = acc.count()
+        if count and acc.sum() is not stripe:
+            np.copyto(stripe, acc.sum())
+    finally:
+        # The views of the buffer have to be released before closing it
+        stripe = acc = None
+        buffer.close()
+    return count, failed
+
+
+def reduce_part(
+    name, shape, dtype, part, paths, jobs, prefetch, correction, policy, loader
+):
+    """Sum whole images of paths into the part-th sum of the shared buffer name
+
+    Returns the number of summed images and the paths that could not be loaded.
+    """
+    buffer = shared_memory.SharedMemory(name=name)
+    total = acc = None
+    try:
+        total = np.ndarray(shape, dtype, buffer=buffer.buf)[part]
+        acc = Accumulator(policy, out=total)
+        images = prefetch_map(loader or load, paths, jobs, prefetch)
+        failed = add_values(acc, paths, images, correction)
+        count = acc.count()
+        if count and acc.sum() is not total:
+            np.copyto(total, acc.sum())
+    finally:
+        total = acc = None
+        buffer.close()
+    return count, failed
+
+
+def reads_rows(path, loader=None):
+    """Return whether load_rows reads only the requested rows of path"""
+    return loader is None and isinstance(load_mmap(path), np.memmap)
+
+
+def reduce_shared(
+    items, workers, jobs=1, prefetch=0, correction=None, policy="auto", loader=None
+):
+    """Sum items with workers processes into one buffer in shared memory
+
+    If only the rows of the images can be read, see reads_rows, the workers sum
+    disjoint stripes of rows into one sum, so that memory is needed for one sum
+    only. Otherwise every worker sums whole images of a chunk of items into its
+    own sum in the buffer and these are added in place afterwards. Only row
+    ranges or chunks and counts are passed between the processes. The sum of
+    the returned accumulator is a view of the buffer, which is released once
+    the sum and all views of it are gone.
+    """
+    if shared_memory is None:
+        raise ValueError("Shared memory needs Python 3.8 or later")
+    paths = [path for index, path in items]
+    first = np.asarray((loader or load)(paths[0]))
+    if correction is not None:
+        first = correction(first)
+    shape = first.shape
+    dtype = np.dtype(promote_dtype(first.dtype, policy))
+    del first
+    if reads_rows(paths[0], loader):
+        n_parts = min(workers, shape[0])
+        bounds = [shape[0] * i // n_parts for i in range(n_parts + 1)]
+        parts = list(zip(bounds, bounds[1:]))
+        buffer_shape = shape
+        func = reduce_stripe
+        chunks = [paths] * n_parts
+        if correction is None:
+            corrections = [None] * n_parts
+        else:
+            corrections = [correction.rows(start, stop) for start, stop in parts]
+    else:
+        log.info("Summing whole images in %d separate sums", workers)
+        n_parts = min(workers, len(paths))
+        bounds = [len(paths) * i // n_parts for i in range(n_parts + 1)]
+        parts = list(range(n_parts))
+        buffer_shape = (n_parts,) + shape
+        func = reduce_part
+        chunks = [paths[start:stop] for start, stop in zip(bounds, bounds[1:])]
+        corrections = [correction] * n_parts
+
+    nbytes = max(1, int(np.prod(buffer_shape, dtype="int64")) * dtype.itemsize)
+    buffer = shared_memory.SharedMemory(create=True, size=nbytes)
+    try:
+        total = np.ndarray(buffer_shape, dtype, buffer=buffer.buf)
+        weakref.finalize(total, buffer.close)
+        total[...] = 0
+        with ProcessPoolExecutor(max_workers=n_parts) as executor:
+            results = list(
+                executor.map(
+                    func,
+                    repeat(buffer.name),
+                    repeat(buffer_shape),
+                    repeat(dtype),
+                    parts,
+                    chunks,
+                    repeat(jobs),
+                    repeat(prefetch),
+                    corrections,
+                    repeat(policy),
+                    repeat(loader),
+                )
+            )
+    finally:
+        # The workers are done, the memory stays mapped until total is gone
+        buffer.unlink()
+    if func is reduce_stripe:
+        count, failed = results[0]
+        if any(result != results[0] for result in results):
+            raise ValueError("Images changed or could not be read while merging")
+    else:
+        count = sum(result[0] for result in results)
+        failed = [path for result in results for path in result[1]]
+        for part in total[1:]:
+            total[0] += part
+        total = total[0]
+    for path in failed:
+        log.error("Cannot open '%s'", path)
+    return Accumulator.from_state(dict(sum=total, count=count, policy=policy))
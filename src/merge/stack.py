@@ -0,0 +1,155 @@
+"""
+    Frame stacks stored in a single file, like HDF5 datasets or multi-page TIFFs
+"""
+import logging
+from pathlib import Path
+import numpy as np
+from merge.accumulate import Accumulator
+from merge.utils import ItemTable
+
+
+log = logging.getLogger(__name__)
+
+# Approximate number of bytes read at once from a stack
+BATCH_BYTES = 64 * 2**20
+
+
+def parse_source(source):
+    """Split "file.h5:/path/to/dataset" into the file and dataset path
+
+    The dataset path of TIFF files is None.
+    """
+    if source.lower().endswith((".tif", ".tiff")):
+        return source, None
+    path, sep, dataset = source.rpartition(":")
+    if not sep or not path or not dataset.startswith("/"):
+        raise ValueError(
+            "Stack source '{}' is neither a TIFF file nor of the form"
+            " 'file:/dataset'".format(source)
+        )
+    return path, dataset
+
+
+def source_basename(source):
+    path, dataset = parse_source(source)
+    return Path(path).stem
+
+
+class TiffStack:
+    """The pages of a multi-page TIFF file as a stack of frames
+
+    Slicing decodes one page after the other into the resulting array.
+    """
+
+    def __init__(self, tif):
+        self.pages = tif.pages
+        page = self.pages[0]
+        self.shape = (len(self.pages),) + page.shape
+        self.dtype = page.dtype
+        self.chunks = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        frames = range(*key.indices(len(self)))
+        data = np.empty((len(frames),) + self.shape[1:], dtype=self.dtype)
+        for i, frame in enumerate(frames):
+            page = self.pages[frame]
+            if page.shape != self.shape[1:]:
+                raise ValueError(
+                    "Page {} has shape {} instead of {}".format(
+                        frame, page.shape, self.shape[1:]
+                    )
+                )
+            data[i] = page.asarray()
+        return data
+
+
+def open_tiff_stack(path):
+    """Return the opened file and its pages as a stack
+
+    Uncompressed contiguous pages are memory-mapped, others are decoded.
+    """
+    import tifffile
+
+    tif = tifffile.TiffFile(path)
+    try:
+        stack = TiffStack(tif)
+        try:
+            mapped = tifffile.memmap(path, mode="r")
+        except ValueError:
+            pass
+        else:
+            if mapped.shape == stack.shape:
+                stack = mapped
+    except Exception:
+        tif.close()
+        raise
+    return tif, stack
+
+
+def open_stack(source):
+    """Return the opened file and the dataset of source"""
+    path, dataset = parse_source(source)
+    if dataset is None:
+        return open_tiff_stack(path)
+    try:
+        import h5py
+    except ImportError:
+        raise ValueError("Reading '{}' needs h5py".format(source)) from None
+    file = h5py.File(path, "r")
+    try:
+        stack = file[dataset]
+        if not hasattr(stack, "shape") or len(stack.shape) < 2:
+            raise ValueError("'{}' is not a stack of frames".format(source))
+    except (KeyError, ValueError):
+        file.close()
+        raise
+    return file, stack
+
+
+def stack_items(source, stack):
+    """Return an ItemTable with the frame numbers of stack as indices"""
+    return ItemTable(np.arange(len(stack)), [source] * len(stack))
+
+
+def batch_frames(stack, batch_bytes=BATCH_BYTES):
+    """Return the number of frames per batch, a multiple of the chunk size"""
+    frame_bytes = int(np.prod(stack.shape[1:], dtype="int64")) * stack.dtype.itemsize
+    chunks = getattr(stack, "chunks", None)
+    chunk = chunks[0] if chunks else 1
+    return chunk * max(1, batch_bytes // max(1, chunk * frame_bytes))
+
+
+def read_batches(stack, frames, batch_bytes=BATCH_BYTES):
+    """Yield the frame numbers and data of batches of the sorted frames
+
+    Each batch is read with a single slice along the first axis, which is
+    aligned to the chunks of stack.
+    """
+    frames = np.asarray(frames, dtype="int64")
+    if len(frames) == 0:
+        return
+    size = batch_frames(stack, batch_bytes)
+    batches = frames // size
+    bounds = np.flatnonzero(np.diff(batches)) + 1
+    for batch in np.split(frames, bounds):
+        start = int(batch[0])
+        stop = int(batch[-1]) + 1
+        data = stack[start:stop]
+        if len(batch) != stop - start:
+            data = data[batch - start]
+        yield batch, data
+
+
+def reduce_stack(stack, items, cls=Accumulator, correction=None):
+    """Reduce the frames of stack given by the indices of items"""
+    acc = cls()
+    indices = ItemTable.from_items(items).indices
+    for frames, data in read_batches(stack, indices):
+        log.debug("Merging frames %d to %d", frames[0], frames[-1])
+        if correction is not None:
+            data = correction(data)
+        acc.extend(data)
+    return acc
@@ -1,7 +1,17 @@
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import itertools
+import logging
+import os
 from pathlib import Path
 import re
-from skimage.io import imread, imsave
+import threading
+import numpy as np
+from merge.backends import get_backend
+
+
+log = logging.getLogger(__name__)
 
 
 def get_or_emplace(mapping, key, default):
@@ -13,17 +23,112 @@ def get_or_emplace(mapping, key, default):
         return default
 
 
-def group_files(files, pattern=r"(?P<basename>.+)-(?P<index>[0-9]+)\.tif"):
-    regex = re.compile(pattern)
-    ret = OrderedDict()
+class ItemTable:
+    """Indices and paths of the files of a group
+
+    Behaves like a sequence of (index, path) tuples, but keeps the indices in a
+    NumPy array.
+    """
+
+    def __init__(self, indices, paths):
+        self.indices = np.asarray(indices, dtype="int64")
+        self.paths = list(paths)
+        if len(self.indices) != len(self.paths):
+            raise ValueError("Number of indices and paths differ")
+
+    @classmethod
+    def from_items(cls, items):
+        if isinstance(items, cls):
+            return items
+        items = list(items)
+        return cls([index for index, path in items], [path for index, path in items])
+
+    def take(self, positions):
+        """Return a table of the items at the given positions"""
+        return ItemTable(self.indices[positions], [self.paths[i] for i in positions])
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return ItemTable(self.indices[key], self.paths[key])
+        return int(self.indices[key]), self.paths[key]
+
+    def __iter__(self):
+        return zip(self.indices.tolist(), self.paths)
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return "ItemTable({!r})".format(list(self))
+
+
+# Start of a pattern that matches any basename, see match_basenames
+ANY_BASENAME = "(?P<basename>.*)"
+
+
+def match_basenames(pattern, basenames):
+    """Return a function that returns the basename and index of a filename
+
+    pattern has to start with ANY_BASENAME, which only matches the literal
+    basenames. Like an alternation of all of them, the first basename that is
+    a prefix of the filename followed by a match of the rest of pattern is
+    used, but only the basenames that are prefixes are tried.
+    """
+    if not pattern.startswith(ANY_BASENAME):
+        raise ValueError("Pattern has to start with '{}'".format(ANY_BASENAME))
+    rest = re.compile(pattern[len(ANY_BASENAME) :])
+    order = {}
+    for basename in basenames:
+        order.setdefault(basename, len(order))
+    lengths = sorted({len(basename) for basename in order})
+
+    def match(name):
+        prefixes = [name[:length] for length in lengths if name[:length] in order]
+        for basename in sorted(prefixes, key=order.get):
+            m = rest.match(name, len(basename))
+            if m:
+                return basename, m.group("index")
+        return None
+
+    return match
+
+
+def group_files(
+    files, pattern=r"(?P<basename>.+)-(?P<index>[0-9]+)\.tif", basenames=None
+):
+    """Group files by the basename and index matched by pattern
+
+    If basenames is given, pattern has to start with ANY_BASENAME and only the
+    given basenames are matched, see match_basenames. This is faster than
+    matching many alternatives in pattern.
+    """
+    if basenames is None:
+        regex = re.compile(pattern)
+
+        def match(name):
+            m = regex.match(name)
+            return m and (m.group("basename"), m.group("index"))
+
+    else:
+        match = match_basenames(pattern, basenames)
+    groups = OrderedDict()
     for f in files:
-        m = regex.match(Path(f).name)
+        m = match(os.path.basename(f) if isinstance(f, str) else Path(f).name)
         if m:
-            key = m.group("basename")
-            item = (int(m.group("index")), f)
-            items = get_or_emplace(ret, key, [])
-            items.append(item)
+            key, index = m
+            indices, paths = get_or_emplace(groups, key, ([], []))
+            indices.append(int(index))
+            paths.append(f)
 
+    ret = OrderedDict()
+    for key, (indices, paths) in groups.items():
+        ret[key] = ItemTable(indices, paths)
     return ret
 
 
@@ -37,38 +142,23 @@ def get_range(first, last, slice):
 
 
 def items_to_merge(items, slice=slice(None), exclude=[]):
+    items = ItemTable.from_items(items)
     # Only sort by index to not reorder files with duplicate index
-    items = sorted(items, key=lambda item: item[0])
-    first_index = items[0][0]
-    last_index = items[-1][0]
+    order = np.argsort(items.indices, kind="stable")
+    sorted_indices = items.indices[order]
+    first_index = int(sorted_indices[0])
+    last_index = int(sorted_indices[-1])
     indices = get_range(first_index, last_index, slice)
-    sliced_items = []
-    missing_indices = []
-    duplicated_indices = []
-    pos = 0
-    for i in indices:
-        while pos < len(items) and items[pos][0] < i:
-            pos += 1
-        if pos < len(items) and i == items[pos][0]:
-            item = items[pos]
-            pos += 1
-            if pos < len(items) and i == items[pos][0]:
-                # There is at least one duplicate for the current index.
-                # Additional duplicates of the current index will be skipped at
-                # the beginning of next iteration.
-                duplicated_indices.append(i)
-                pos += 1
-        else:
-            # index is missing in items
-            item = None
-
-        if i not in exclude:
-            if item:
-                sliced_items.append(item)
-            else:
-                missing_indices.append(i)
-
-    return sliced_items, missing_indices, duplicated_indices
+    indices = np.arange(indices.start, indices.stop, indices.step, dtype="int64")
+    lower = np.searchsorted(sorted_indices, indices, side="left")
+    upper = np.searchsorted(sorted_indices, indices, side="right")
+    found = upper > lower
+    # The first file is used for duplicated indices
+    duplicated_indices = indices[upper - lower > 1]
+    included = ~np.isin(indices, np.asarray(exclude, dtype="int64"))
+    sliced_items = items.take(order[lower[found & included]].tolist())
+    missing_indices = indices[~found & included]
+    return sliced_items, missing_indices.tolist(), duplicated_indices.tolist()
 
 
 def parse_slice(str):
@@ -99,9 +189,125 @@ def parse_exclude(str):
         return []
 
 
-def load(path):
-    return imread(str(path))
+def load(path, backend=None):
+    """Load an image with the named backend or the one for its extension"""
+    return get_backend(path, backend).load(path)
+
+
+def save(path, image, backend=None):
+    """Save an image with the named backend or the one for its extension
+
+    The image is written to a temporary file next to path, which is renamed to
+    path afterwards, so that path never holds a partially written image. The
+    name of the temporary file ends with a letter before the extension, so that
+    it never matches a pattern like "<basename><sep><index>.tif" of the files
+    to merge, whatever the separator.
+    """
+    path = str(path)
+    backend = get_backend(path, backend)
+    directory, name = os.path.split(path)
+    extension = os.path.splitext(name)[1]
+    tmp_name = ".tmp{}_{}_partial{}".format(
+        os.getpid(), threading.get_ident(), extension
+    )
+    tmp_path = os.path.join(directory, tmp_name)
+    try:
+        backend.save(tmp_path, image)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_rows(path, start, stop, loader=None):
+    """Load the rows start:stop of an image
+
+    Only the requested rows are read from uncompressed TIFF files, other files
+    are loaded completely. If loader is given, it is used for all files.
+    """
+    if loader is None:
+        loader = load_mmap
+    return np.array(loader(path)[start:stop])
+
+
+def load_mmap(path):
+    """Return a read-only memory map of the pixels of an uncompressed TIFF file
+
+    Compressed, tiled and other files are loaded with load.
+    """
+    import tifffile
+
+    try:
+        return tifffile.memmap(str(path), mode="r")
+    except ValueError:
+        return load(path)
+
+
+def parse_size(str):
+    """Parse a number of bytes with an optional K, M, G or T suffix"""
+    units = "KMGT"
+    str = str.strip().upper().rstrip("B")
+    if str and str[-1] in units:
+        return int(float(str[:-1]) * 1024 ** (units.index(str[-1]) + 1))
+    return int(str)
+
+
+def prefetch_map(func, iterable, jobs=1, prefetch=0):
+    """Lazily apply func to the elements of iterable using a thread pool
+
+    Yields a callable per element, in the order of iterable, that returns the
+    result of func or raises its exception. At most prefetch calls, or jobs
+    calls if prefetch is 0, are pending ahead of the element that was yielded
+    last. A prefetch below jobs would leave threads idle and is rejected.
+    """
+    if 0 < prefetch < jobs:
+        raise ValueError(
+            "prefetch must be 0 or at least jobs, got {} < {}".format(prefetch, jobs)
+        )
+    if jobs <= 1 and prefetch <= 0:
+        for arg in iterable:
+            yield functools.partial(func, arg)
+        return
+
+    in_flight = max(jobs, prefetch)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for arg in iterable:
+            pending.append(executor.submit(func, arg))
+            if len(pending) > in_flight:
+                yield pending.popleft().result
+        while pending:
+            yield pending.popleft().result
+
+
+def load_items(items, jobs=1, prefetch=0, correction=None, loader=None):
+    """Yield index, path and image of items, skipping unloadable images
+
+    Images are loaded with loader, which defaults to load. If given, correction
+    is applied to each image in the loading threads.
+    """
+    if loader is None:
+        loader = load
+    if correction is None:
+        func = loader
+    else:
+
+        def func(path):
+            return correction(loader(path))
 
+    # items may be an iterator, of which tee only keeps the prefetched part
+    items, pending = itertools.tee(items)
+    paths = (path for index, path in pending)
+    results = prefetch_map(func, paths, jobs=jobs, prefetch=prefetch)
+    for (index, path), result in zip(items, results):
+        try:
+            value = result()
+        except OSError:
+            log.error("Cannot open '%s'", path)
+            continue
+        except ValueError:
+            log.error("Format of '%s' not supported", path)
+            continue
 
-def save(path, image):
-    imsave(str(path), image)
+        yield index, path, value
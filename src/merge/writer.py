@@ -0,0 +1,59 @@
+"""
+    Save output images in background threads
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import numpy as np
+from merge.utils import save
+
+
+log = logging.getLogger(__name__)
+
+
+class AsyncWriter:
+    """Save images with a pool of threads while the caller continues
+
+    save blocks while queue_size images are waiting to be written. The images
+    are copied, so the caller may modify them afterwards. Errors are logged by
+    close, which returns the paths that could not be written.
+    """
+
+    def __init__(self, workers=1, queue_size=None):
+        if queue_size is None:
+            queue_size = 2 * workers
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self.errors = []
+
+    def _save(self, path, image):
+        try:
+            save(path, image)
+        except Exception as e:
+            with self._lock:
+                self.errors.append((path, e))
+        finally:
+            self._slots.release()
+
+    def save(self, path, image):
+        image = np.array(image, copy=True)
+        self._slots.acquire()
+        try:
+            self._executor.submit(self._save, path, image)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def close(self):
+        """Wait for all images to be written and return the failed paths"""
+        self._executor.shutdown(wait=True)
+        for path, error in self.errors:
+            log.error("Cannot save '%s': %s", path, error)
+        return [path for path, error in self.errors]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,6 +1,12 @@
 import numpy as np
 import pytest
-from merge.accumulate import Accumulator
+import merge.accumulate
+from merge.accumulate import (
+    Accumulator,
+    StatsAccumulator,
+    ClippedAccumulator,
+    leave_one_out_scale,
+)
 
 
 def test_init():
@@ -50,3 +56,287 @@ def test_reset():
     assert acc.count() == 0
     assert acc.sum() == 0
     assert acc.avg() == 0
+
+
+@pytest.mark.parametrize("n_partials", [1, 2, 3, 7])
+def test_combine(n_partials):
+    values = np.random.randn(20, 4, 5)
+    partials = []
+    for chunk in np.array_split(values, n_partials):
+        acc = Accumulator()
+        for value in chunk:
+            acc(value)
+        partials.append(acc)
+    acc = Accumulator.combine(partials)
+    assert acc.count() == values.shape[0]
+    assert np.allclose(acc.sum(), np.sum(values, axis=0))
+    assert np.allclose(acc.avg(), np.mean(values, axis=0))
+
+
+def test_combine_empty():
+    acc = Accumulator.combine([])
+    assert acc.count() == 0
+    assert acc.sum() == 0
+
+
+def test_merge_empty():
+    acc = Accumulator()
+    acc(np.ones(3))
+    other = Accumulator()
+    assert acc.merge(other) is acc
+    assert acc.count() == 1
+    assert other.merge(acc) is other
+    assert other.count() == 1
+    assert np.all(other.sum() == 1)
+    other(np.ones(3))
+    assert np.all(acc.sum() == 1)
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        np.random.randn(10),
+        np.random.randn(10, 20) + 1e4,
+        np.random.randint(2**16, size=(10, 20, 30), dtype="uint16"),
+    ],
+)
+def test_stats(values):
+    acc = StatsAccumulator()
+    for value in values:
+        acc(value)
+    assert acc.count() == values.shape[0]
+    assert np.allclose(acc.sum(), np.sum(values, axis=0))
+    assert np.allclose(acc.avg(), np.mean(values, axis=0))
+    assert np.allclose(acc.var(), np.var(values, axis=0), rtol=1e-4)
+    assert np.allclose(acc.std(ddof=1), np.std(values, axis=0, ddof=1), rtol=1e-4)
+    assert np.all(acc.min() == np.min(values, axis=0))
+    assert np.all(acc.max() == np.max(values, axis=0))
+    assert acc.min().dtype == values.dtype
+
+
+def test_stats_init():
+    acc = StatsAccumulator()
+    assert acc.var() == 0
+    assert acc.std() == 0
+    acc(np.ones(3))
+    assert np.all(acc.var() == 0)
+
+
+@pytest.mark.parametrize("n_partials", [2, 3, 7])
+def test_stats_combine(n_partials):
+    values = np.random.randn(20, 4, 5) * 10 + 100
+    partials = []
+    for chunk in np.array_split(values, n_partials):
+        acc = StatsAccumulator()
+        for value in chunk:
+            acc(value)
+        partials.append(acc)
+    partials.append(StatsAccumulator())
+    acc = StatsAccumulator.combine(partials)
+    assert acc.count() == values.shape[0]
+    assert np.allclose(acc.avg(), np.mean(values, axis=0))
+    assert np.allclose(acc.var(), np.var(values, axis=0))
+    assert np.all(acc.min() == np.min(values, axis=0))
+    assert np.all(acc.max() == np.max(values, axis=0))
+
+
+def test_stats_state():
+    values = np.random.randn(5, 4, 5)
+    acc = StatsAccumulator()
+    for value in values:
+        acc(value)
+    restored = StatsAccumulator.from_state(acc.state())
+    restored(values[0])
+    acc(values[0])
+    assert restored.count() == acc.count()
+    assert np.allclose(restored.var(), acc.var())
+    assert np.all(restored.max() == acc.max())
+
+
+def test_clipped():
+    values = np.random.default_rng(0).standard_normal((50, 4, 5))
+    values[10, 1, 2] = 1e3
+    values[20, 3, 4] = -1e3
+    stats = StatsAccumulator()
+    for value in values:
+        stats(value)
+    acc = ClippedAccumulator(stats.avg(), stats.std(), sigma=5)
+    for value in values:
+        acc(value)
+    expected_accepted = np.full((4, 5), 50)
+    expected_accepted[1, 2] = 49
+    expected_accepted[3, 4] = 49
+    assert acc.count() == 50
+    assert np.all(acc.accepted() == expected_accepted)
+    mask = np.ones(values.shape, dtype="bool")
+    mask[10, 1, 2] = False
+    mask[20, 3, 4] = False
+    expected_sum = np.sum(values, axis=0, where=mask)
+    assert np.allclose(acc.sum(), expected_sum)
+    assert np.allclose(acc.avg(), expected_sum / expected_accepted)
+
+
+@pytest.mark.parametrize("n", [10, 20])
+def test_clipped_leave_one_out(n):
+    values = np.random.default_rng(2).normal(100, 1, size=(n, 4, 5))
+    values[3, 1, 2] = 1e5
+    stats = StatsAccumulator()
+    for value in values:
+        stats(value)
+    acc = ClippedAccumulator(stats.avg(), leave_one_out_scale(stats, 5), sigma=5)
+    for value in values:
+        acc(value)
+    expected_accepted = np.full((4, 5), n)
+    expected_accepted[1, 2] = n - 1
+    assert np.all(acc.accepted() == expected_accepted)
+    assert np.allclose(acc.avg()[1, 2], np.delete(values[:, 1, 2], 3).mean())
+
+
+def test_leave_one_out_scale():
+    values = np.random.randn(8, 3)
+    stats = StatsAccumulator()
+    for value in values:
+        stats(value)
+    sigma = 2.0
+    threshold = sigma * leave_one_out_scale(stats, sigma)
+    for i, value in enumerate(values):
+        others = np.delete(values, i, axis=0)
+        deviation = np.abs(value - others.mean(axis=0))
+        accepted = deviation <= sigma * others.std(axis=0, ddof=1)
+        assert np.all(accepted == (np.abs(value - stats.avg()) <= threshold))
+
+
+def test_clipped_none_accepted():
+    acc = ClippedAccumulator(np.zeros(3), np.zeros(3), sigma=1)
+    acc(np.array([1.0, 0.0, -1.0]))
+    assert np.all(acc.accepted() == [0, 1, 0])
+    assert np.all(acc.avg() == 0)
+
+
+def test_clipped_combine():
+    values = np.random.randn(20, 4, 5)
+    center = np.zeros((4, 5))
+    scale = np.ones((4, 5))
+    partials = []
+    for chunk in np.array_split(values, 3):
+        acc = ClippedAccumulator(center, scale, sigma=1)
+        for value in chunk:
+            acc(value)
+        partials.append(acc)
+    acc = Accumulator.combine(partials)
+    mask = np.abs(values) <= 1
+    assert np.all(acc.accepted() == np.sum(mask, axis=0))
+    assert np.allclose(acc.sum(), np.sum(values, axis=0, where=mask))
+
+
+def test_policy_int64_exact():
+    values = np.random.randint(2**32, size=(1000, 3), dtype="uint32")
+    acc = Accumulator(policy="int64")
+    for value in values:
+        acc(value)
+    assert acc.sum().dtype == np.dtype("int64")
+    assert np.all(acc.sum() == np.sum(values, axis=0, dtype="int64"))
+
+
+@pytest.mark.parametrize("policy", ["float32", "float64", "int64", "kahan"])
+def test_policy_state(policy):
+    values = np.random.randint(1000, size=(10, 3), dtype="uint16")
+    acc = Accumulator(policy=policy)
+    for value in values:
+        acc(value)
+    restored = Accumulator.from_state(acc.state())
+    assert restored.policy() == policy
+    restored(values[0])
+    assert np.allclose(restored.sum(), np.sum(values, axis=0) + values[0])
+
+
+def test_kahan_accuracy():
+    values = np.random.uniform(0.5, 1.5, size=(100000, 2)).astype("float32")
+    expected = np.sum(values, axis=0, dtype="float64")
+    naive = Accumulator(policy="float32")
+    kahan = Accumulator(policy="kahan")
+    for value in values:
+        naive(value)
+        kahan(value)
+    assert kahan.sum().dtype == np.dtype("float32")
+    kahan_error = np.max(np.abs(kahan.sum() - expected))
+    assert kahan_error < np.max(np.abs(naive.sum() - expected))
+    assert np.allclose(kahan.sum(), expected, rtol=1e-6)
+
+
+def test_kahan_remove_and_combine():
+    values = np.random.uniform(size=(1000, 3)).astype("float32")
+    partials = []
+    for chunk in np.array_split(values, 4):
+        acc = Accumulator(policy="kahan")
+        for value in chunk:
+            acc(value)
+        partials.append(acc)
+    acc = Accumulator.combine(partials)
+    acc.remove(values[0])
+    expected = np.sum(values[1:], axis=0, dtype="float64")
+    assert acc.count() == 999
+    assert np.allclose(acc.sum(), expected, rtol=1e-6)
+
+
+def test_kahan_blocks(monkeypatch):
+    monkeypatch.setattr(merge.accumulate, "kahan_block", 7)
+    values = np.random.uniform(size=(50, 4, 5)).astype("float32")
+    out = np.empty((4, 5), dtype="float32")
+    acc = Accumulator(policy="kahan", out=out)
+    for value in values:
+        acc(value)
+    acc.remove(values[0])
+    expected = np.sum(values[1:], axis=0, dtype="float64")
+    assert np.allclose(acc.sum(), expected, rtol=1e-6)
+    assert np.allclose(out, expected, rtol=1e-5)
+
+
+def test_stats_policy_int64():
+    values = np.random.randint(100, size=(10, 3), dtype="uint8")
+    acc = StatsAccumulator(policy="int64")
+    for value in values:
+        acc(value)
+    assert np.all(acc.sum() == np.sum(values, axis=0))
+    assert np.allclose(acc.var(), np.var(values, axis=0))
+
+
+@pytest.mark.parametrize("policy", ["auto", "int64", "kahan"])
+def test_extend(policy):
+    values = np.random.randint(1000, size=(20, 3, 4), dtype="uint16")
+    acc = Accumulator(policy=policy)
+    acc.extend(values[:7])
+    acc(values[7])
+    acc.extend(values[8:])
+    assert acc.count() == 20
+    assert np.allclose(acc.sum(), np.sum(values, axis=0))
+
+
+def test_stats_extend():
+    values = np.random.randn(20, 3, 4)
+    acc = StatsAccumulator()
+    acc(values[0])
+    acc.extend(values[1:12])
+    acc.extend(values[12:])
+    assert acc.count() == 20
+    assert np.allclose(acc.avg(), np.mean(values, axis=0))
+    assert np.allclose(acc.var(), np.var(values, axis=0))
+    assert np.all(acc.min() == np.min(values, axis=0))
+    assert np.all(acc.max() == np.max(values, axis=0))
+
+
+def test_accumulator_out():
+    out = np.full((2, 3), 7, dtype="float32")
+    acc = Accumulator(out=out)
+    acc(np.ones((2, 3), dtype="uint16"))
+    acc(np.ones((2, 3), dtype="uint16"))
+    assert acc.sum() is out
+    assert np.all(out == 2)
+
+    acc = Accumulator(out=out)
+    acc.extend(np.ones((3, 2, 3), dtype="uint16"))
+    assert acc.sum() is out
+    assert np.all(out == 3)
+
+    with pytest.raises(ValueError):
+        Accumulator(out=out)(np.ones((2, 3), dtype="float64"))
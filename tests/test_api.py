@@ -0,0 +1,132 @@
+import itertools
+import logging
+import os
+import numpy as np
+import pytest
+import merge
+from merge.utils import save
+
+
+@pytest.fixture
+def series():
+    return [np.random.randint(2**16, size=(6, 7), dtype="uint16") for _ in range(6)]
+
+
+def test_reduce_arrays(series):
+    result = merge.reduce(
+        iter(series), slice="1:4", exclude=[2], stats=("avg", "sum", "std", "median")
+    )
+    selected = np.array(series)[[1, 3, 4]]
+    assert list(result.stats) == ["avg", "sum", "std", "median"]
+    assert np.allclose(result.stats["avg"], np.mean(selected, axis=0))
+    assert np.all(result.stats["sum"] == np.sum(selected, axis=0))
+    assert np.allclose(result.stats["std"], np.std(selected, axis=0))
+    assert np.allclose(result.stats["median"], np.median(selected, axis=0))
+    assert (result.start, result.stop, result.count) == (1, 4, 3)
+    assert result.missing == []
+
+
+def test_reduce_stream(series):
+    read = []
+
+    def frames():
+        for i in itertools.count():
+            read.append(i)
+            yield series[i % len(series)]
+
+    result = merge.reduce(frames(), slice="1:4", exclude=[2], stats=("avg", "std"))
+    selected = np.array(series)[[1, 3, 4]]
+    assert np.allclose(result.stats["avg"], np.mean(selected, axis=0))
+    assert np.allclose(result.stats["std"], np.std(selected, axis=0))
+    assert (result.start, result.stop, result.count) == (1, 4, 3)
+    assert result.missing == []
+    assert read == list(range(6))
+
+
+def test_reduce_dir(tmp_path, series):
+    for i, image in enumerate(series):
+        if i != 3:
+            save(tmp_path / "s-{}.tif".format(i), image)
+    save(tmp_path / "t-0.tif", series[0])
+    files = sorted(os.listdir(str(tmp_path)))
+    result = merge.reduce(
+        str(tmp_path), basename="s", stats=("min", "max"), percentiles=[10, 90]
+    )
+    selected = np.array(series)[[0, 1, 2, 4, 5]]
+    assert list(result.stats) == ["min", "max", "p10", "p90"]
+    assert np.all(result.stats["min"] == np.min(selected, axis=0))
+    assert np.all(result.stats["max"] == np.max(selected, axis=0))
+    expected = np.percentile(selected, [10, 90], axis=0)
+    assert np.allclose(result.stats["p10"], expected[0])
+    assert np.allclose(result.stats["p90"], expected[1])
+    assert (result.start, result.stop, result.count) == (0, 5, 5)
+    assert result.missing == [3]
+    assert sorted(os.listdir(str(tmp_path))) == files
+    with pytest.raises(ValueError):
+        merge.reduce(str(tmp_path))
+
+
+def test_reduce_paths(tmp_path, series):
+    paths = []
+    for i, image in enumerate(series):
+        paths.append(tmp_path / "{}.npy".format(i))
+        save(paths[-1], image)
+    result = merge.reduce(paths, exclude="0,5")
+    assert np.all(result.stats["sum"] == np.sum(series[1:5], axis=0))
+    assert (result.start, result.stop, result.count) == (1, 4, 4)
+
+
+def test_reduce_stack(tmp_path, series):
+    h5py = pytest.importorskip("h5py")
+    with h5py.File(str(tmp_path / "scan.h5"), "w") as f:
+        f.create_dataset("data", data=np.array(series), chunks=(2, 6, 7))
+    result = merge.reduce(
+        str(tmp_path / "scan.h5") + ":/data", slice=":3", stats=("avg", "median")
+    )
+    assert np.allclose(result.stats["avg"], np.mean(series[:4], axis=0))
+    assert np.allclose(result.stats["median"], np.median(series[:4], axis=0))
+    assert result.count == 4
+
+
+def test_reduce_clipped():
+    frames = list(np.random.default_rng(0).normal(100, 1, size=(10, 6, 7)))
+    result = merge.reduce(frames, stats=("avg", "accepted"), reduce="clipped")
+    assert np.all(result.stats["accepted"] == len(frames))
+    assert np.allclose(result.stats["avg"], np.mean(frames, axis=0))
+
+
+def test_reduce_clipped_short_series():
+    frames = list(np.random.default_rng(1).normal(100, 1, size=(10, 6, 7)))
+    frames[4][2, 3] = 1e5
+    result = merge.reduce(frames, stats=("avg", "accepted"), reduce="clipped")
+    assert result.stats["accepted"][2, 3] == 9
+    assert abs(result.stats["avg"][2, 3] - 100) < 2
+
+
+def test_reduce_shared_compressed(tmp_path, series, caplog):
+    tifffile = pytest.importorskip("tifffile")
+    paths = []
+    for i, image in enumerate(series):
+        paths.append(str(tmp_path / "z-{}.tif".format(i)))
+        tifffile.imwrite(paths[-1], image, compression="zlib")
+    caplog.set_level(logging.INFO)
+    result = merge.reduce(paths, stats=("sum",), shared_workers=2)
+    assert np.all(result.stats["sum"] == np.sum(series, axis=0))
+    assert "Summing whole images in 2 separate sums" in caplog.text
+
+
+def test_reduce_dark(series):
+    dark = np.ones((6, 7))
+    result = merge.reduce(series, stats=("avg",), dark=dark)
+    assert np.allclose(result.stats["avg"], np.mean(series, axis=0) - 1)
+
+
+def test_reduce_errors(series):
+    with pytest.raises(ValueError):
+        merge.reduce([])
+    with pytest.raises(ValueError):
+        merge.reduce(series, stats=("mode",))
+    with pytest.raises(ValueError):
+        merge.reduce(series, stats=("accepted",))
+    with pytest.raises(ValueError):
+        merge.reduce(series, slice="10:")
@@ -1,3 +1,8 @@
+import os
+import subprocess
+import sys
+import merge.cumsum
+import merge.utils
 from merge.app import create_parser, parse_config, merge_group, main
 from merge.utils import load, save
 import numpy as np
@@ -39,6 +44,42 @@ def test_parse_config_multiple_basenames():
     assert config["pattern"] == expected
 
 
+def test_parse_config_many_basenames():
+    names = ["foo{}".format(i) for i in range(100)]
+    args = create_parser().parse_args(names)
+    config = parse_config(args)
+    expected = r"(?P<basename>.*)-(?P<index>[0-9]+)\.tif$"
+    assert config["pattern"] == expected
+    assert config["basenames"] == names
+
+    pattern = "x_(?P<basename>{basename})"
+    args = create_parser().parse_args(["--pattern", pattern] + names)
+    config = parse_config(args)
+    assert config["pattern"] == "x_(?P<basename>{})".format("|".join(names))
+    assert config["basenames"] is None
+
+
+@pytest.mark.parametrize("others", [1, 40])
+def test_main_many_basenames_without_sep(tmp_path, others):
+    image = np.arange(42, dtype="uint16").reshape(6, 7)
+    save(tmp_path / "scan12.tif", image)
+    names = ["scan"] + ["other{}".format(i) for i in range(others)]
+    args = ["--sep", "", "--dir", str(tmp_path), "--output-dir", str(tmp_path)]
+    main(args + names)
+    assert np.all(load(tmp_path / "scan_sum_12_12.tif") == image)
+
+
+def test_parse_config_output_switches():
+    switches = ["--std", "--median", "--accepted", "--h5-output", "--index"]
+    for switch in switches:
+        args = create_parser().parse_args(["--slice", "0:9", switch, "foo"])
+        assert args.basename == ["foo"]
+    args = create_parser().parse_args(["--std", "--std-output", "s.tif", "foo"])
+    config = parse_config(args)
+    assert config["std_pattern"] == os.path.join(".", "s.tif")
+    assert config["var_pattern"] is None
+
+
 def test_parse_config_basename_and_all(caplog):
     args = create_parser().parse_args(["--all", "bar"])
     config = parse_config(args)
@@ -176,3 +217,567 @@ def test_main_output_dir(tmp_path, images):
     actual = load(sum_b)
     expected = np.mean(images["b"][:1], axis=0)
     assert np.allclose(actual, expected)
+
+
+def test_main_prefetch(tmp_path, images):
+    main(
+        [
+            "--all",
+            "--jobs",
+            "2",
+            "--prefetch",
+            "3",
+            "--dir",
+            str(tmp_path),
+            "--output-dir",
+            str(tmp_path),
+        ]
+    )
+
+    actual = load(tmp_path / "a_sum_0_3.tif")
+    expected = np.sum(images["a"], axis=0)
+    assert np.allclose(actual, expected)
+
+    actual = load(tmp_path / "b_avg_1_2.tif")
+    expected = np.mean(images["b"], axis=0)
+    assert np.allclose(actual, expected)
+
+
+def test_parse_config_jobs():
+    args = create_parser().parse_args(["--jobs", "0", "foo"])
+    with pytest.raises(ValueError):
+        parse_config(args)
+    args = create_parser().parse_args(["--jobs", "8", "--prefetch", "2", "foo"])
+    with pytest.raises(ValueError):
+        parse_config(args)
+
+
+def test_main_chunk_workers(tmp_path, images):
+    main(
+        [
+            "--all",
+            "--chunk-workers",
+            "2",
+            "--dir",
+            str(tmp_path),
+            "--output-dir",
+            str(tmp_path),
+        ]
+    )
+
+    actual = load(tmp_path / "a_sum_0_3.tif")
+    expected = np.sum(images["a"], axis=0)
+    assert np.allclose(actual, expected)
+
+    actual = load(tmp_path / "a_avg_0_3.tif")
+    expected = np.mean(images["a"], axis=0)
+    assert np.allclose(actual, expected)
+
+
+def test_main_group_workers(tmp_path, images, caplog):
+    ret = main(
+        [
+            "--all",
+            "--group-workers",
+            "2",
+            "--dir",
+            str(tmp_path),
+            "--output-dir",
+            str(tmp_path),
+        ]
+    )
+    assert ret == 0
+
+    actual = load(tmp_path / "a_sum_0_3.tif")
+    expected = np.sum(images["a"], axis=0)
+    assert np.allclose(actual, expected)
+
+    actual = load(tmp_path / "b_avg_1_2.tif")
+    expected = np.mean(images["b"], axis=0)
+    assert np.allclose(actual, expected)
+
+    messages = [record.getMessage() for record in caplog.records]
+    start_b = messages.index("Merging files for basename 'b'")
+    assert all("'a'" not in message for message in messages[start_b:-3])
+    assert "Summary:" in messages
+
+
+def test_main_group_workers_failure(tmp_path, images, caplog):
+    save(tmp_path / "a-01.tif", images["a"][0])
+    ret = main(
+        [
+            "--all",
+            "--group-workers",
+            "2",
+            "--dir",
+            str(tmp_path),
+            "--output-dir",
+            str(tmp_path),
+        ]
+    )
+    assert ret == 1
+    assert not (tmp_path / "a_sum_0_3.tif").exists()
+    assert (tmp_path / "b_sum_1_2.tif").is_file()
+    assert "'a': failed" in caplog.text
+    assert "'b': merged 2 images" in caplog.text
+
+
+def test_main_write_failure(tmp_path, images, caplog):
+    (tmp_path / "a_avg.tif").mkdir()
+    ret = main(
+        [
+            "--all",
+            "--write-jobs",
+            "2",
+            "--dir",
+            str(tmp_path),
+            "--output-dir",
+            str(tmp_path),
+            "--avg",
+            "{basename}_avg.tif",
+        ]
+    )
+    assert ret == 1
+    assert "Cannot save '{}'".format(tmp_path / "a_avg.tif") in caplog.text
+    assert (tmp_path / "b_avg.tif").is_file()
+
+
+def test_main_checkpoint(tmp_path, images, monkeypatch):
+    loaded = []
+
+    def counting_load(path):
+        loaded.append(os.path.basename(str(path)))
+        return load(path)
+
+    monkeypatch.setattr(merge.utils, "load", counting_load)
+    args = ["--dir", str(tmp_path), "--output-dir", str(tmp_path), "--checkpoint"]
+    main(args + ["--slice", "0:1", "a"])
+    assert sorted(loaded) == ["a-0.tif", "a-1.tif"]
+    assert (tmp_path / "a_checkpoint.npz").is_file()
+
+    loaded.clear()
+    main(args + ["--slice", "1:3", "a"])
+    assert sorted(loaded) == ["a-0.tif", "a-3.tif"]
+    actual = load(tmp_path / "a_sum_1_3.tif")
+    expected = images["a"][1].astype("float32") + images["a"][2]
+    assert np.allclose(actual, expected)
+
+    loaded.clear()
+    main(args + ["--slice", "1:3", "a"])
+    assert loaded == []
+
+
+def test_main_index(tmp_path, monkeypatch):
+    images = [np.random.randint(2**16, size=(6, 7), dtype="uint16") for _ in range(30)]
+    for i, image in enumerate(images):
+        save(tmp_path / "a-{}.tif".format(i), image)
+    args = ["--dir", str(tmp_path), "--output-dir", str(tmp_path), "a"]
+    assert main(["index", "--stride", "10"] + args) == 0
+    assert (tmp_path / "a_index.npy").is_file()
+    assert (tmp_path / "a_index.json").is_file()
+
+    loaded = []
+
+    def counting_load(path):
+        loaded.append(path)
+        return load(path)
+
+    monkeypatch.setattr(merge.utils, "load", counting_load)
+    monkeypatch.setattr(merge.cumsum, "load", counting_load)
+    main(["--index", "--slice", "4:21", "--exclude", "15"] + args)
+    assert len(loaded) <= 7
+    actual = load(tmp_path / "a_sum_4_21.tif")
+    expected = np.sum(images[4:15] + images[16:22], axis=0)
+    assert np.allclose(actual, expected)
+
+
+def test_parse_config_index_follow():
+    args = create_parser().parse_args(["--index", "--follow", "foo"])
+    with pytest.raises(ValueError):
+        parse_config(args)
+
+
+@pytest.fixture
+def series(tmp_path):
+    images = [np.random.randint(2**16, size=(6, 7), dtype="uint16") for _ in range(5)]
+    for i, image in enumerate(images):
+        save(tmp_path / "s-{}.tif".format(i), image)
+    return images
+
+
+def test_main_bin(tmp_path, series):
+    main(["--bin", "2", "--dir", str(tmp_path), "--output-dir", str(tmp_path), "s"])
+    for start, stop in [(0, 1), (2, 3), (4, 4)]:
+        actual = load(tmp_path / "s_avg_{}_{}.tif".format(start, stop))
+        expected = np.mean(series[start : stop + 1], axis=0)
+        assert np.allclose(actual, expected)
+    assert not (tmp_path / "s_avg_0_4.tif").exists()
+
+
+def test_main_window(tmp_path, series, monkeypatch):
+    loaded = []
+
+    def counting_load(path):
+        loaded.append(path)
+        return load(path)
+
+    monkeypatch.setattr(merge.utils, "load", counting_load)
+    main(["--window", "3", "--dir", str(tmp_path), "--output-dir", str(tmp_path), "s"])
+    assert len(loaded) == 5
+    for start in range(3):
+        actual = load(tmp_path / "s_sum_{}_{}.tif".format(start, start + 2))
+        expected = np.sum(series[start : start + 3], axis=0)
+        assert np.allclose(actual, expected)
+    assert not (tmp_path / "s_sum_3_5.tif").exists()
+
+
+@pytest.mark.parametrize("chunk_workers", ["1", "2"])
+def test_main_stats(tmp_path, series, chunk_workers):
+    main(
+        [
+            "--std",
+            "--var",
+            "--min",
+            "--max",
+            "--chunk-workers",
+            chunk_workers,
+            "--dir",
+            str(tmp_path),
+            "--output-dir",
+            str(tmp_path),
+            "s",
+        ]
+    )
+    assert np.allclose(load(tmp_path / "s_std_0_4.tif"), np.std(series, axis=0))
+    assert np.allclose(load(tmp_path / "s_var_0_4.tif"), np.var(series, axis=0))
+    assert np.all(load(tmp_path / "s_min_0_4.tif") == np.min(series, axis=0))
+    assert np.all(load(tmp_path / "s_max_0_4.tif") == np.max(series, axis=0))
+    assert np.allclose(load(tmp_path / "s_avg_0_4.tif"), np.mean(series, axis=0))
+
+
+@pytest.mark.parametrize("method", ["sort", "histogram"])
+def test_main_median(tmp_path, series, method):
+    main(
+        [
+            "--median",
+            "--percentile",
+            "10",
+            "--percentile",
+            "97.5",
+            "--percentile-method",
+            method,
+            "--max-memory",
+            "100",
+            "--dir",
+            str(tmp_path),
+            "--output-dir",
+            str(tmp_path),
+            "s",
+        ]
+    )
+    actual = load(tmp_path / "s_median_0_4.tif")
+    assert np.allclose(actual, np.median(series, axis=0))
+    actual = load(tmp_path / "s_p10_0_4.tif")
+    assert np.allclose(actual, np.percentile(series, 10, axis=0))
+    actual = load(tmp_path / "s_p97.5_0_4.tif")
+    assert np.allclose(actual, np.percentile(series, 97.5, axis=0))
+
+
+@pytest.mark.parametrize("chunk_workers", ["1", "2"])
+def test_main_clipped(tmp_path, chunk_workers):
+    rng = np.random.default_rng(0)
+    images = rng.normal(1000, 10, size=(30, 6, 7)).astype("uint16")
+    images[7, 2, 3] = 60000
+    for i, image in enumerate(images):
+        save(tmp_path / "z-{}.tif".format(i), image)
+    main(
+        [
+            "--reduce",
+            "clipped",
+            "--sigma",
+            "4",
+            "--accepted",
+            "--chunk-workers",
+            chunk_workers,
+            "--dir",
+            str(tmp_path),
+            "--output-dir",
+            str(tmp_path),
+            "z",
+        ]
+    )
+    accepted = load(tmp_path / "z_accepted_0_29.tif")
+    assert accepted[2, 3] == 29
+    assert np.sum(accepted) >= 29 * 42
+    actual = load(tmp_path / "z_avg_0_29.tif")
+    assert abs(actual[2, 3] - np.mean(np.delete(images[:, 2, 3], 7))) < 1e-3
+
+
+def test_main_dark_flat(tmp_path, series):
+    refs = tmp_path / "refs"
+    refs.mkdir()
+    darks = np.random.randint(100, size=(2, 6, 7), dtype="uint16")
+    flats = np.random.randint(2000, 3000, size=(2, 6, 7), dtype="uint16")
+    for i in range(2):
+        save(refs / "dark-{}.tif".format(i), darks[i])
+        save(refs / "flat-{}.tif".format(i), flats[i])
+    main(
+        [
+            "--dark",
+            str(refs / "dark-*.tif"),
+            "--flat",
+            str(refs / "flat-*.tif"),
+            "--cache-dir",
+            str(tmp_path / "cache"),
+            "--median",
+            "--dir",
+            str(tmp_path),
+            "--output-dir",
+            str(tmp_path),
+            "s",
+        ]
+    )
+    dark = np.mean(darks, axis=0)
+    flat = np.mean(flats, axis=0) - dark
+    corrected = (np.array(series) - dark) / flat * np.mean(flat)
+    actual = load(tmp_path / "s_avg_0_4.tif")
+    assert np.allclose(actual, np.mean(corrected, axis=0), rtol=1e-4)
+    actual = load(tmp_path / "s_median_0_4.tif")
+    assert np.allclose(actual, np.median(corrected, axis=0), rtol=1e-4)
+
+
+@pytest.mark.parametrize("dtype", ["float64", "int64", "kahan"])
+def test_main_accumulate_dtype(tmp_path, series, dtype):
+    main(
+        [
+            "--accumulate-dtype",
+            dtype,
+            "--dir",
+            str(tmp_path),
+            "--output-dir",
+            str(tmp_path),
+            "s",
+        ]
+    )
+    actual = load(tmp_path / "s_sum_0_4.tif")
+    assert np.all(actual == np.sum(series, axis=0))
+
+
+def test_main_many_basenames(tmp_path, series):
+    names = ["s"] + ["missing{}".format(i) for i in range(50)]
+    main(["--dir", str(tmp_path), "--output-dir", str(tmp_path / "out")] + names)
+    actual = load(tmp_path / "out" / "s_avg_0_4.tif")
+    assert np.allclose(actual, np.mean(series, axis=0))
+
+
+@pytest.mark.parametrize("group_workers", ["1", "2"])
+def test_main_recursive(tmp_path, group_workers):
+    images = np.random.randint(100, size=(3, 6, 7), dtype="uint16")
+    for i, reldir in enumerate(["run1", "run2", "run2/skip"]):
+        (tmp_path / "raw" / reldir).mkdir(parents=True)
+        save(tmp_path / "raw" / reldir / "a-0.tif", images[i])
+        save(tmp_path / "raw" / reldir / "a-1.tif", images[i] + 1)
+    main(
+        [
+            "--recursive",
+            "--exclude-dirs",
+            "*/skip",
+            "--group-workers",
+            group_workers,
+            "--dir",
+            str(tmp_path / "raw"),
+            "--output-dir",
+            str(tmp_path / "out"),
+            "a",
+        ]
+    )
+    for i, reldir in enumerate(["run1", "run2"]):
+        actual = load(tmp_path / "out" / reldir / "a_sum_0_1.tif")
+        assert np.all(actual == 2 * images[i] + 1)
+    assert not (tmp_path / "out" / "run2" / "skip").exists()
+
+
+def test_parse_config_include_dirs_without_recursive():
+    args = create_parser().parse_args(["--include-dirs", "run*", "a"])
+    with pytest.raises(ValueError):
+        parse_config(args)
+
+
+def test_main_mmap(tmp_path, series):
+    main(["--mmap", "--dir", str(tmp_path), "--output-dir", str(tmp_path), "s"])
+    actual = load(tmp_path / "s_sum_0_4.tif")
+    assert np.all(actual == np.sum(series, axis=0))
+
+
+def test_main_backend(tmp_path):
+    images = np.random.randint(100, size=(3, 6, 7), dtype="uint16")
+    for i, image in enumerate(images):
+        np.save(str(tmp_path / "n-{}.npy".format(i)), image)
+    main(
+        [
+            "--ext",
+            "npy",
+            "--backend",
+            "npy",
+            "--dir",
+            str(tmp_path),
+            "--output-dir",
+            str(tmp_path),
+            "n",
+        ]
+    )
+    assert np.all(load(tmp_path / "n_sum_0_2.tif") == np.sum(images, axis=0))
+
+
+def test_main_stack(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    frames = np.random.randint(2**12, size=(10, 6, 7), dtype="uint16")
+    with h5py.File(str(tmp_path / "scan.h5"), "w") as f:
+        f.create_dataset("/entry/data/data", data=frames, chunks=(4, 6, 7))
+    main(
+        [
+            "--stack",
+            str(tmp_path / "scan.h5") + ":/entry/data/data",
+            "--slice",
+            "2:8",
+            "--exclude",
+            "5",
+            "--std",
+            "--output-dir",
+            str(tmp_path),
+        ]
+    )
+    selected = frames[[2, 3, 4, 6, 7, 8]]
+    assert np.all(load(tmp_path / "scan_sum_2_8.tif") == np.sum(selected, axis=0))
+    actual = load(tmp_path / "scan_std_2_8.tif")
+    assert np.allclose(actual, np.std(selected, axis=0), rtol=1e-4)
+
+
+def test_main_tiff_stack(tmp_path):
+    import tifffile
+
+    frames = np.random.randint(2**12, size=(6, 6, 7), dtype="uint16")
+    tifffile.imwrite(str(tmp_path / "pages.tif"), frames, compression="zlib")
+    main(
+        [
+            "--stack",
+            str(tmp_path / "pages.tif"),
+            "--slice",
+            "1:",
+            "--output-dir",
+            str(tmp_path),
+        ]
+    )
+    actual = load(tmp_path / "pages_avg_1_5.tif")
+    assert np.allclose(actual, np.mean(frames[1:], axis=0))
+
+
+def test_main_h5_output(tmp_path, series):
+    h5py = pytest.importorskip("h5py")
+    main(
+        [
+            "--h5-output",
+            "--std",
+            "--median",
+            "--exclude",
+            "2",
+            "--dir",
+            str(tmp_path),
+            "--output-dir",
+            str(tmp_path / "out"),
+            "s",
+        ]
+    )
+    assert sorted(os.listdir(str(tmp_path / "out"))) == ["merged.h5"]
+    selected = np.array(series)[[0, 1, 3, 4]]
+    with h5py.File(str(tmp_path / "out" / "merged.h5"), "r") as f:
+        group = f["s"]
+        assert sorted(group) == ["avg", "inputs", "median", "std", "sum"]
+        assert np.all(group["sum"][()] == np.sum(selected, axis=0))
+        assert np.allclose(group["median"][()], np.median(selected, axis=0))
+        assert group.attrs["start"] == 0
+        assert group.attrs["stop"] == 4
+        assert group.attrs["count"] == 4
+        assert list(group.attrs["excluded"]) == [2]
+        assert len(group["inputs"]) == 4
+
+
+def test_main_partial_combine(tmp_path, series, capsys):
+    args = ["--dir", str(tmp_path), "--output-dir", str(tmp_path / "parts"), "s"]
+    for slice in ["0:1", "2:4"]:
+        assert main(["partial", "--moments", "--slice", slice] + args) == 0
+    assert main(["partial", "--slice", "4:"] + args) == 0
+    partials = sorted(str(path) for path in (tmp_path / "parts").iterdir())
+    assert [os.path.basename(path) for path in partials] == [
+        "s_partial_0_1.npz",
+        "s_partial_2_4.npz",
+        "s_partial_4_4.npz",
+    ]
+
+    out = str(tmp_path / "out")
+    assert main(["combine", "-o", out, "--std"] + partials[:2]) == 0
+    assert np.allclose(load(tmp_path / "out" / "s_avg_0_4.tif"), np.mean(series, 0))
+    assert np.all(load(tmp_path / "out" / "s_sum_0_4.tif") == np.sum(series, 0))
+    assert np.allclose(load(tmp_path / "out" / "s_std_0_4.tif"), np.std(series, 0))
+
+    assert main(["combine", "-o", out] + partials) == 1
+    assert "both contain the indices [4]" in capsys.readouterr().err
+    partials.pop(1)
+    assert main(["combine", "-o", out, "--std"] + partials) == 1
+    assert main(["combine", "-o", out] + partials) == 0
+    actual = load(tmp_path / "out" / "s_sum_0_4.tif")
+    assert np.all(actual == np.sum(np.array(series)[[0, 1, 4]], 0))
+
+
+def test_main_partial_combine_recursive(tmp_path):
+    images = np.random.randint(100, size=(6, 6, 7)).astype("uint16")
+    for i, image in enumerate(images):
+        run = tmp_path / "raw" / ("run1" if i < 3 else "run2")
+        run.mkdir(parents=True, exist_ok=True)
+        save(run / "a-{}.tif".format(i), image)
+    parts = tmp_path / "parts"
+    args = ["--recursive", "--dir", str(tmp_path / "raw"), "--output-dir", str(parts)]
+    assert main(["partial", "--all"] + args) == 0
+    partials = sorted(str(path) for path in parts.glob("*/*.npz"))
+    assert len(partials) == 2
+
+    out = tmp_path / "out"
+    assert main(["combine", "-o", str(out)] + partials) == 0
+    actual = load(out / "run1" / "a_avg_0_2.tif")
+    assert np.allclose(actual, np.mean(images[:3], axis=0))
+    actual = load(out / "run2" / "a_sum_3_5.tif")
+    assert np.all(actual == np.sum(images[3:], axis=0))
+    assert not (out / "a_avg_0_5.tif").exists()
+
+
+def test_main_shared_workers(tmp_path, series):
+    pytest.importorskip("multiprocessing.shared_memory")
+    args = ["--shared-workers", "2", "--exclude", "1", "--dir", str(tmp_path)]
+    main(args + ["--output-dir", str(tmp_path), "--median", "s"])
+    selected = np.array(series)[[0, 2, 3, 4]]
+    actual = load(tmp_path / "s_sum_0_4.tif")
+    assert np.all(actual == np.sum(selected, axis=0))
+    actual = load(tmp_path / "s_median_0_4.tif")
+    assert np.allclose(actual, np.median(selected, axis=0))
+    with pytest.raises(ValueError):
+        parse_config(create_parser().parse_args(args + ["--std", "s"]))
+
+
+def test_import_time():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "merge.app", "--help"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    imported = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            own, cumulative, name = line[len("import time:") :].split("|")
+            if cumulative.strip().isdigit():
+                imported[name.strip()] = int(cumulative)
+    # Image libraries are only imported when a file is loaded or saved
+    for module in ["skimage", "scipy", "imageio", "tifffile", "h5py"]:
+        assert module not in imported
+    assert imported["merge.accumulate"] < 2e6
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+from merge.backends import backends, get_backend
+
+
+@pytest.mark.parametrize(
+    "name, extension",
+    [("tifffile", "tif"), ("imageio", "png"), ("skimage", "tif"), ("npy", "npy")],
+)
+def test_save_load(tmp_path, name, extension):
+    image = np.random.randint(2**16, size=(6, 7), dtype="uint16")
+    path = tmp_path / "image.{}".format(extension)
+    backend = backends[name]
+    backend.save(path, image)
+    loaded = backend.load(path)
+    assert loaded.dtype == image.dtype
+    assert np.all(loaded == image)
+
+
+def test_get_backend():
+    assert get_backend("a-1.TIF") is backends["tifffile"]
+    assert get_backend("a-1.npy") is backends["npy"]
+    assert get_backend("a-1.png") is backends["imageio"]
+    assert get_backend("a-1.tif", "skimage") is backends["skimage"]
+    with pytest.raises(ValueError):
+        get_backend("a-1.tif", "unknown")
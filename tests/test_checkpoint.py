@@ -0,0 +1,87 @@
+import os
+import numpy as np
+import pytest
+from merge.accumulate import Accumulator, StatsAccumulator
+from merge.checkpoint import (
+    combine_partials,
+    covered_indices,
+    file_key,
+    load_checkpoint,
+    plan_update,
+    read_partial,
+    save_checkpoint,
+    save_partial,
+)
+
+
+def test_save_load(tmp_path):
+    acc = Accumulator()
+    acc(np.arange(6).reshape((2, 3)))
+    acc(np.ones((2, 3)))
+    merged = {3: ("/data/a-3.tif", 1), 4: ("/data/a-4.tif", 2)}
+    path = tmp_path / "checkpoint.npz"
+    save_checkpoint(path, acc, merged)
+    assert os.listdir(str(tmp_path)) == ["checkpoint.npz"]
+
+    loaded, loaded_merged = load_checkpoint(path)
+    assert loaded_merged == merged
+    assert loaded.count() == 2
+    assert np.all(loaded.sum() == acc.sum())
+
+
+def test_save_load_empty(tmp_path):
+    path = tmp_path / "checkpoint.npz"
+    save_checkpoint(path, Accumulator(), {})
+    acc, merged = load_checkpoint(path)
+    assert acc.count() == 0
+    assert acc.sum() == 0
+    assert merged == {}
+
+
+def test_plan_update(tmp_path):
+    keys = {}
+    for i in range(4):
+        path = tmp_path / "a-{}.tif".format(i)
+        path.write_text("")
+        keys[i] = file_key(path)
+    merged = {i: keys[i] for i in range(3)}
+    wanted = {i: keys[i] for i in range(1, 4)}
+    assert plan_update(merged, wanted) == ([0], [3])
+
+
+def test_plan_update_modified(tmp_path):
+    path = tmp_path / "a-0.tif"
+    path.write_text("")
+    key = file_key(path)
+    merged = {0: (key[0], key[1] - 1)}
+    assert plan_update(merged, {}) is None
+    assert plan_update({0: ("/does/not/exist", 0)}, {}) is None
+
+
+def test_combine_partials(tmp_path):
+    values = np.random.random((6, 2, 3))
+    paths = []
+    for i, part in enumerate([values[:2], values[2:5], values[5:]]):
+        acc = StatsAccumulator()
+        acc.extend(part)
+        paths.append(tmp_path / "{}.npz".format(i))
+        save_partial(paths[-1], acc, {}, "a", "run1")
+    assert read_partial(paths[0])[::3] == ("run1", True)
+    assert read_partial(paths[0])[1] == "a"
+
+    acc = combine_partials(paths)
+    assert acc.count() == 6
+    assert np.allclose(acc.sum(), np.sum(values, axis=0))
+    assert np.allclose(acc.var(), np.var(values, axis=0))
+    assert np.all(acc.max() == np.max(values, axis=0))
+
+    acc = combine_partials(paths, moments=False)
+    assert type(acc) is Accumulator
+    assert np.allclose(acc.avg(), np.mean(values, axis=0))
+
+
+def test_covered_indices():
+    partials = [("a", [4, 6]), ("b", [0, 2]), ("c", [5])]
+    assert covered_indices(partials).tolist() == [0, 2, 4, 5, 6]
+    with pytest.raises(ValueError, match="'b' and 'd' both contain the indices"):
+        covered_indices(partials + [("d", [1, 2])])
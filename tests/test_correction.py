@@ -0,0 +1,66 @@
+import os
+import numpy as np
+import pytest
+import merge.correction
+from merge.correction import Correction, load_reference, create_correction
+from merge.utils import save
+
+
+def test_correction():
+    dark = np.full((2, 3), 10.0)
+    flat = np.array([[12.0, 14.0, 10.0], [12.0, 14.0, 12.0]])
+    correction = Correction(dark, flat)
+    value = np.array([[20, 20, 20], [11, 14, 10]], dtype="uint16")
+    expected = (value - dark) / (flat - dark) * 2.8
+    expected[0, 2] = 0
+    actual = correction(value)
+    assert actual.dtype == np.dtype("float32")
+    assert np.allclose(actual, expected)
+
+
+def test_correction_dark_only():
+    correction = Correction(dark=np.full(3, 10.0))
+    assert np.all(correction(np.array([5, 10, 15], dtype="uint8")) == [-5, 0, 5])
+
+
+def test_create_correction_none():
+    assert create_correction() is None
+
+
+@pytest.fixture
+def darks(tmp_path):
+    darks = np.random.randint(100, size=(3, 6, 7), dtype="uint16")
+    for i, dark in enumerate(darks):
+        save(tmp_path / "dark-{}.tif".format(i), dark)
+    return darks
+
+
+def test_load_reference_cache(tmp_path, darks, monkeypatch):
+    monkeypatch.setattr(merge.correction, "references", {})
+    pattern = str(tmp_path / "dark-*.tif")
+    cache_dir = str(tmp_path / "cache")
+    reference = load_reference(pattern, cache_dir)
+    assert np.allclose(reference, np.mean(darks, axis=0))
+    assert len(os.listdir(cache_dir)) == 1
+    assert load_reference(pattern, cache_dir) is reference
+
+    monkeypatch.setattr(merge.correction, "load_items", None)
+    monkeypatch.setattr(merge.correction, "references", {})
+    assert np.all(load_reference(pattern, cache_dir) == reference)
+
+
+def test_load_reference_modified(tmp_path, darks, monkeypatch):
+    monkeypatch.setattr(merge.correction, "references", {})
+    pattern = str(tmp_path / "dark-*.tif")
+    cache_dir = str(tmp_path / "cache")
+    load_reference(pattern, cache_dir)
+    save(tmp_path / "dark-1.tif", darks[0])
+    os.utime(str(tmp_path / "dark-1.tif"), ns=(0, 0))
+    reference = load_reference(pattern, cache_dir)
+    assert np.allclose(reference, np.mean(darks[[0, 0, 2]], axis=0))
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_load_reference_no_files(tmp_path):
+    with pytest.raises(ValueError):
+        load_reference(str(tmp_path / "dark-*.tif"))
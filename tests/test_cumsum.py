@@ -0,0 +1,61 @@
+import os
+import numpy as np
+import pytest
+from merge.cumsum import CumulativeIndex, StaleIndexError, reduce_indexed
+from merge.utils import save, items_to_merge
+
+
+@pytest.fixture
+def series(tmp_path):
+    images = {}
+    for i in list(range(2, 12)) + list(range(13, 25)):
+        images[i] = np.random.randint(2**16, size=(6, 7), dtype="uint16")
+        save(tmp_path / "a-{}.tif".format(i), images[i])
+    items = [(i, tmp_path / "a-{}.tif".format(i)) for i in sorted(images)]
+    return images, items
+
+
+def test_build(tmp_path, series):
+    images, items = series
+    index = CumulativeIndex.build(str(tmp_path / "a_index"), items, stride=5)
+    assert index.prefixes.shape == (6, 6, 7)
+    for k in range(6):
+        expected = sum(
+            images[i].astype("float64") for i in images if i < 2 + 5 * k
+        )
+        assert np.allclose(index.prefixes[k], expected)
+
+
+@pytest.mark.parametrize(
+    "s, exclude",
+    [
+        (slice(None), []),
+        (slice(3, 20), []),
+        (slice(5, 6), []),
+        (slice(10, 16), [14]),
+        (slice(0, 100), [2, 3, 24]),
+        (slice(7, 19), [8, 12, 16]),
+    ],
+)
+def test_reduce(tmp_path, series, s, exclude):
+    images, items = series
+    index = CumulativeIndex.build(str(tmp_path / "a_index"), items, stride=5)
+    selected, missing, dups = items_to_merge(items, s, exclude)
+    acc = index.reduce(selected)
+    expected = sum(images[i].astype("float32") for i, path in selected)
+    assert acc.count() == len(selected)
+    assert acc.sum().dtype == np.dtype("float32")
+    assert np.allclose(acc.sum(), expected)
+
+
+def test_reduce_stale(tmp_path, series):
+    images, items = series
+    path = str(tmp_path / "a_index")
+    CumulativeIndex.build(path, items, stride=5)
+    save(items[3][1], images[5])
+    os.utime(str(items[3][1]), ns=(0, 0))
+    with pytest.raises(StaleIndexError):
+        CumulativeIndex(path).reduce(items[:5])
+    assert reduce_indexed(path, items[:5], slice(None)) is None
+    assert reduce_indexed(path, items[5:], slice(None)) is not None
+    assert reduce_indexed(path, items[5:], slice(None, None, 2)) is None
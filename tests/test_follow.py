@@ -0,0 +1,84 @@
+import logging
+import threading
+import numpy as np
+import pytest
+import merge.follow
+from merge.follow import Follower, follow
+from merge.utils import group_files, load, save
+
+
+pattern = r"(?P<basename>a)-(?P<index>[0-9]+)\.tif$"
+
+
+@pytest.fixture
+def images(tmp_path):
+    images = [
+        np.random.randint(2**16, size=(10, 20), dtype="uint16") for _ in range(6)
+    ]
+    for i, image in enumerate(images[:3]):
+        save(tmp_path / "a-{}.tif".format(i), image)
+    return images
+
+
+def test_follower_loads_new_items_only(tmp_path, images, monkeypatch):
+    loaded = []
+
+    def counting_load(path):
+        loaded.append(path)
+        return load(path)
+
+    monkeypatch.setattr(merge.follow, "load", counting_load)
+    follower = Follower("a", slice(None), [])
+    files = sorted(tmp_path.iterdir())
+    assert follower.update(group_files(files, pattern)["a"]) == 3
+    assert len(loaded) == 3
+
+    save(tmp_path / "a-3.tif", images[3])
+    files = sorted(tmp_path.iterdir())
+    assert follower.update(group_files(files, pattern)["a"]) == 1
+    assert len(loaded) == 4
+    assert (follower.start, follower.stop) == (0, 3)
+    assert np.allclose(follower.acc.sum(), np.sum(images[:4], axis=0))
+
+
+def test_follow_final_index(tmp_path, images):
+    avg = str(tmp_path / "{basename}_avg_{start}_{stop}.tif")
+    sum = str(tmp_path / "{basename}_sum_{start}_{stop}.tif")
+    follow(pattern, tmp_path, slice(None, 3), [], avg, sum, timeout=10)
+    assert np.allclose(load(tmp_path / "a_sum_0_2.tif"), np.sum(images[:3], axis=0))
+    assert np.allclose(load(tmp_path / "a_avg_0_2.tif"), np.mean(images[:3], axis=0))
+
+
+def test_follow_new_images(tmp_path, images):
+    avg = str(tmp_path / "{basename}_avg_{start}_{stop}.tif")
+    sum = str(tmp_path / "{basename}_sum_{start}_{stop}.tif")
+
+    def acquire():
+        for i in range(3, 6):
+            save(tmp_path / "a-{}.tif".format(i), images[i])
+
+    timer = threading.Timer(0.2, acquire)
+    timer.start()
+    follow(
+        pattern,
+        tmp_path,
+        slice(None, 6),
+        [],
+        avg,
+        sum,
+        poll_interval=0.05,
+        write_every=1,
+        timeout=10,
+    )
+    timer.join()
+    assert np.allclose(load(tmp_path / "a_sum_0_5.tif"), np.sum(images, axis=0))
+    # intermediate outputs are replaced by the latest ones
+    assert not (tmp_path / "a_sum_0_2.tif").exists()
+
+
+def test_follow_timeout(tmp_path, images, caplog):
+    caplog.set_level(logging.INFO)
+    sum = str(tmp_path / "{basename}_sum_{start}_{stop}.tif")
+    follow(pattern, tmp_path, slice(None), [], None, sum, timeout=0.1)
+    assert "No new images" in caplog.text
+    assert np.allclose(load(tmp_path / "a_sum_0_2.tif"), np.sum(images[:3], axis=0))
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from merge.h5output import H5Writer
+
+h5py = pytest.importorskip("h5py")
+
+
+def test_writer(tmp_path):
+    path = tmp_path / "merged.h5"
+    avg = np.random.rand(6, 7).astype("float32")
+    attrs = dict(start=0, stop=2, count=3, missing=np.array([], dtype="int64"))
+    with H5Writer(path, batch=2) as writer:
+        writer.write("a", {"avg": avg}, attrs, ["a-0.tif", "a-1.tif", "a-2.tif"])
+        assert path.exists()
+        assert writer.unflushed == 1
+        writer.write("run1/b", {"avg": avg}, attrs, ["b-0.tif"])
+        assert writer.unflushed == 0
+        writer.write("./c", {"avg": avg}, attrs, ["c-0.tif"])
+
+    with h5py.File(str(path), "r") as f:
+        assert sorted(f) == ["a", "c", "run1"]
+        assert np.all(f["a/avg"][()] == avg)
+        assert f["a/avg"].compression == "gzip"
+        assert f["a"].attrs["count"] == 3
+        assert [name.decode() for name in f["a/inputs"]] == [
+            "a-0.tif",
+            "a-1.tif",
+            "a-2.tif",
+        ]
+        assert "b" in f["run1"]
+
+    with H5Writer(path) as writer:
+        writer.write("a", {"sum": 3 * avg}, dict(attrs, count=4), ["a-0.tif"])
+    with h5py.File(str(path), "r") as f:
+        assert sorted(f) == ["a", "c", "run1"]
+        assert sorted(f["a"]) == ["inputs", "sum"]
+        assert f["a"].attrs["count"] == 4
@@ -0,0 +1,109 @@
+import os
+import time
+from merge.listing import (
+    find_files,
+    find_files_recursive,
+    list_files,
+    listings,
+    scan_dir,
+    scan_tree,
+)
+
+
+def touch(path):
+    with open(str(path), "w"):
+        pass
+
+
+def age(path, seconds=60):
+    mtime = time.time() - seconds
+    os.utime(str(path), (mtime, mtime))
+
+
+def test_scan_dir(tmp_path):
+    touch(tmp_path / "a-1.tif")
+    (tmp_path / "b-1.tif").mkdir()
+    assert scan_dir(tmp_path) == ["a-1.tif"]
+
+
+def test_list_files_cache(tmp_path):
+    dir = tmp_path / "data"
+    dir.mkdir()
+    touch(dir / "a-1.tif")
+    age(dir)
+    cache_dir = tmp_path / "cache"
+    assert list_files(dir, cache_dir) == ["a-1.tif"]
+    assert list(cache_dir.glob("listings/*.json"))
+
+    # An unchanged directory is not listed again
+    mtime = os.stat(str(dir)).st_mtime
+    touch(dir / "a-2.tif")
+    os.utime(str(dir), (mtime, mtime))
+    assert list_files(dir, cache_dir) == ["a-1.tif"]
+
+    age(dir, 30)
+    assert sorted(list_files(dir, cache_dir)) == ["a-1.tif", "a-2.tif"]
+
+
+def test_list_files_memory(tmp_path):
+    touch(tmp_path / "a-1.tif")
+    age(tmp_path)
+    assert list_files(tmp_path) == ["a-1.tif"]
+    assert str(tmp_path) in listings
+
+    mtime = os.stat(str(tmp_path)).st_mtime
+    touch(tmp_path / "a-2.tif")
+    os.utime(str(tmp_path), (mtime, mtime))
+    assert list_files(tmp_path) == ["a-1.tif"]
+
+    age(tmp_path, 30)
+    assert sorted(list_files(tmp_path)) == ["a-1.tif", "a-2.tif"]
+
+
+def test_list_files_recently_modified(tmp_path):
+    touch(tmp_path / "a-1.tif")
+    cache_dir = tmp_path / "cache"
+    assert list_files(tmp_path, cache_dir) == ["a-1.tif"]
+    # The mtime might not change if a file is added right after listing
+    assert not list(cache_dir.glob("listings/*.json"))
+
+
+def test_find_files_basenames(tmp_path):
+    for name in ["a-1.tif", "a-2.tif", "b-1.tif", "c-1.tif"]:
+        touch(tmp_path / name)
+    pattern = r"(?P<basename>.*)-(?P<index>[0-9]+)\.tif$"
+    groups = find_files(tmp_path, pattern, basenames={"a", "c"})
+    assert sorted(groups) == ["a", "c"]
+    assert sorted(groups["a"]) == [(1, tmp_path / "a-1.tif"), (2, tmp_path / "a-2.tif")]
+
+
+def test_scan_tree(tmp_path):
+    for reldir in ["run1/raw", "run1/tmp", "run2/raw"]:
+        (tmp_path / reldir).mkdir(parents=True)
+        touch(tmp_path / reldir / "a-1.tif")
+    touch(tmp_path / "b-1.tif")
+    listing = scan_tree(tmp_path, workers=4)
+    assert [reldir for reldir, names in listing] == [
+        ".",
+        "run1",
+        "run1/raw",
+        "run1/tmp",
+        "run2",
+        "run2/raw",
+    ]
+    assert listing[0] == (".", ["b-1.tif"])
+    listing = scan_tree(tmp_path, include=["*/raw"], exclude=["run2"], workers=4)
+    assert listing == [("run1/raw", ["a-1.tif"])]
+
+
+def test_find_files_recursive(tmp_path):
+    (tmp_path / "run1").mkdir()
+    for name in ["a-1.tif", "run1/a-1.tif", "run1/a-2.tif", "run1/b-1.tif"]:
+        touch(tmp_path / name)
+    pattern = r"(?P<basename>a)-(?P<index>[0-9]+)\.tif$"
+    groups = find_files_recursive(tmp_path, pattern, workers=2)
+    assert sorted(groups) == [(".", "a"), ("run1", "a")]
+    assert sorted(groups["run1", "a"]) == [
+        (1, tmp_path / "run1" / "a-1.tif"),
+        (2, tmp_path / "run1" / "a-2.tif"),
+    ]
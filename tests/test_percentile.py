@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from merge.percentile import (
+    rank_positions,
+    to_unsigned,
+    from_unsigned,
+    select_histogram,
+    percentiles,
+)
+from merge.utils import save
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "int8", "uint16", "int32", "int64"])
+def test_to_from_unsigned(dtype):
+    info = np.iinfo(dtype)
+    values = np.unique(np.array([info.min, info.min // 2, 0, 1, info.max], dtype=dtype))
+    unsigned = to_unsigned(values)
+    assert unsigned.dtype.kind == "u"
+    assert np.all(unsigned[1:] > unsigned[:-1])
+    assert np.all(from_unsigned(unsigned, dtype) == values)
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "int8", "uint16", "int16", "uint32"])
+def test_select_histogram(dtype):
+    info = np.iinfo(dtype)
+    images = np.random.randint(info.min, info.max, size=(7, 3, 5), dtype=dtype)
+    ranks = [0, 3, 6]
+    bits = 8 if np.dtype(dtype).itemsize > 1 else 4
+    actual = select_histogram(lambda: iter(images), ranks, dtype, 15, bits)
+    expected = np.sort(images.reshape(7, -1), axis=0)[ranks]
+    assert np.all(actual == expected)
+
+
+@pytest.mark.parametrize("n", [1, 2, 5, 10])
+def test_rank_positions(n):
+    values = np.arange(n) * 3.0
+    qs = [0, 10, 50, 75, 100]
+    lower, upper, weights = rank_positions(n, qs)
+    actual = values[lower] + (values[upper] - values[lower]) * weights
+    assert np.allclose(actual, np.percentile(values, qs))
+
+
+@pytest.fixture
+def items(tmp_path):
+    images = np.random.randint(2**16, size=(9, 6, 7), dtype="uint16")
+    items = []
+    for i, image in enumerate(images):
+        path = tmp_path / "a-{}.tif".format(i)
+        save(path, image)
+        items.append((i, path))
+    return images, items
+
+
+@pytest.mark.parametrize("method", ["sort", "histogram"])
+@pytest.mark.parametrize("max_memory", [1, 2**20])
+def test_percentiles(items, method, max_memory):
+    images, items = items
+    qs = [50, 0, 12.5, 100]
+    actual = percentiles(items, qs, max_memory=max_memory, method=method)
+    assert actual.shape == (4, 6, 7)
+    assert actual.dtype == np.dtype("float32")
+    assert np.allclose(actual, np.percentile(images, qs, axis=0))
+
+
+def test_percentiles_histogram_float(tmp_path, caplog):
+    images = np.random.randn(4, 6, 7).astype("float32")
+    items = []
+    for i, image in enumerate(images):
+        save(tmp_path / "a-{}.tif".format(i), image)
+        items.append((i, tmp_path / "a-{}.tif".format(i)))
+    actual = percentiles(items, [50], method="histogram")
+    assert np.allclose(actual[0], np.median(images, axis=0))
+    assert "integer" in caplog.text
+
+
+@pytest.mark.parametrize("method", ["sort", "histogram"])
+@pytest.mark.parametrize("broken", [0, 4])
+def test_percentiles_unreadable(items, method, broken, caplog):
+    images, items = items
+    items[broken][1].write_bytes(b"broken")
+    qs = [50, 100]
+    actual = percentiles(items, qs, max_memory=1, method=method)
+    expected = np.percentile(np.delete(images, broken, axis=0), qs, axis=0)
+    assert np.allclose(actual, expected)
+    assert "Cannot open" in caplog.text
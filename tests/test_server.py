@@ -0,0 +1,83 @@
+import os
+import socket
+import stat
+import threading
+import time
+import numpy as np
+import pytest
+from merge.app import main, run_job
+from merge.server import JobServer, remove_stale_socket, submit
+from merge.utils import load, save
+
+
+@pytest.fixture
+def series(tmp_path):
+    images = [np.random.randint(2**16, size=(6, 7), dtype="uint16") for _ in range(4)]
+    for i, image in enumerate(images):
+        save(tmp_path / "s-{}.tif".format(i), image)
+    return images
+
+
+@pytest.fixture
+def server(tmp_path):
+    path = str(tmp_path / "merge.sock")
+    server = JobServer(path, run_job)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield path
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def test_run_job(tmp_path, series, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    response = run_job(str(tmp_path), dict(basename=["s"], slice="1:"))
+    assert response["status"] == "ok"
+    assert "INFO     Merged 3 images" in response["log"]
+    actual = load(tmp_path / "s_sum_1_3.tif")
+    assert np.all(actual == np.sum(series[1:], axis=0))
+
+    response = run_job(str(tmp_path), dict(basename=["s"], quiet=1, unknown=1))
+    assert response["status"] == "error"
+    assert response["log"] == ["ERROR    Unknown options: unknown"]
+
+
+def test_submit(tmp_path, series, server, capsys):
+    args = ["--dir", str(tmp_path), "--output-dir", str(tmp_path / "out"), "s"]
+    assert main(["submit", "--socket", server] + args) == 0
+    assert "Merged 4 images" in capsys.readouterr().err
+    actual = load(tmp_path / "out" / "s_avg_0_3.tif")
+    assert np.allclose(actual, np.mean(series, axis=0))
+
+    assert main(["submit", "--socket", server, "--follow"] + args) == 1
+    assert "--follow cannot be used" in capsys.readouterr().err
+
+    response = submit(server, dict(options={}))
+    assert response["status"] == "error"
+    assert "cwd" in response["error"]
+
+
+def test_remove_stale_socket(tmp_path, server):
+    with pytest.raises(ValueError):
+        remove_stale_socket(server)
+    stale = tmp_path / "stale.sock"
+    stale.touch()
+    remove_stale_socket(str(stale))
+    assert not stale.exists()
+
+
+def test_socket_permissions(server):
+    assert stat.S_IMODE(os.stat(server).st_mode) == 0o600
+
+
+def test_client_disconnect(server, caplog):
+    with socket.socket(socket.AF_UNIX) as client:
+        client.connect(server)
+        client.sendall(b'{"options": {}}\n')
+        client.shutdown(socket.SHUT_RDWR)
+    for _ in range(100):
+        if "Cannot send response" in caplog.text:
+            break
+        time.sleep(0.05)
+    assert "Cannot send response" in caplog.text
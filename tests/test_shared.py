@@ -0,0 +1,69 @@
+import mmap
+import numpy as np
+import pytest
+from merge.correction import Correction
+from merge.shared import reads_rows, reduce_shared, shared_memory
+from merge.utils import load, save
+
+pytestmark = pytest.mark.skipif(shared_memory is None, reason="needs Python 3.8")
+
+
+@pytest.fixture
+def series(tmp_path):
+    images = [np.random.randint(2**16, size=(7, 6), dtype="uint16") for _ in range(5)]
+    for i, image in enumerate(images):
+        save(tmp_path / "s-{}.tif".format(i), image)
+    return images
+
+
+def items(tmp_path, n=5):
+    return [(i, tmp_path / "s-{}.tif".format(i)) for i in range(n)]
+
+
+@pytest.mark.parametrize("workers", [2, 3, 10])
+def test_reduce_shared(tmp_path, series, workers):
+    acc = reduce_shared(items(tmp_path), workers, prefetch=1)
+    assert acc.count() == 5
+    assert acc.sum().dtype == np.float32
+    assert np.all(acc.sum() == np.sum(series, axis=0))
+    assert isinstance(acc.sum().base, mmap.mmap)
+
+
+@pytest.mark.parametrize("policy", ["int64", "kahan"])
+def test_reduce_shared_policy(tmp_path, series, policy):
+    acc = reduce_shared(items(tmp_path), 2, policy=policy)
+    assert acc.policy() == policy
+    assert np.all(acc.sum() == np.sum(series, axis=0))
+
+
+def test_reduce_shared_correction(tmp_path, series):
+    dark = np.random.random((7, 6))
+    acc = reduce_shared(items(tmp_path), 3, correction=Correction(dark))
+    assert np.allclose(acc.avg(), np.mean(series, axis=0) - dark)
+
+
+def test_reduce_shared_missing(tmp_path, series, caplog):
+    acc = reduce_shared(items(tmp_path, 6), 2)
+    assert acc.count() == 5
+    assert "Cannot open" in caplog.text
+
+
+def test_reads_rows(tmp_path, series):
+    tifffile = pytest.importorskip("tifffile")
+    tifffile.imwrite(str(tmp_path / "zlib.tif"), series[0], compression="zlib")
+    assert reads_rows(tmp_path / "s-0.tif")
+    assert not reads_rows(tmp_path / "s-0.tif", loader=np.load)
+    assert not reads_rows(tmp_path / "zlib.tif")
+
+
+@pytest.mark.parametrize("policy", ["auto", "kahan"])
+def test_reduce_shared_whole_images(tmp_path, series, policy):
+    acc = reduce_shared(items(tmp_path, 6), 3, policy=policy, loader=load)
+    assert acc.count() == 5
+    assert np.allclose(acc.sum(), np.sum(series, axis=0))
+    assert isinstance(acc.sum().base.base, mmap.mmap)
+
+    arrays = list(enumerate(series))
+    dark = np.random.random((7, 6))
+    acc = reduce_shared(arrays, 2, correction=Correction(dark), loader=np.asarray)
+    assert np.allclose(acc.avg(), np.mean(series, axis=0) - dark)
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from merge.accumulate import StatsAccumulator
+from merge.stack import parse_source, read_batches, reduce_stack, open_stack
+from merge.utils import items_to_merge
+
+
+@pytest.fixture
+def frames(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    frames = np.random.randint(2**12, size=(20, 6, 7), dtype="uint16")
+    with h5py.File(str(tmp_path / "scan.h5"), "w") as f:
+        f.create_dataset("/entry/data/data", data=frames, chunks=(3, 6, 7))
+    return frames
+
+
+def test_parse_source():
+    assert parse_source("C:/scan.h5:/entry/data") == ("C:/scan.h5", "/entry/data")
+    assert parse_source("C:/scan.tif") == ("C:/scan.tif", None)
+    with pytest.raises(ValueError):
+        parse_source("scan.h5")
+
+
+def test_read_batches(tmp_path, frames):
+    file, stack = open_stack(str(tmp_path / "scan.h5") + ":/entry/data/data")
+    with file:
+        wanted = [0, 1, 2, 4, 5, 9, 19]
+        batch_bytes = 2 * stack.chunks[0] * frames[0].nbytes
+        batches = list(read_batches(stack, wanted, batch_bytes=batch_bytes))
+    assert [batch.tolist() for batch, data in batches] == [[0, 1, 2, 4, 5], [9], [19]]
+    for batch, data in batches:
+        assert np.all(data == frames[batch])
+
+
+def test_reduce_stack(tmp_path, frames):
+    source = str(tmp_path / "scan.h5") + ":/entry/data/data"
+    file, stack = open_stack(source)
+    with file:
+        items = [(i, source) for i in range(len(stack))]
+        items, missing, dups = items_to_merge(items, slice(2, 15), [4, 7])
+        acc = reduce_stack(stack, items, StatsAccumulator)
+    selected = frames[[i for i, path in items]]
+    assert acc.count() == 11
+    assert np.allclose(acc.sum(), np.sum(selected, axis=0))
+    assert np.allclose(acc.std(), np.std(selected, axis=0))
+    assert np.all(acc.max() == np.max(selected, axis=0))
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_tiff_stack(tmp_path, compression):
+    import tifffile
+
+    frames = np.random.randint(2**12, size=(12, 6, 7), dtype="uint16")
+    path = str(tmp_path / "scan.tif")
+    tifffile.imwrite(path, frames, compression=compression)
+    file, stack = open_stack(path)
+    with file:
+        assert isinstance(stack, np.memmap) == (compression is None)
+        items = [(i, path) for i in range(len(stack))]
+        items, missing, dups = items_to_merge(items, slice(1, None, 2), [5])
+        acc = reduce_stack(stack, items)
+    selected = frames[[1, 3, 7, 9, 11]]
+    assert acc.count() == 5
+    assert np.all(acc.sum() == np.sum(selected, axis=0))
+
+
+def test_tiff_stack_batches(tmp_path):
+    import tifffile
+
+    frames = np.random.randint(2**12, size=(10, 6, 7), dtype="uint16")
+    path = str(tmp_path / "scan.tif")
+    tifffile.imwrite(path, frames, compression="zlib")
+    file, stack = open_stack(path)
+    with file:
+        batch_bytes = 3 * frames[0].nbytes
+        batches = list(read_batches(stack, range(10), batch_bytes=batch_bytes))
+    assert [len(data) for batch, data in batches] == [3, 3, 3, 1]
+    assert np.all(np.concatenate([data for batch, data in batches]) == frames)
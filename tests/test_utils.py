@@ -1,6 +1,21 @@
+import pickle
+import threading
+import time
 import numpy as np
 import pytest
-from merge.utils import parse_slice, get_range, group_files, items_to_merge, save, load
+from merge.utils import (
+    parse_slice,
+    get_range,
+    group_files,
+    items_to_merge,
+    ItemTable,
+    save,
+    load,
+    prefetch_map,
+    load_rows,
+    load_mmap,
+    parse_size,
+)
 
 
 @pytest.mark.parametrize(
@@ -50,6 +65,18 @@ def test_group_files():
     }
 
 
+@pytest.mark.parametrize("basenames", [["a", "a1", "b"], ["a1", "a", "b"]])
+def test_match_basenames(basenames):
+    names = ["a12.tif", "a1.tif", "b3.tif", "a1x2.tif", "c1.tif"]
+    rest = r"(?P<index>[0-9]+)\.tif$"
+    alternation = "(?P<basename>{})".format("|".join(basenames)) + rest
+    assert group_files(names, "(?P<basename>.*)" + rest, basenames) == group_files(
+        names, alternation
+    )
+    with pytest.raises(ValueError):
+        group_files(names, alternation, basenames)
+
+
 def test_items_to_merge_order():
     names = ["a", "b", "c", "d", "e"]
     files = ["{}-0.tif".format(name) for name in names]
@@ -109,8 +136,123 @@ def test_items_to_merge_exclude():
     assert dups == []
 
 
+def test_item_table():
+    table = ItemTable([3, 1, 2], ["a-3.tif", "a-1.tif", "a-2.tif"])
+    assert len(table) == 3
+    assert table[1] == (1, "a-1.tif")
+    assert table[1:] == [(1, "a-1.tif"), (2, "a-2.tif")]
+    assert isinstance(table[1:], ItemTable)
+    assert pickle.loads(pickle.dumps(table)) == table
+    assert dict(table) == {3: "a-3.tif", 1: "a-1.tif", 2: "a-2.tif"}
+
+
+def reference_items_to_merge(items, slice, exclude):
+    items = sorted(items, key=lambda item: item[0])
+    indices = get_range(items[0][0], items[-1][0], slice)
+    sliced, missing, dups = [], [], []
+    for i in indices:
+        matching = [item for item in items if item[0] == i]
+        if len(matching) > 1:
+            dups.append(i)
+        if i not in exclude:
+            if matching:
+                sliced.append(matching[0])
+            else:
+                missing.append(i)
+    return sliced, missing, dups
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_items_to_merge_reference(seed):
+    rng = np.random.default_rng(seed)
+    indices = rng.integers(100, size=80)
+    items = [(int(i), "a-{}-{}.tif".format(i, n)) for n, i in enumerate(indices)]
+    exclude = rng.integers(100, size=20).tolist()
+    start, stop, step = rng.integers(10), rng.integers(50, 110), rng.integers(1, 4)
+    s = slice(int(start), int(stop), int(step))
+    expected = reference_items_to_merge(items, s, exclude)
+    assert items_to_merge(items, s, exclude) == expected
+    assert items_to_merge(ItemTable.from_items(items), s, exclude) == expected
+
+
+def test_load_mmap(tmp_path):
+    import tifffile
+
+    image = np.random.randint(2**16, size=(6, 7), dtype="uint16")
+    save(tmp_path / "plain.tif", image)
+    tifffile.imwrite(str(tmp_path / "zlib.tif"), image, compression="zlib")
+    mapped = load_mmap(tmp_path / "plain.tif")
+    assert isinstance(mapped, np.memmap)
+    assert np.all(mapped == image)
+    decoded = load_mmap(tmp_path / "zlib.tif")
+    assert not isinstance(decoded, np.memmap)
+    assert np.all(decoded == image)
+
+
 def test_save_load(tmp_path):
     image = np.random.randint(2**32, size=(100, 200), dtype="uint32")
     filename = tmp_path / "test.tif"
     save(filename, image)
     assert np.allclose(load(filename), image)
+
+
+@pytest.mark.parametrize("jobs, prefetch", [(1, 0), (1, 3), (4, 0), (4, 6)])
+def test_prefetch_map_order(jobs, prefetch):
+    def func(x):
+        time.sleep(0.001 * (x % 3))
+        return x * x
+
+    results = [result() for result in prefetch_map(func, range(20), jobs, prefetch)]
+    assert results == [x * x for x in range(20)]
+
+
+@pytest.mark.parametrize("jobs, prefetch, ahead", [(2, 3, 3), (4, 0, 4), (3, 3, 3)])
+def test_prefetch_map_bounded(jobs, prefetch, ahead):
+    started = []
+    lock = threading.Lock()
+
+    def func(x):
+        with lock:
+            started.append(x)
+        return x
+
+    for i, result in enumerate(prefetch_map(func, range(20), jobs, prefetch)):
+        assert result() == i
+        with lock:
+            assert max(started) <= i + ahead
+
+
+def test_prefetch_map_below_jobs():
+    with pytest.raises(ValueError):
+        next(prefetch_map(abs, range(20), jobs=8, prefetch=2))
+
+
+def test_prefetch_map_exception():
+    def func(x):
+        if x == 1:
+            raise OSError("cannot open")
+        return x
+
+    results = list(prefetch_map(func, range(3), jobs=2, prefetch=2))
+    assert results[0]() == 0
+    with pytest.raises(OSError):
+        results[1]()
+    assert results[2]() == 2
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_load_rows(tmp_path, compression):
+    import tifffile
+
+    image = np.random.randint(2**16, size=(10, 20), dtype="uint16")
+    filename = tmp_path / "test.tif"
+    tifffile.imwrite(str(filename), image, compression=compression)
+    assert np.all(load_rows(filename, 3, 6) == image[3:6])
+
+
+@pytest.mark.parametrize(
+    "str, expected",
+    [("100", 100), ("2K", 2048), ("1.5M", 3 * 2**19), ("1G", 2**30), ("1gb", 2**30)],
+)
+def test_parse_size(str, expected):
+    assert parse_size(str) == expected
@@ -0,0 +1,77 @@
+import os
+import threading
+import numpy as np
+import pytest
+import merge.writer
+from merge.backends import Backend, backends
+from merge.utils import group_files, load, save
+from merge.writer import AsyncWriter
+
+
+def test_async_writer(tmp_path):
+    image = np.arange(42, dtype="uint16").reshape(6, 7)
+    with AsyncWriter(workers=2) as writer:
+        for i in range(5):
+            writer.save(str(tmp_path / "{}.tif".format(i)), image)
+            image += 1
+    for i in range(5):
+        assert np.all(load(tmp_path / "{}.tif".format(i)).ravel() == np.arange(42) + i)
+    assert sorted(os.listdir(str(tmp_path))) == ["{}.tif".format(i) for i in range(5)]
+
+
+def test_async_writer_errors(tmp_path, caplog):
+    writer = AsyncWriter()
+    path = str(tmp_path / "missing" / "a.tif")
+    writer.save(path, np.zeros((6, 7)))
+    writer.save(str(tmp_path / "b.tif"), np.zeros((6, 7)))
+    assert writer.close() == [path]
+    assert "Cannot save '{}'".format(path) in caplog.text
+    assert (tmp_path / "b.tif").is_file()
+
+
+def test_async_writer_queue_size(tmp_path, monkeypatch):
+    release = threading.Event()
+    saved = []
+
+    def slow_save(path, image):
+        release.wait()
+        saved.append(path)
+
+    monkeypatch.setattr(merge.writer, "save", slow_save)
+    writer = AsyncWriter(workers=1, queue_size=1)
+    writer.save("a", np.zeros(1))
+    writer.save("b", np.zeros(1))
+    blocked = threading.Thread(target=writer.save, args=("c", np.zeros(1)))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+    release.set()
+    blocked.join()
+    assert writer.close() == []
+    assert saved == ["a", "b", "c"]
+
+
+def test_save_atomic(tmp_path):
+    (tmp_path / "a.tif").mkdir()
+    with pytest.raises(OSError):
+        save(tmp_path / "a.tif", np.zeros((6, 7)))
+    assert os.listdir(str(tmp_path)) == ["a.tif"]
+    save(tmp_path / "b.npy", np.ones((6, 7)))
+    assert sorted(os.listdir(str(tmp_path))) == ["a.tif", "b.npy"]
+    assert np.all(load(tmp_path / "b.npy") == 1)
+
+
+def test_save_temporary_name(tmp_path, monkeypatch):
+    names = []
+
+    def spy(path, image):
+        names.append(os.path.basename(path))
+        np.save(path, image)
+
+    monkeypatch.setitem(backends, "npy", Backend(np.load, spy))
+    save(tmp_path / "a-3.npy", np.zeros(1))
+    assert names[0] != "a-3.npy"
+    for sep in ["-", "_", ""]:
+        pattern = r"(?P<basename>.*){}(?P<index>[0-9]+)\.npy$".format(sep)
+        assert not group_files(names, pattern)
+    assert os.listdir(str(tmp_path)) == ["a-3.npy"]